@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+import asyncio, async_comms
+
+async def main():
+    device = async_comms.AsyncDevice("/dev/ttyACM0")
+    device.open()
+    await async_comms.update_pacemaker_params(device)
+    values, round_trip = await async_comms.request_params(device)
+    await async_comms.request_egram(device)
+    async for m_vraw, m_araw in device.egram_batches():
+        ...
+    await async_comms.stop_egram(device)
+    device.close()
+
+asyncio.run(main())
+
+python3 async_comms.py PORT... [--seconds 5]
+    Stream the egram from every port on one event loop and print the rates.
+
+MODULE PURPOSE
+--------------
+The DCM-Pacemaker protocol of comms.py on asyncio, so one event loop can drive
+several devices and the egram pipeline without a thread per port. The packets
+are the same (comms.command_packet(), comms.params_packet()); only the
+transport differs.
+
+    - AsyncDevice owns one serial port as a nonblocking file descriptor that
+      the event loop watches (SerialTransport).
+    - request_egram(), stop_egram(), update_pacemaker_params() and
+      request_params() are coroutines that take the device, with timeouts.
+    - device.egram_batches() is an async iterator of decoded (m_vraw, m_araw)
+      batches, one per chunk the port hands over.
+
+MODULE SECRETS
+--------------
+    - The port is opened with os.open(O_NONBLOCK) and set to raw mode with
+      termios (what pyserial does). The event loop calls back when bytes are
+      waiting (add_reader()) or when a blocked write can continue
+      (add_writer()), so nothing ever waits on the port.
+    - Bytes are decoded as they arrive with comms.EgramDecoder. Batches wait
+      in a bounded queue; if nobody iterates, the oldest batches are dropped
+      (counted in device.dropped) so memory stays bounded.
+    - A response to k_echo shares the stream with egram frames. While a
+      request_params() is waiting, arriving bytes are searched for the echo
+      header followed by a data section with a valid length and checksum;
+      the bytes in front of it still go to the egram decoder.
+    - If the port fails (device unplugged), the device closes it and the next
+      command or the egram iterator re-opens it, at most once every
+      comms.reconnect_period seconds (the same as comms.Connection).
+"""
+
+import argparse
+import asyncio
+import os
+import termios
+import time
+import tty
+
+import comms
+
+write_timeout = 1       # seconds a command may wait for the port
+batch_queue_len = 1024  # egram batches kept if nobody iterates
+read_size = 4096        # bytes read per callback
+
+"""
+Nonblocking file descriptor for a serial port, watched by the running event
+loop. Received bytes are passed to on_data(bytes); on_lost() is called once
+if the port fails.
+"""
+class SerialTransport():
+    def __init__(self, port_name, baudrate, on_data, on_lost):
+        self.port_name = port_name
+        self.baudrate = baudrate
+        self.on_data = on_data
+        self.on_lost = on_lost
+        self.loop = asyncio.get_running_loop()
+        self.fd = os.open(port_name, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            tty.setraw(self.fd)
+            attributes = termios.tcgetattr(self.fd)
+            speed = getattr(termios, f"B{baudrate}")
+            attributes[4] = speed   # input speed
+            attributes[5] = speed   # output speed
+            termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+            # same as pyserial: bytes from before the port was opened are stale
+            termios.tcflush(self.fd, termios.TCIFLUSH)
+        except (termios.error, OSError):
+            os.close(self.fd)
+            raise
+        self.loop.add_reader(self.fd, self.readable)
+
+    def readable(self):
+        try:
+            data = os.read(self.fd, read_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.lost()
+            return
+        if not data:
+            self.lost()
+            return
+        self.on_data(data)
+
+    """ Write the whole packet. Returns True on success. """
+    async def write(self, packet):
+        view = memoryview(bytes(packet))
+        while len(view) > 0:
+            if self.fd is None:
+                return False
+            try:
+                num_bytes = os.write(self.fd, view)
+            except BlockingIOError:
+                num_bytes = 0
+            except OSError:
+                self.lost()
+                return False
+            view = view[num_bytes:]
+            if len(view) > 0:
+                await self.writable()
+        return True
+
+    """ Wait until the port takes more bytes """
+    async def writable(self):
+        ready = self.loop.create_future()
+        self.loop.add_writer(self.fd, lambda: ready.done() or
+                                          ready.set_result(None))
+        try:
+            await ready
+        finally:
+            if self.fd is not None:
+                self.loop.remove_writer(self.fd)
+
+    def lost(self):
+        if self.fd is not None:
+            self.close()
+            self.on_lost()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+"""
+One Pacemaker on the running event loop. Commands go through the module
+functions (request_egram(device), ...); the egram comes out of
+egram_batches(). Create it (and call everything) from a coroutine.
+If self.capture is set (see capture.CaptureFile), every byte read or written
+is passed to capture.record() like comms.Connection.
+"""
+class AsyncDevice():
+    def __init__(self, port_name=None, baudrate=comms.baud,
+                 queue_len=batch_queue_len):
+        if port_name is None:
+            port_name = comms.port
+        self.port_name = port_name
+        self.baudrate = baudrate
+        self.transport = None
+        self.last_open_attempt = None
+        self.closed = False
+        self.capture = None
+        self.rx = bytearray()   # received bytes held back for a response
+        self.decoder = comms.EgramDecoder()
+        self.batches = asyncio.Queue(queue_len)
+        self.dropped = 0        # egram batches dropped because nobody read
+        self.response = None    # future waiting for a k_echo response
+        self.data_arrived = asyncio.Event()
+
+    """ Open the port if it isn't already open. Return True if it is open. """
+    def open(self):
+        if self.transport is not None:
+            return True
+        if self.closed:
+            return False
+        now = time.monotonic()
+        if (self.last_open_attempt is not None and
+                now - self.last_open_attempt < comms.reconnect_period):
+            return False
+        self.last_open_attempt = now
+        try:
+            self.transport = SerialTransport(self.port_name, self.baudrate,
+                                             self.received, self.lost)
+            self.last_open_attempt = None
+        except (OSError, termios.error):
+            self.transport = None
+        return self.transport is not None
+
+    """ Close the port for good and end egram_batches(). """
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.data_arrived.set()
+
+    """ Called by the transport when the port fails """
+    def lost(self):
+        print("Device Disconnected!")
+        self.transport = None
+        self.rx.clear()
+        self.data_arrived.set()
+
+    def is_connected(self):
+        return self.open()
+
+    """ Write packet, waiting at most timeout seconds. True on success. """
+    async def write(self, packet, timeout=write_timeout):
+        if not self.open():
+            return False
+        try:
+            success = await asyncio.wait_for(self.transport.write(packet),
+                                             timeout)
+        except asyncio.TimeoutError:
+            return False
+        if success and self.capture is not None:
+            self.capture.record("W", packet)
+        return success
+
+    """ Bytes from the transport: pick out a response, decode the rest. """
+    def received(self, data):
+        if self.capture is not None:
+            self.capture.record("R", data)
+        if self.response is None:
+            self.decode(data)
+            return
+
+        self.rx.extend(data)
+        start, end = comms.find_echo_response(self.rx)
+        if start is None:
+            start = len(self.rx)
+        self.decode(self.rx[:start])
+        if end is None:
+            del self.rx[:start]     # may be the start of the response
+            return
+
+        response = bytes(self.rx[start:end])
+        rest = bytes(self.rx[end:])
+        self.rx.clear()
+        if not self.response.done():
+            self.response.set_result(response)
+        self.response = None
+        self.decode(rest)
+
+    def decode(self, data):
+        if len(data) == 0:
+            return
+        m_vraw, m_araw = self.decoder.decode(bytes(data))
+        if len(m_vraw) == 0:
+            return
+        if self.batches.full():
+            self.batches.get_nowait()
+            self.dropped = self.dropped + 1
+        self.batches.put_nowait((m_vraw, m_araw))
+        self.data_arrived.set()
+
+    """
+    Send packet and wait for the k_echo response, timeout seconds in all.
+    Returns (response, round_trip): the response (header and data section)
+    or None, and the seconds from sending to receiving it.
+    """
+    async def exchange(self, packet, timeout):
+        if self.response is not None:
+            raise RuntimeError("a request is already waiting for a response")
+        self.response = asyncio.get_running_loop().create_future()
+        response = self.response
+        try:
+            sent_at = time.perf_counter()
+            if not await self.write(packet, timeout):
+                return None, None
+            data = await asyncio.wait_for(response, timeout)
+            return data, time.perf_counter() - sent_at
+        except asyncio.TimeoutError:
+            return None, None
+        finally:
+            self.response = None
+            if self.rx:
+                self.decode(self.rx)
+                self.rx.clear()
+
+    """
+    Async iterator of egram batches (m_vraw, m_araw uint16 NumPy arrays) as
+    they are decoded. Re-opens the port if it fails and ends when the device
+    is closed. Only one consumer at a time.
+    """
+    async def egram_batches(self):
+        while not self.closed:
+            if not self.batches.empty():
+                yield self.batches.get_nowait()
+                continue
+            if not self.open():
+                await asyncio.sleep(comms.reconnect_period)
+                continue
+            self.data_arrived.clear()
+            await self.data_arrived.wait()
+
+""" Command the Pacemaker to start sending egrams """
+async def request_egram(device, timeout=write_timeout):
+    return await device.write(comms.command_packet(comms.fn_code["rqst_egram"]),
+                              timeout)
+
+""" Command the Pacemaker to stop sending egrams """
+async def stop_egram(device, timeout=write_timeout):
+    return await device.write(comms.command_packet(comms.fn_code["stop_egram"]),
+                              timeout)
+
+""" 
+Send the parameters of the current mode to the Pacemaker. The parameters 
+comms.upload_params() last confirmed on the same port are forgotten.
+"""
+async def update_pacemaker_params(device, timeout=write_timeout):
+    comms.forget_acknowledged(device.port_name)
+    return await device.write(comms.params_packet(), timeout)
+
+"""
+Ask the Pacemaker for its parameters. Returns (values, round_trip) like
+comms.request_params(); values is None if no valid response came within
+timeout seconds.
+"""
+async def request_params(device, timeout=comms.response_timeout):
+    response, round_trip = await device.exchange(
+                    comms.command_packet(comms.fn_code["send_params"]), timeout)
+    if response is None:
+        return None, None
+    return comms.decode_params(response[comms.command_header_len:]), round_trip
+
+""" Stream the egram from one port for seconds. Returns the sample count. """
+async def stream_port(port_name, seconds):
+    device = AsyncDevice(port_name)
+    await request_egram(device)
+    num_samples = 0
+    deadline = time.monotonic() + seconds
+
+    async def count():
+        nonlocal num_samples
+        async for m_vraw, m_araw in device.egram_batches():
+            num_samples = num_samples + len(m_vraw)
+
+    counter = asyncio.create_task(count())
+    await asyncio.sleep(max(deadline - time.monotonic(), 0))
+    await stop_egram(device)
+    device.close()
+    await counter
+    return num_samples
+
+async def stream_ports(port_names, seconds):
+    counts = await asyncio.gather(*[stream_port(port_name, seconds)
+                                    for port_name in port_names])
+    for port_name, num_samples in zip(port_names, counts):
+        print(f"{port_name}: {num_samples / seconds:.0f} samples/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio egram streaming")
+    parser.add_argument("ports", nargs="+")
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(stream_ports(args.ports, args.seconds))
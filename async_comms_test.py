@@ -0,0 +1,146 @@
+import asyncio
+import time
+import pytest       # run pytest in the directory to run all tests in the file
+import async_comms
+import comms
+from simulator import PacemakerSimulator, synthetic_egram
+
+@pytest.fixture
+def simulator():
+    sim = PacemakerSimulator(seed=1)
+    sim.start()
+    yield sim
+    sim.quit()
+
+""" Iterate device's egram until n samples have arrived (or timeout) """
+async def collect(device, n, timeout=5):
+    m_vraw = []
+    m_araw = []
+
+    async def gather():
+        async for batch_vraw, batch_araw in device.egram_batches():
+            m_vraw.extend(batch_vraw.tolist())
+            m_araw.extend(batch_araw.tolist())
+            if len(m_vraw) >= n:
+                break
+
+    try:
+        await asyncio.wait_for(gather(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return m_vraw, m_araw
+
+""" Wait until the simulator has received fn """
+async def wait_for_command(sim, fn, timeout=5):
+    deadline = time.monotonic() + timeout
+    while fn not in sim.commands and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+class TestAsyncDevice():
+    def test_egram_stream(self, simulator):
+        async def run():
+            device = async_comms.AsyncDevice(simulator.port_name)
+            assert await async_comms.request_egram(device)
+            m_vraw, m_araw = await collect(device, 500)
+            assert await async_comms.stop_egram(device)
+            await wait_for_command(simulator, comms.k_estop)
+            device.close()
+            return m_vraw, m_araw
+
+        m_vraw, m_araw = asyncio.run(run())
+        expected = synthetic_egram(range(len(m_vraw)), simulator.rate)
+        assert len(m_vraw) >= 500
+        assert m_vraw == expected[0].tolist()
+        assert m_araw == expected[1].tolist()
+        assert simulator.commands == [comms.k_egram, comms.k_estop]
+
+    def test_request_params_while_streaming(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VVI")
+
+        async def run():
+            device = async_comms.AsyncDevice(simulator.port_name)
+            assert await async_comms.update_pacemaker_params(device)
+            await wait_for_command(simulator, comms.k_pparams)
+            assert await async_comms.request_egram(device)
+            before = await collect(device, 200)
+            values, round_trip = await async_comms.request_params(device)
+            after = await collect(device, 200)
+            device.close()
+            return values, round_trip, before[0] + after[0]
+
+        values, round_trip, m_vraw = asyncio.run(run())
+        assert values == comms.decode_params(simulator.params)
+        assert values["mode"] == comms.p["mode"].get()
+        assert 0 < round_trip < comms.response_timeout
+        # the response didn't cost any egram samples
+        expected = synthetic_egram(range(len(m_vraw)), simulator.rate)
+        assert m_vraw == expected[0].tolist()
+
+    def test_request_params_timeout(self, simulator):
+        async def run():
+            device = async_comms.AsyncDevice(simulator.port_name)
+            start = time.monotonic()
+            # nothing programmed yet, so the simulator doesn't answer
+            values, round_trip = await async_comms.request_params(device,
+                                                                  timeout=0.2)
+            device.close()
+            return values, time.monotonic() - start
+
+        values, seconds = asyncio.run(run())
+        assert values is None
+        assert seconds < 1
+
+    def test_update_forgets_acknowledged(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        connection = comms.get_connection(simulator.port_name)
+        packet = comms.params_packet()
+        connection.acknowledged = (comms.packet_hash(packet), {})
+
+        async def run():
+            device = async_comms.AsyncDevice(simulator.port_name)
+            assert await async_comms.update_pacemaker_params(device)
+            device.close()
+
+        asyncio.run(run())
+        # comms.upload_params() won't skip the next upload
+        assert connection.acknowledged is None
+
+    def test_two_devices_one_loop(self):
+        simulators = [PacemakerSimulator(seed=i) for i in range(2)]
+        for sim in simulators:
+            sim.start()
+
+        async def stream(sim):
+            device = async_comms.AsyncDevice(sim.port_name)
+            await async_comms.request_egram(device)
+            m_vraw, m_araw = await collect(device, 300)
+            await async_comms.stop_egram(device)
+            device.close()
+            return m_vraw
+
+        async def run():
+            return await asyncio.gather(*[stream(sim) for sim in simulators])
+
+        results = asyncio.run(run())
+        for sim in simulators:
+            sim.quit()
+        for m_vraw in results:
+            assert len(m_vraw) >= 300
+            assert m_vraw == synthetic_egram(range(len(m_vraw)), 1000)[0].tolist()
+
+    def test_reconnect(self, simulator):
+        async def run():
+            device = async_comms.AsyncDevice(simulator.port_name)
+            assert device.is_connected()
+            simulator.unplug()
+            assert not await async_comms.request_egram(device)
+
+            simulator.plug()
+            device.port_name = simulator.port_name
+            await asyncio.sleep(comms.reconnect_period)
+            assert await async_comms.request_egram(device)
+            m_vraw, m_araw = await collect(device, 100)
+            device.close()
+            return m_vraw
+
+        assert len(asyncio.run(run())) >= 100
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+python3 bench.py [--seconds 300] [--batch 16] [--frames 2000] [--input FILE]
+                 [--garbage 0] [--output results.json] [--baseline old.json]
+                 [--tolerance 0.1]
+
+    Runs every benchmark and prints a table. With --output the results are
+    saved as JSON. With --baseline they are compared to a saved run and the
+    exit status is 1 if any benchmark got slower by more than tolerance.
+
+    To check a change to comms.py or egram.py:
+        python3 bench.py --output before.json
+        ... make the change ...
+        python3 bench.py --baseline before.json
+
+MODULE PURPOSE
+--------------
+Benchmarks for the egram hot path, from serial bytes to pixels:
+    - decode: EgramThread.read_batch(), the body of the read thread's loop
+      (receive buffer, decode_egram_frames(), ring buffer write)
+    - get_data_<form>: EgramThread.get_data() for each form, as called by the
+      plot once per frame
+    - update_egram_<mode>: EgramPlot.update_egram() for each display mode,
+      drawn headless on an Agg canvas the size of the real plot
+
+The input is a synthetic 1 kHz egram stream (see simulator.py) or the bytes
+read from the serial port in a capture file (see capture.py) or a plain file
+of raw bytes (--input).
+
+Each benchmark reports:
+    - mb_per_s: stream bytes (6 per sample) handled per second
+    - samples_per_s: samples (per channel) handled per second
+    - latency_us: p50/p90/p99/max time of one call (one read batch or one plot
+      frame) in microseconds
+    - peak_memory_bytes: peak Python/NumPy allocation during the benchmark
+      (tracemalloc), not counting the input stream
+
+MODULE SECRETS
+--------------
+    - Timing and memory are measured in separate runs of each benchmark since
+      tracemalloc slows down every allocation.
+    - Only the calls themselves are timed. Feeding the ring buffer for the
+      get_data() and update_egram() benchmarks happens between the timed
+      calls.
+    - Comparisons use samples_per_s, so runs with different --seconds or
+      --input sizes can still be compared.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import capture
+import comms
+import egram
+import simulator
+
+"""
+Stands in for a Connection: hands out a byte stream chunk_size bytes at a time
+(what the serial port has waiting per read) and 0 bytes at the end.
+"""
+class StreamConnection():
+    def __init__(self, stream, chunk_size):
+        self.stream = memoryview(stream)
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.chunk_size, len(self.stream) - self.pos)
+        buffer[:size] = self.stream[self.pos:self.pos + size]
+        self.pos = self.pos + size
+        return size
+
+""" EgramPlot on an Agg canvas (no Tk window) """
+class HeadlessEgramPlot(egram.EgramPlot):
+    def __init__(self, egram_reader, x_len=1000, mode="scroll"):
+        self.egram_reader = egram_reader
+        self.x_len = x_len
+        self.mode = mode
+        self.figure = Figure(figsize=(10,5), dpi=100)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.create_plot()
+        self.canvas.draw()
+
+    def __getitem__(self, key):
+        return "white" # stands in for the tkinter background colour
+
+""" A synthetic egram stream of seconds at rate frames per second (bytes) """
+def synthetic_stream(seconds, rate=1000, garbage=0, seed=0):
+    rng = np.random.default_rng(seed)
+    seq = np.arange(int(seconds * rate))
+    frames = simulator.egram_frames(*simulator.synthetic_egram(seq, rate,
+                                                               noise=20,
+                                                               rng=rng))
+    return simulator.with_garbage(frames, garbage, rng)
+
+""" Percentiles of call times (seconds) in microseconds """
+def latency_summary(latencies):
+    latencies = 1e6 * np.asarray(latencies)
+    if len(latencies) == 0:
+        latencies = np.zeros(1)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {"p50":float(p50), "p90":float(p90), "p99":float(p99),
+            "max":float(latencies.max())}
+
+"""
+Run benchmark (a function returning (num_samples, call_times)) once for timing
+and once for peak memory, and return the result dictionary.
+"""
+def measure(benchmark, *args):
+    num_samples, latencies = benchmark(*args)
+    seconds = float(np.sum(latencies))
+
+    tracemalloc.start()
+    benchmark(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_bytes = num_samples * comms.egram_frame_len
+    return {
+        "calls":len(latencies),
+        "samples":num_samples,
+        "seconds":seconds,
+        "mb_per_s":num_bytes / seconds / 1e6 if seconds > 0 else 0.0,
+        "samples_per_s":num_samples / seconds if seconds > 0 else 0.0,
+        "latency_us":latency_summary(latencies),
+        "peak_memory_bytes":peak,
+    }
+
+"""
+Time EgramThread.read_batch() over the whole stream, batch frames per read.
+The ring is drained (untimed) after every read like the plot does.
+"""
+def bench_decode(stream, batch):
+    batch_len = batch * comms.egram_frame_len
+    connection = StreamConnection(stream, batch_len)
+    reader = comms.EgramThread(batch, connection=connection)
+    receive_buffer = comms.ReceiveBuffer(batch_len + comms.egram_frame_len)
+
+    num_samples = 0
+    latencies = []
+    while True:
+        start = time.perf_counter()
+        num_bytes = reader.read_batch(receive_buffer, batch_len)
+        latencies.append(time.perf_counter() - start)
+        if num_bytes == 0:
+            latencies.pop()
+            break
+        num_samples = num_samples + len(reader.get_data("numpy")["m_vraw"])
+    return num_samples, latencies
+
+""" Decode the whole stream at once. Returns (m_vraw, m_araw). """
+def decode_stream(stream):
+    m_vraw, m_araw, consumed = comms.decode_egram_frames(
+                                            np.frombuffer(stream, np.uint8))
+    return m_vraw, m_araw
+
+""" Time get_data(form) with samples_per_call new samples before each call """
+def bench_get_data(samples, samples_per_call, form):
+    reader = comms.EgramThread(samples_per_call)
+    num_samples = 0
+    latencies = []
+    for start in range(0, len(samples[0]), samples_per_call):
+        stop = start + samples_per_call
+        reader.store(samples[0][start:stop], samples[1][start:stop])
+
+        begin = time.perf_counter()
+        data = reader.get_data(form)
+        latencies.append(time.perf_counter() - begin)
+        num_samples = num_samples + len(data["m_vraw"])
+    return num_samples, latencies
+
+"""
+Time update_egram() for frames plot frames with samples_per_frame new samples
+each (16 samples is a 16 ms refresh period at 1 kHz).
+"""
+def bench_update_egram(samples, samples_per_frame, frames, mode):
+    reader = comms.EgramThread(samples_per_frame)
+    plot = HeadlessEgramPlot(reader, mode=mode)
+    num_samples = 0
+    latencies = []
+    for frame in range(frames):
+        start = (frame * samples_per_frame) % len(samples[0])
+        stop = start + samples_per_frame
+        reader.store(samples[0][start:stop], samples[1][start:stop])
+        num_samples = num_samples + reader.default_subscription.lag()
+
+        begin = time.perf_counter()
+        plot.update_egram()
+        latencies.append(time.perf_counter() - begin)
+    return num_samples, latencies
+
+""" Run every benchmark on stream and return the results by name """
+def run_benchmarks(stream, batch=16, frames=2000):
+    samples = decode_stream(stream)
+    results = {}
+    results["decode"] = measure(bench_decode, stream, batch)
+    for form in ("list", "array", "numpy"):
+        results[f"get_data_{form}"] = measure(bench_get_data, samples, batch,
+                                              form)
+    for mode in ("scroll", "sweep"):
+        results[f"update_egram_{mode}"] = measure(bench_update_egram, samples,
+                                                  batch, frames, mode)
+    return results
+
+""" Description of the machine and libraries, saved with the results """
+def environment():
+    return {
+        "time":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":platform.python_version(),
+        "numpy":np.__version__,
+        "matplotlib":matplotlib.__version__,
+        "machine":platform.machine(),
+        "platform":platform.platform(),
+    }
+
+"""
+Compare results to baseline results (both by benchmark name). Returns a list
+of (name, ratio, verdict) where ratio is the new samples_per_s over the old
+one and verdict is "slower", "faster" or "same" (within tolerance).
+"""
+def compare(results, baseline, tolerance=0.1):
+    comparison = []
+    for name in results:
+        if name not in baseline or baseline[name]["samples_per_s"] == 0:
+            continue
+        ratio = results[name]["samples_per_s"] / baseline[name]["samples_per_s"]
+        verdict = "same"
+        if ratio < 1 - tolerance:
+            verdict = "slower"
+        elif ratio > 1 + tolerance:
+            verdict = "faster"
+        comparison.append((name, ratio, verdict))
+    return comparison
+
+def print_results(results):
+    print(f"{'benchmark':<22}{'MB/s':>10}{'samples/s':>14}{'p50 us':>10}"
+          f"{'p99 us':>10}{'max us':>10}{'peak KiB':>10}")
+    for name, result in results.items():
+        latency = result["latency_us"]
+        print(f"{name:<22}{result['mb_per_s']:>10.2f}"
+              f"{result['samples_per_s']:>14.0f}{latency['p50']:>10.1f}"
+              f"{latency['p99']:>10.1f}{latency['max']:>10.1f}"
+              f"{result['peak_memory_bytes'] / 1024:>10.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Egram hot path benchmarks")
+    parser.add_argument("--seconds", type=float, default=300,
+                        help="length of the synthetic 1 kHz stream")
+    parser.add_argument("--batch", type=int, default=16,
+                        help="egram frames per serial read and per plot frame")
+    parser.add_argument("--frames", type=int, default=2000,
+                        help="plot frames drawn per update_egram benchmark")
+    parser.add_argument("--input", default=None,
+                        help="capture file (or raw serial bytes) to use instead")
+    parser.add_argument("--garbage", type=float, default=0,
+                        help="probability of junk bytes before a frame")
+    parser.add_argument("--output", default=None, help="save results (JSON)")
+    parser.add_argument("--baseline", default=None,
+                        help="results (JSON) to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.input is not None and capture.is_capture(args.input):
+        stream = capture.read_bytes(args.input)
+    elif args.input is not None:
+        with open(args.input, "rb") as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(args.seconds, garbage=args.garbage)
+
+    results = run_benchmarks(stream, batch=args.batch, frames=args.frames)
+    print_results(results)
+
+    if args.output is not None:
+        run = {"environment":environment(), "settings":vars(args),
+               "results":results}
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        comparison = compare(results, baseline, args.tolerance)
+        print()
+        for name, ratio, verdict in comparison:
+            print(f"{name:<22}{ratio:>8.2f}x  {verdict}")
+        if any(verdict == "slower" for _, _, verdict in comparison):
+            sys.exit(1)
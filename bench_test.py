@@ -0,0 +1,41 @@
+import numpy as np
+import pytest       # run pytest in the directory to run all tests in the file
+import bench
+
+class TestBenchmarks():
+    def test_decode_counts_every_sample(self):
+        stream = bench.synthetic_stream(2, garbage=0.05)
+        num_samples, latencies = bench.bench_decode(stream, 16)
+        assert num_samples == 2000
+        assert len(latencies) >= len(stream) // (16 * 6)
+
+    def test_get_data(self):
+        samples = bench.decode_stream(bench.synthetic_stream(1))
+        for form in ("list", "array", "numpy"):
+            num_samples, latencies = bench.bench_get_data(samples, 16, form)
+            assert num_samples == 1000
+            assert len(latencies) == 63
+
+    def test_update_egram(self):
+        samples = bench.decode_stream(bench.synthetic_stream(1))
+        for mode in ("scroll", "sweep"):
+            num_samples, latencies = bench.bench_update_egram(samples, 16, 5,
+                                                              mode)
+            assert num_samples == 80
+            assert len(latencies) == 5
+
+    def test_measure(self):
+        result = bench.measure(lambda: (3000, [0.001, 0.002]))
+        assert result["samples_per_s"] == pytest.approx(1e6)
+        assert result["mb_per_s"] == pytest.approx(6)
+        assert result["latency_us"]["max"] == pytest.approx(2000)
+
+class TestCompare():
+    def test_verdicts(self):
+        baseline = {"a":{"samples_per_s":100}, "b":{"samples_per_s":100},
+                    "c":{"samples_per_s":100}}
+        results = {"a":{"samples_per_s":80}, "b":{"samples_per_s":105},
+                   "c":{"samples_per_s":150}, "new":{"samples_per_s":1}}
+        assert bench.compare(results, baseline) == [("a", 0.8, "slower"),
+                                                    ("b", 1.05, "same"),
+                                                    ("c", 1.5, "faster")]
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+python3 capture.py record FILE [--seconds 60]
+    Capture an egram session from the Pacemaker on comms.port.
+
+python3 capture.py replay FILE [--speed 1] [--batch 256]
+    Replay a capture into an EgramThread and print the throughput.
+    --speed 0 replays as fast as possible.
+
+import comms, capture
+comms.get_connection().capture = capture.CaptureFile("glitch.cap")
+... use the GUI or comms as usual ...
+comms.get_connection().capture.close()
+
+reader = comms.EgramThread(16, connection=capture.ReplayConnection(
+                                                    "glitch.cap", speed=4))
+
+MODULE PURPOSE
+--------------
+Record the raw bytes that go over the serial port so that problems seen with
+a real device (egram glitches, dropped frames) can be reproduced offline
+against the exact byte stream, at the original speed, faster, or as fast as
+possible (which also makes a realistic throughput benchmark, see bench.py
+--input).
+
+Capture file format (little endian). Files are only ever appended to, so one
+file can hold several sessions.
+    magic       8 bytes  b"PMCAP001"
+    records, each:
+        timestamp   8 bytes  float, time.monotonic() when the bytes were read
+                             or written
+        kind        1 byte   b"R" bytes read from the device
+                             b"W" bytes written to the device
+                             b"S" a capture session starts (data is the wall
+                                  clock time, time.time() as a float)
+        length      4 bytes  number of data bytes
+        data        length bytes
+
+MODULE SECRETS
+--------------
+    - Records are buffered and flushed at least once every flush_period
+      seconds (and after every write to the device) so a 1 kHz stream doesn't
+      cost a system call per read.
+    - Monotonic time has no meaning across sessions (or reboots), so replay
+      restarts its clock at each session record instead of waiting out the
+      gap.
+    - Replay hands out one read record per readinto() call, the same chunks
+      the serial port returned during the capture.
+"""
+
+import argparse
+import struct
+import threading
+import time
+
+import comms
+
+magic = b"PMCAP001"
+record_header = struct.Struct("<dcI")
+wall_time = struct.Struct("<d")
+flush_period = 1.0 # seconds
+
+"""
+Append-only capture file. Set it as the capture of a comms.Connection to
+record everything the connection reads and writes. Thread safe.
+"""
+class CaptureFile():
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(magic)
+        else:
+            with open(path, "rb") as f:
+                if f.read(len(magic)) != magic:
+                    self.file.close()
+                    raise ValueError(f"{path} is not a capture file")
+        self.last_flush = time.monotonic()
+        self.record("S", wall_time.pack(time.time()))
+
+    """ Append a record of kind ("R", "W" or "S") holding data """
+    def record(self, kind, data):
+        with self.lock:
+            if self.file is None:
+                return
+            now = time.monotonic()
+            self.file.write(record_header.pack(now, kind.encode(), len(data)))
+            self.file.write(data)
+            if kind != "R" or now - self.last_flush > flush_period:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = None
+
+""" Yield every record of the capture file at path as (timestamp, kind, data) """
+def read_capture(path):
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                return  # end of file (or a record cut off by a crash)
+            timestamp, kind, length = record_header.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, kind.decode(), data
+
+""" True if the file at path is a capture file """
+def is_capture(path):
+    with open(path, "rb") as f:
+        return f.read(len(magic)) == magic
+
+""" All the bytes read from the device in the capture file, in one string """
+def read_bytes(path):
+    return b"".join(data for _, kind, data in read_capture(path)
+                    if kind == "R")
+
+"""
+Stands in for a comms.Connection and plays back the bytes read in a capture
+file. Each read record becomes available speed times faster than it was
+captured (speed 0 means right away). Writes are accepted and thrown away.
+"""
+class ReplayConnection():
+    def __init__(self, path, speed=1.0, read_timeout=comms.timeout):
+        self.path = path
+        self.speed = speed
+        self.read_timeout = read_timeout
+        self.records = read_capture(path)
+        self.pending = memoryview(b"")  # rest of the current read record
+        self.due = None                 # when the current record is available
+        self.clock = None   # (capture timestamp, replay time) it started at
+        self.finished = False
+
+    """ Move on to the next read record. Returns False at the end. """
+    def next_record(self):
+        for timestamp, kind, data in self.records:
+            if kind == "S":
+                self.clock = None
+            if kind != "R" or len(data) == 0:
+                continue
+            if self.clock is None:
+                self.clock = (timestamp, time.monotonic())
+            if self.speed:
+                captured_at, replay_start = self.clock
+                self.due = replay_start + (timestamp - captured_at) / self.speed
+            self.pending = memoryview(data)
+            return True
+        self.finished = True
+        return False
+
+    """
+    Same as Connection.readinto(): waits up to read_timeout for bytes and
+    returns the number of bytes copied into buffer.
+    """
+    def readinto(self, buffer):
+        if len(self.pending) == 0 and not self.next_record():
+            time.sleep(self.read_timeout)
+            return 0
+
+        if self.speed:
+            wait = self.due - time.monotonic()
+            if wait > self.read_timeout:
+                time.sleep(self.read_timeout)
+                return 0
+            if wait > 0:
+                time.sleep(wait)
+
+        num_bytes = min(len(buffer), len(self.pending))
+        buffer[:num_bytes] = self.pending[:num_bytes]
+        self.pending = self.pending[num_bytes:]
+        return num_bytes
+
+    def read(self, size):
+        buffer = bytearray(size)
+        num_bytes = self.readinto(buffer)
+        return bytes(buffer[:num_bytes])
+
+    def write(self, packet):
+        return True
+
+    def is_connected(self):
+        return not self.finished
+
+    """ True once every captured byte has been handed out """
+    def done(self):
+        return self.finished
+
+""" Capture an egram session of seconds from the device on comms.port """
+def record_egram(path, seconds):
+    connection = comms.get_connection()
+    connection.capture = CaptureFile(path)
+    reader = comms.EgramThread(16, connection=connection)
+    reader.start()
+    comms.request_egram()
+    time.sleep(seconds)
+    comms.stop_egram()
+    reader.quit()
+    reader.join()
+    connection.capture.close()
+    connection.capture = None
+
+"""
+Replay the capture at path into an EgramThread. Returns (samples, dropped,
+seconds): the number of samples decoded and lost and how long it took.
+"""
+def replay_egram(path, speed=1.0, batch=256):
+    connection = ReplayConnection(path, speed=speed)
+    reader = comms.EgramThread(batch, connection=connection)
+    start = time.perf_counter()
+    reader.start()
+    while not connection.done():
+        time.sleep(0.01)
+    seconds = time.perf_counter() - start
+    reader.quit()
+    reader.join()
+    with reader.data_lock:
+        samples = reader.broadcast.head
+        dropped = reader.default_subscription.dropped
+    return samples, dropped, seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serial capture and replay")
+    parser.add_argument("command", choices=["record", "replay"])
+    parser.add_argument("file")
+    parser.add_argument("--seconds", type=float, default=60,
+                        help="length of the recording")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay speed (0 is as fast as possible)")
+    parser.add_argument("--batch", type=int, default=256,
+                        help="egram frames per read when replaying")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record_egram(args.file, args.seconds)
+    else:
+        samples, dropped, seconds = replay_egram(args.file, args.speed,
+                                                 args.batch)
+        num_bytes = len(read_bytes(args.file))
+        print(f"{samples} samples ({dropped} dropped) in {seconds:.3f} s: "
+              f"{samples / seconds:.0f} samples/s, "
+              f"{num_bytes / seconds / 1e6:.2f} MB/s")
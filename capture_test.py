@@ -0,0 +1,120 @@
+import os
+import pty
+import time
+import tty
+import numpy as np
+import pytest       # run pytest in the directory to run all tests in the file
+import comms
+import capture
+import simulator
+
+""" Write a capture file with the given (timestamp, kind, data) records """
+def write_capture(path, records):
+    with open(path, "wb") as f:
+        f.write(capture.magic)
+        for timestamp, kind, data in records:
+            f.write(capture.record_header.pack(timestamp, kind.encode(),
+                                               len(data)))
+            f.write(data)
+
+def egram_stream(num_samples):
+    seq = np.arange(num_samples)
+    return simulator.egram_frames(*simulator.synthetic_egram(seq, 1000))
+
+class TestCaptureFile():
+    def test_round_trip(self, tmp_path):
+        path = tmp_path / "test.cap"
+        capture_file = capture.CaptureFile(path)
+        capture_file.record("W", b"\x16\x01\x47\x50")
+        capture_file.record("R", memoryview(b"\x16\x01\x00\x01\x00\x02"))
+        capture_file.close()
+
+        records = list(capture.read_capture(path))
+        assert [kind for _, kind, _ in records] == ["S", "W", "R"]
+        assert records[1][2] == b"\x16\x01\x47\x50"
+        assert records[2][2] == b"\x16\x01\x00\x01\x00\x02"
+        timestamps = [timestamp for timestamp, _, _ in records]
+        assert timestamps == sorted(timestamps)
+
+    def test_append(self, tmp_path):
+        path = tmp_path / "test.cap"
+        for data in (b"one", b"two"):
+            capture_file = capture.CaptureFile(path)
+            capture_file.record("R", data)
+            capture_file.close()
+
+        kinds = [kind for _, kind, _ in capture.read_capture(path)]
+        assert kinds == ["S", "R", "S", "R"]
+        assert capture.read_bytes(path) == b"onetwo"
+
+    def test_not_a_capture(self, tmp_path):
+        path = tmp_path / "data.bin"
+        path.write_bytes(b"\x16\x01\x00\x01\x00\x02")
+        assert not capture.is_capture(path)
+        with pytest.raises(ValueError):
+            capture.CaptureFile(path)
+
+    def test_cut_off_record(self, tmp_path):
+        path = tmp_path / "test.cap"
+        write_capture(path, [(0.0, "R", b"abc"), (0.1, "R", b"defgh")])
+        path.write_bytes(path.read_bytes()[:-2])
+        assert capture.read_bytes(path) == b"abc"
+
+    def test_connection_hook(self, tmp_path):
+        master_fd, slave_fd = pty.openpty()
+        tty.setraw(master_fd)
+        connection = comms.Connection(port_name=os.ttyname(slave_fd))
+        connection.capture = capture.CaptureFile(tmp_path / "test.cap")
+        assert connection.open()
+
+        packet = bytes([comms.k_sync, comms.k_soh, comms.k_egram, 0x50])
+        connection.write(packet)
+        os.write(master_fd, b"\x16\x01\x00\x01\x00\x02")
+        assert connection.read(6) == b"\x16\x01\x00\x01\x00\x02"
+        connection.close()
+        connection.capture.close()
+        os.close(slave_fd)
+        os.close(master_fd)
+
+        records = list(capture.read_capture(tmp_path / "test.cap"))
+        assert [(kind, data) for _, kind, data in records[1:]] == [
+                    ("W", packet), ("R", b"\x16\x01\x00\x01\x00\x02")]
+
+class TestReplayConnection():
+    def test_max_speed_into_thread(self, tmp_path):
+        frames = egram_stream(3000)
+        stream = frames.tobytes()
+        # chunks that split frames, an hour apart
+        records = [(3600.0 * i, "R", stream[start:start + 1000])
+                   for i, start in enumerate(range(0, len(stream), 1000))]
+        write_capture(tmp_path / "test.cap", records)
+
+        samples, dropped, seconds = capture.replay_egram(tmp_path / "test.cap",
+                                                         speed=0)
+        assert samples == 3000
+        assert dropped == 0
+        assert seconds < 5
+
+    def test_speed(self, tmp_path):
+        write_capture(tmp_path / "test.cap", [(10.0, "R", b"a"),
+                                              (10.4, "W", b"ignored"),
+                                              (10.8, "R", b"b")])
+        connection = capture.ReplayConnection(tmp_path / "test.cap", speed=4,
+                                              read_timeout=0.5)
+        start = time.monotonic()
+        assert connection.read(8) == b"a"
+        assert connection.read(8) == b"b"
+        assert 0.15 < time.monotonic() - start < 0.4
+        assert connection.read(8) == b""
+        assert connection.done()
+
+    def test_sessions_restart_the_clock(self, tmp_path):
+        write_capture(tmp_path / "test.cap", [(0.0, "S", b""),
+                                              (5.0, "R", b"a"),
+                                              (9999.0, "S", b""),
+                                              (1.0, "R", b"b")])
+        connection = capture.ReplayConnection(tmp_path / "test.cap",
+                                              read_timeout=0.5)
+        start = time.monotonic()
+        assert connection.read(8) + connection.read(8) == b"ab"
+        assert time.monotonic() - start < 0.2
@@ -3,7 +3,7 @@
 """
 Implement the following:
 ✓   1. Enable the user to download parameters to the Pacemaker.
-x   2. Request to see current parameters in the Pacemaker
+✓   2. Request to see current parameters in the Pacemaker
 ✓   3. Request that the Pacemaker stream egram data, which must then be 
        displayed and printed (if requested by the user).
 ✓   4. Instruct the pacemaker to stop streaming egram data.
@@ -20,17 +20,29 @@ structure.
 We implemented a read thread for the egram data stream since reading the port 
 directly from the GUI slowed it down while the code waited for packets to 
 come in. The read thread can gather and store packets without blocking GUI main
-loop operation.
+loop operation. Besides the plot (get_data()), other consumers can subscribe()
+to the read thread and each get the whole stream.
+
+The serial port is owned by a single Connection object per device (see 
+get_connection()). Commands and the egram read thread share it instead of 
+opening their own port, so a button press doesn't pay for re-opening the port 
+and doesn't drop egram bytes in the middle of a stream. If the device is 
+unplugged, the connection is re-opened on the next access.
 
 Details on threading:
 https://www.tutorialspoint.com/python/python_multithreading.htm
 """
 
+import hashlib
 import serial
+import struct
 import time
 import threading
+from array import array
+import numpy as np
 from params import params as p
 from params import params_by_pacing_mode as p_by_mode
+from params import NonNumericParam
 
 # Internal Constants
 k_egram = 0x47
@@ -41,9 +53,21 @@ k_soh = 0x01
 k_streamPeriod = 1 # millisecond (interval between egram samples)
 k_sync = 0x16
 
+# egram frame layout: SYNC SOH m_vraw(2) m_araw(2)
+egram_header_len = 2
+egram_data_len = 4
+egram_frame_len = egram_header_len + egram_data_len
+egram_channels = ("m_vraw", "m_araw") # rows of the sample arrays
+
 port = "/dev/ttyACM0" # CHANGE THIS ONE TO COM_ FOR WINDOWS! 
 baud = 115200
 timeout = 0.1 # read waits 0.1 s for something in the buffer (++ efficient ++)
+reconnect_period = 0.5 # seconds to wait between attempts to re-open the port
+egram_capacity = 60000 # samples kept per channel if nobody reads (60 s)
+response_timeout = 0.5 # seconds to wait for the Pacemaker to answer k_echo
+command_header_len = 4 # SYNC SOH FnCode Chksum
+verify_attempts = 3    # times program_and_verify() sends the parameters
+verify_budget = 2      # seconds program_and_verify() may take in all
 
 fn_code = {
             "rcv_params":k_pparams,
@@ -53,6 +77,174 @@ fn_code = {
           }
 
 
+""" 
+Long-lived owner of the serial port for one device.
+Writes are serialized with a lock so that commands can be sent while the egram
+read thread is reading from the same port. Any serial error closes the port, 
+and the next read or write re-opens it (at most once every reconnect_period 
+seconds so that a missing device isn't hammered with open calls).
+If self.capture is set (see capture.CaptureFile), every byte read or written
+is passed to capture.record() with the direction ("R" or "W").
+"""
+class Connection():
+    def __init__(self, port_name=port, baudrate=baud, read_timeout=timeout):
+        self.port_name = port_name
+        self.baudrate = baudrate
+        self.read_timeout = read_timeout
+        self.serial_port = None
+        self.last_open_attempt = None
+        self.open_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.capture = None
+        self.reader = None      # the EgramThread reading the port, if any
+        self.response = None    # PendingResponse of a request_params() call
+        # (packet hash, values) of the parameters the device last confirmed
+        self.acknowledged = None
+
+    """ Open the port if it isn't already open. Return True if it is open. """
+    def open(self):
+        return self.get_port() is not None
+
+    """ 
+    Open the port if it isn't already open and return it (None if it can't be
+    opened). Use the returned object rather than self.serial_port, which 
+    close() may set to None from another thread at any time.
+    """
+    def get_port(self):
+        with self.open_lock:
+            if self.serial_port is not None:
+                return self.serial_port
+
+            now = time.monotonic()
+            if (self.last_open_attempt is not None and 
+                    now - self.last_open_attempt < reconnect_period):
+                return None
+            self.last_open_attempt = now
+
+            try:
+                self.serial_port = serial.Serial(port=self.port_name, 
+                                                 baudrate=self.baudrate, 
+                                                 timeout=self.read_timeout)
+                self.last_open_attempt = None
+            except serial.serialutil.SerialException:
+                self.serial_port = None
+
+            return self.serial_port
+
+    """ Close the port. The next read or write will re-open it. """
+    def close(self):
+        with self.open_lock:
+            if self.serial_port is not None:
+                try:
+                    self.serial_port.close()
+                except (serial.serialutil.SerialException, OSError):
+                    pass
+            self.serial_port = None
+
+    """ Called when the port fails (usually because the device was unplugged) """
+    def disconnected(self):
+        print("Device Disconnected!")
+        self.close()
+        self.acknowledged = None    # it may come back with other parameters
+
+    """ Return True if the port is open and still responding. """
+    def is_connected(self):
+        serial_port = self.serial_port
+        if serial_port is None:
+            return self.open()
+
+        try:
+            serial_port.in_waiting  # fails if the device has gone away
+            connected = True
+        except (serial.serialutil.SerialException, OSError):
+            self.disconnected()
+            connected = False
+
+        return connected
+
+    """ Write the whole packet and flush it. Return True on success. """
+    def write(self, packet):
+        with self.write_lock:
+            serial_port = self.get_port()
+            if serial_port is None:
+                return False
+            try:
+                serial_port.write(packet)
+                serial_port.flush()
+                success = True
+                if self.capture is not None:
+                    self.capture.record("W", packet)
+            except (serial.serialutil.SerialException, OSError):
+                self.disconnected()
+                success = False
+
+        return success
+
+    """ 
+    Read up to len(buffer) bytes into buffer and return the number of bytes 
+    read. Returns 0 after the read timeout if nothing arrived or if the device 
+    isn't connected.
+    """
+    def readinto(self, buffer):
+        serial_port = self.get_port()
+        if serial_port is None:
+            time.sleep(self.read_timeout)
+            return 0
+        try:
+            num_bytes = serial_port.readinto(buffer)
+        except (serial.serialutil.SerialException, OSError, TypeError):
+            # pyserial raises TypeError if the port is closed under it
+            self.disconnected()
+            num_bytes = 0
+
+        num_bytes = num_bytes or 0
+        if num_bytes > 0 and self.capture is not None:
+            self.capture.record("R", buffer[:num_bytes])
+        return num_bytes
+
+    """ Read up to size bytes. """
+    def read(self, size):
+        buffer = bytearray(size)
+        num_bytes = self.readinto(buffer)
+        return bytes(buffer[:num_bytes])
+
+connections = {}
+connections_lock = threading.Lock()
+
+""" 
+Return the shared Connection for port_name, creating it on first use. 
+Defaults to the module's port setting at the time of the call (so tools like 
+the simulator can point comms at another port).
+"""
+def get_connection(port_name=None):
+    if port_name is None:
+        port_name = port
+    with connections_lock:
+        if port_name not in connections:
+            connections[port_name] = Connection(port_name=port_name)
+        return connections[port_name]
+
+""" 
+A response that a request is waiting for. Whoever reads the port (the 
+EgramThread if one is running, otherwise the request itself) hands it over 
+with set().
+"""
+class PendingResponse():
+    def __init__(self):
+        self.event = threading.Event()
+        self.data = None
+        self.received_at = None
+
+    def set(self, data):
+        self.data = data
+        self.received_at = time.perf_counter()
+        self.event.set()
+
+    """ Wait up to timeout seconds. Returns the response or None. """
+    def wait(self, timeout):
+        self.event.wait(timeout)
+        return self.data
+
 """ XOR checksum of an iterable of bytes """
 def checksum(packet_bytes):
     c_sum = 0
@@ -60,166 +252,751 @@ def checksum(packet_bytes):
         c_sum = c_sum ^ byte 
     return c_sum
         
-""" Command the Pacemaker to start sending egrams
+""" 
+Command packet for fn (a fn_code value).
 Packet contains 4 header bytes with no data section.
     SYNC
     SOH
     FnCode
     Chksum
 """
-def request_egram(): # not sure how to handle receiving it... periodic GUI function?
+def command_packet(fn):
     packet = bytearray()
     packet.append(k_sync)
     packet.append(k_soh)
-    packet.append(fn_code["rqst_egram"])
+    packet.append(fn)
     packet.append(checksum(packet[0:3]))
+    return packet
 
-    packet_len = len(packet)
+""" Command the Pacemaker to start sending egrams """
+def request_egram(): # not sure how to handle receiving it... periodic GUI function?
+    packet = command_packet(fn_code["rqst_egram"])
 
-    try:
-        with serial.Serial(port=port, baudrate=baud, timeout=timeout) as s:
-            s.write(packet)
-            print(f"Writing: {packet}")
-            s.flush()
-        success = True
-    except serial.serialutil.SerialException:
-        success = False
+    print(f"Writing: {packet}")
+    success = get_connection().write(packet)
 
     return success
 
-""" 
-Command the Pacemaker to stop sending egrams 
-Packet contains 4 header bytes with no data section.
-    SYNC
-    SOH
-    FnCode
-    Chksum
-"""
+""" Command the Pacemaker to stop sending egrams """
 def stop_egram():
-    packet = bytearray()
-    packet.append(k_sync)
-    packet.append(k_soh)
-    packet.append(fn_code["stop_egram"])
-    packet.append(checksum(packet[0:3]))
+    packet = command_packet(fn_code["stop_egram"])
 
-    packet_len = len(packet)
-
-    try:
-        with serial.Serial(port=port, baudrate=baud, timeout=timeout) as s:
-            s.write(packet)
-            print(f"Writing: {packet}")
-            s.flush()
-        success = True
-    except serial.serialutil.SerialException:
-        success = False
+    print(f"Writing: {packet}")
+    success = get_connection().write(packet)
 
     return success
 
 """ 
 Construct a parameters packet based on the current mode. 
 Reduce the message size by not transmitting parameters that aren't applicable 
-to the current mode.
+to the current mode (see ParamsCodec for the layout).
+"""
+def params_packet():
+    codec = params_codecs[p["mode"].get()]
+    values = {param_name: p[param_name].get() for param_name in codec.names}
+    return command_packet(fn_code["rcv_params"]) + codec.encode(values)
+
+""" 
+Send the parameters of the current mode to the Pacemaker. Nothing checks 
+that it took them, so they aren't remembered as confirmed (see 
+upload_params()).
 """
 def update_pacemaker_params():
-    packet = bytearray()
-    # construct header
-    packet.append(k_sync)
-    packet.append(k_soh)
-    packet.append(fn_code["rcv_params"])
-    packet.append(checksum(packet[0:3]))
+    packet = params_packet()
     
-    relevant_params = ["mode"]
-    current_mode = p["mode"].get_str()
-    relevant_params = relevant_params + p_by_mode[current_mode]
-
-    # NOTE: parameters that have an "Off" option need a boolean byte in front
-    # which tells us if they are to be used or not.
-    for param_name in relevant_params:
-        param_value = p[param_name].get()
-        byte_size = p[param_name].get_max_value_size_in_bytes()
-        
-        # packet byte order is big endian
-        for i in range(8*(byte_size-1),-1,-8):
-            if param_value is None: # TODO change this behaviour to use 1 bool byte "Off" if param is None, "On" otherwise, followed by data bytes
-                packet.append(0x00)
+    print(f"Writing: {packet}")
+    forget_acknowledged()
+    success = get_connection().write(packet)
+
+    return success
+
+""" 
+Ask the Pacemaker for its parameters (k_echo) and wait up to timeout seconds 
+for its response: the echo header followed by the data section of the current
+mode (the same layout as a k_pparams packet, see decode_params()).
+Returns (values, round_trip) where values is a dictionary of the parameter 
+values as transmitted (see decode_params()) and round_trip is the seconds 
+from sending the request to receiving the whole response. values is None if 
+no valid response arrived in time.
+If an EgramThread is reading the port, it picks the response out of the egram
+stream; otherwise the response is read here, a packet at a time so the read 
+returns as soon as the bytes are in.
+"""
+def request_params(timeout=response_timeout):
+    connection = get_connection()
+    packet = command_packet(fn_code["send_params"])
+    response = PendingResponse()
+    connection.response = response
+    try:
+        print(f"Writing: {packet}")
+        sent_at = time.perf_counter()
+        if not connection.write(packet):
+            return None, None
+
+        deadline = sent_at + timeout
+        if connection.reader is not None:
+            data = response.wait(timeout)
+        else:
+            data = read_echo_response(connection, response, deadline)
+    finally:
+        connection.response = None
+
+    if data is None:
+        return None, None
+    values = decode_params(data[command_header_len:])
+    return values, response.received_at - sent_at
+
+""" 
+Read the port until a k_echo response arrives (handed to response) or the
+deadline (a time.perf_counter() time) passes. Returns the response.
+"""
+def read_echo_response(connection, response, deadline):
+    buff = bytearray()
+    while time.perf_counter() < deadline:
+        # read only the bytes the response still needs
+        start, end = find_echo_response(buff)
+        if start is None:
+            del buff[:max(len(buff) - (command_header_len - 1), 0)]
+            needed = command_header_len + 1 - len(buff)
+        else:
+            del buff[:start]
+            if len(buff) <= command_header_len:
+                needed = command_header_len + 1 - len(buff)
             else:
-                packet.append(0xff & (param_value >> i))
+                needed = command_header_len + \
+                         params_data_len(buff[command_header_len]) - len(buff)
 
-    data_checksum = checksum(packet[4:])
+        buff.extend(connection.read(max(needed, 1)))
+        start, end = find_echo_response(buff)
+        if end is not None:
+            response.set(bytes(buff[start:end]))
+            return response.data
+    return None
 
-    packet.append(data_checksum)
+""" 
+Program the parameters of the current mode and make sure the Pacemaker took 
+them: send the k_pparams packet, read the parameters back with 
+request_params() and compare them field by field with what was sent. Only if
+they differ (or nothing came back) is the packet sent again, at most 
+max_attempts times in all and not after time_budget seconds.
+Returns (verified, mismatches, attempts) where mismatches is a dictionary of
+{param_name: (sent, read back)} for the last attempt (read back is None if 
+there was no response). Verified parameters are remembered as the ones the 
+device has (see upload_params()).
+"""
+def program_and_verify(max_attempts=verify_attempts, time_budget=verify_budget,
+                       packet=None):
+    if packet is None:
+        packet = params_packet()
+    sent = decode_params(packet[command_header_len:])
+    deadline = time.perf_counter() + time_budget
+    connection = get_connection()
+    mismatches = {}
+    attempts = 0
 
-    packet_len = len(packet)
-    
-    try:
-        with serial.Serial(port=port, baudrate=baud, timeout=timeout) as s:
-            s.write(packet)
-            print(f"Writing: {packet}")
-            s.flush()
-        success = True
-    except serial.serialutil.SerialException:
-        success = False
+    while attempts < max_attempts and time.perf_counter() < deadline:
+        attempts = attempts + 1
+        connection.acknowledged = None  # until this packet is verified
+        print(f"Writing: {packet}")
+        if not connection.write(packet):
+            mismatches = {name: (value, None) for name, value in sent.items()}
+            # the port can't be re-opened sooner (see Connection.open())
+            time.sleep(max(min(reconnect_period, 
+                               deadline - time.perf_counter()), 0))
+            continue
 
-    return success
+        timeout = min(response_timeout, deadline - time.perf_counter())
+        values, round_trip = request_params(max(timeout, 0))
+        if values is None:
+            mismatches = {name: (value, None) for name, value in sent.items()}
+            continue
+
+        mismatches = {name: (value, values.get(name)) 
+                      for name, value in sent.items() 
+                      if values.get(name) != value}
+        if not mismatches:
+            connection.acknowledged = (packet_hash(packet), sent)
+            return True, {}, attempts
+
+    return False, mismatches, attempts
+
+""" 
+Forget the parameters the device on port_name last confirmed, because it is 
+being programmed with a packet that isn't verified (so upload_params() sends 
+the next one whatever it is).
+"""
+def forget_acknowledged(port_name=None):
+    get_connection(port_name).acknowledged = None
+
+""" Hash that identifies an encoded parameters packet """
+def packet_hash(packet):
+    return hashlib.sha1(packet).hexdigest()
 
-""" Lower priority to implement because we are currently just echoing params. """
-def request_params():
-    pass
+""" Old value in upload_params()'s changes for a parameter with none """
+not_confirmed = object()
+
+""" 
+Program the parameters of the current mode only if they differ from the ones
+the device last confirmed (compared by the hash of the encoded packet), so 
+pressing Send again doesn't take the port away from the egram for nothing.
+Returns (result, changed):
+    - result is "unchanged" (nothing sent), "programmed" (sent and verified)
+      or "failed" (see program_and_verify())
+    - changed is a dictionary of {param_name: (old, new)} of the parameters 
+      that differ from the confirmed ones. old is not_confirmed for a 
+      parameter without a confirmed value (nothing was confirmed yet, or it 
+      isn't used in the mode that was), since None means "Off".
+"""
+def upload_params(max_attempts=verify_attempts, time_budget=verify_budget):
+    packet = params_packet()
+    acknowledged = get_connection().acknowledged
+    if acknowledged is not None and acknowledged[0] == packet_hash(packet):
+        return "unchanged", {}
+
+    values = decode_params(packet[command_header_len:])
+    old_values = {} if acknowledged is None else acknowledged[1]
+    changed = {name: (old_values.get(name, not_confirmed), value) 
+               for name, value in values.items() 
+               if name not in old_values or old_values[name] != value}
+
+    verified, mismatches, attempts = program_and_verify(max_attempts, 
+                                                        time_budget, packet)
+    return ("programmed" if verified else "failed"), changed
 
 """ Determine if the Pacemaker is connected for connection status light """
 def pacemaker_connected():
-    if EgramThread.port_in_use:
-        connected = True
+    return get_connection().is_connected()
+
+""" 
+struct format of the value of param: the smallest big endian integer that 
+holds every programmable value, signed if any of them is negative. 
+Non-numeric parameters are sent as the index of their value.
+"""
+def field_format(param):
+    if isinstance(param, NonNumericParam):
+        limits = [0, len(param.get_strings()) - 1]
     else:
-        try:
-            serial_port = serial.Serial(port=port, 
-                                        baudrate=baud, 
-                                        timeout=timeout)
-            serial_port.close()
-            connected = True 
-        except serial.serialutil.SerialException:
-            connected = False
+        limits = []
+        for v in param.programmable_values:
+            if isinstance(v, dict):
+                limits = limits + [v["min"], v["max"]]
+            elif v is not None:
+                limits.append(v)
+
+    low = min(limits)
+    high = max(limits)
+    for signed, unsigned, num_bits in [("b", "B", 8), ("h", "H", 16),
+                                       ("i", "I", 32)]:
+        if low >= 0 and high < (1 << num_bits):
+            return unsigned
+        if -(1 << (num_bits - 1)) <= low and high < (1 << (num_bits - 1)):
+            return signed
+    raise ValueError(f"values {low} to {high} don't fit in 32 bits")
+
+""" 
+Packs and unpacks the data section of a parameters packet for one pacing 
+mode with a struct.Struct compiled once from params and params_by_pacing_mode.
+The data section is the mode's parameters in order (the mode first), big 
+endian, then an XOR checksum. A parameter that has an "Off" option 
+(programmable value None) is sent as a flag byte, 1 if it is on and 0 if it 
+is off, followed by its value (0 when off). Values are what 
+params[name].get() returns (None for off, the index for the mode).
+"""
+class ParamsCodec():
+    def __init__(self, mode):
+        self.mode = mode
+        self.mode_value = p["mode"].get_strings().index(mode)
+        self.names = ["mode"] + p_by_mode[mode]
+        self.has_off = [None in p[param_name].programmable_values
+                        for param_name in self.names]
+        self.formats = [field_format(p[param_name])
+                        for param_name in self.names]
+        layout = ""
+        for has_off, value_format in zip(self.has_off, self.formats):
+            layout = layout + ("B" if has_off else "") + value_format
+        self.layout = struct.Struct(">" + layout)
+        self.data_len = self.layout.size + 1   # checksum
+
+    """ Data section (with its checksum) for a dictionary of values """
+    def encode(self, values):
+        fields = []
+        for param_name, has_off in zip(self.names, self.has_off):
+            value = values[param_name]
+            if has_off:
+                fields.append(0 if value is None else 1)
+            fields.append(0 if value is None else value)
+        data = bytearray(self.layout.pack(*fields))
+        data.append(checksum(data))
+        return data
 
-    return connected
+    """ 
+    Dictionary of values from a data section. Raises ValueError if the length
+    or checksum is wrong. 
+    """
+    def decode(self, data):
+        if len(data) != self.data_len:
+            raise ValueError(f"bad parameters data section length {len(data)}")
+        if checksum(data[:-1]) != data[-1]:
+            raise ValueError("bad parameters data section checksum")
+
+        fields = iter(self.layout.unpack_from(data))
+        values = {}
+        for param_name, has_off in zip(self.names, self.has_off):
+            on = next(fields) if has_off else True
+            value = next(fields)
+            values[param_name] = value if on else None
+        return values
+
+""" ParamsCodec of every pacing mode with a parameter layout, by mode index """
+params_codecs = {codec.mode_value:codec for codec in 
+                 [ParamsCodec(mode) for mode in p_by_mode 
+                  if mode in p["mode"].get_strings()]}
+
+""" Length of the longest k_echo response (header and data section) """
+max_response_len = command_header_len + max(codec.data_len for codec in 
+                                            params_codecs.values())
+
+""" 
+Number of bytes in the data section of a parameters packet (including its 
+checksum) for the pacing mode with index mode_value, the value of the first 
+data byte. Returns None for modes that have no parameter layout.
+"""
+def params_data_len(mode_value):
+    codec = params_codecs.get(mode_value)
+    return None if codec is None else codec.data_len
+
+""" 
+Decode the data section of a parameters packet (mode byte first, checksum 
+last). Returns a dictionary of the values of the mode's parameters as they are
+transmitted (what params[name].get() returns, so "mode" is its index and an 
+"Off" parameter is None). Raises ValueError if the data isn't valid.
+"""
+def decode_params(data):
+    codec = params_codecs.get(data[0]) if len(data) > 0 else None
+    if codec is None:
+        raise ValueError("parameters data section has no known mode")
+    return codec.decode(data)
+
+""" 
+Find a k_echo response in buff (bytes-like): the echo header and a data 
+section whose length matches its mode byte and whose checksum is right. 
+Returns (start, end) of the response, (start, None) if a response may start 
+at start but hasn't fully arrived, or (None, None).
+"""
+def find_echo_response(buff):
+    header = bytes(command_packet(k_echo))
+    start = buff.find(header)
+    while start >= 0:
+        data = start + command_header_len
+        if len(buff) <= data:
+            return start, None
+        data_len = params_data_len(buff[data])
+        if data_len is not None:
+            if len(buff) < data + data_len:
+                return start, None
+            section = buff[data:data + data_len]
+            if checksum(section[:-1]) == section[-1]:
+                return start, data + data_len
+        start = buff.find(header, start + 1)
+
+    # the end of buff may hold the first bytes of a header
+    for size in range(min(command_header_len - 1, len(buff)), 0, -1):
+        if buff[-size:] == header[:size]:
+            return len(buff) - size, None
+    return None, None
 
 """ Autogenerate packet documentation """
 def print_data_section_spec():
-    for mode in p_by_mode:
-        relevant_params = p_by_mode[mode]
-        byte_size = p["mode"].get_max_value_size_in_bytes()
-
-        s = f"MODE: {mode}\n"
+    for codec in params_codecs.values():
+        s = f"MODE: {codec.mode}\n"
         s += f"    PARAMETER BYTES\n"
-        s += f"    mode {byte_size}\n"
-        for param_name in relevant_params:
-            byte_size = p[param_name].get_max_value_size_in_bytes()
-            s += f"    {param_name} {byte_size}\n"
+        for param_name, has_off, value_format in zip(codec.names, codec.has_off,
+                                                     codec.formats):
+            if has_off:
+                s += f"    {param_name}_on 1\n"
+            byte_size = struct.calcsize(value_format)
+            signed = " (signed)" if value_format.islower() else ""
+            s += f"    {param_name} {byte_size}{signed}\n"
         s += "    checksum 1\n"
         print(s)
 
+""" 
+The frame starts a scan of the bytes in order would find among the candidate
+starts (sorted): each start that isn't inside the frame kept before it. One 
+pass, so a stream full of SYNC SOH pairs costs the same per byte as any other.
+"""
+def first_frame_starts(starts):
+    kept = []
+    next_allowed = -1
+    for start in starts.tolist():
+        if start >= next_allowed:
+            kept.append(start)
+            next_allowed = start + egram_frame_len
+    return np.array(kept, dtype=starts.dtype)
+
+""" 
+Find every complete egram frame in buff (a uint8 NumPy array) at once.
+Frame starts are the SYNC SOH pairs. A SYNC SOH pair can also show up inside 
+the data section of a frame, so starts that overlap the frame before them are
+dropped (the same result as scanning the bytes in order).
+Returns (m_vraw, m_araw, consumed) where m_vraw and m_araw are uint16 arrays
+and consumed is the number of bytes at the front of buff that can be thrown 
+away. The bytes after consumed may hold the start of a partial frame.
+"""
+def decode_egram_frames(buff):
+    num_bytes = len(buff)
+    last = num_bytes - egram_frame_len + 1  # frames must start before this
+    if last <= 0:
+        empty = np.empty(0, dtype=np.uint16)
+        return empty, empty, 0
+
+    is_start = (buff[:last] == k_sync) & (buff[1:last + 1] == k_soh)
+    starts = np.flatnonzero(is_start)
+
+    # Drop starts that fall inside the previous frame. Usually none do, so the
+    # check is vectorised and the scan only runs when SYNC SOH shows up in a 
+    # data section.
+    if len(starts) > 1 and (np.diff(starts) < egram_frame_len).any():
+        starts = first_frame_starts(starts)
+
+    data = starts + egram_header_len
+    # packet byte order is big endian
+    m_vraw = (buff[data].astype(np.uint16) << 8) | buff[data + 1]
+    m_araw = (buff[data + 2].astype(np.uint16) << 8) | buff[data + 3]
+
+    consumed = last
+    if len(starts) > 0:
+        consumed = max(consumed, starts[-1] + egram_frame_len)
+
+    return m_vraw, m_araw, int(consumed)
+
+""" 
+Batch egram decoder for a byte stream that arrives in arbitrary chunks.
+Bytes that might be the start of a frame are carried over to the next chunk.
+"""
+class EgramDecoder():
+    def __init__(self):
+        self.carry = np.empty(0, dtype=np.uint8)
+
+    """ Decode all complete frames in chunk. Returns (m_vraw, m_araw). """
+    def decode(self, chunk):
+        buff = np.concatenate((self.carry, np.frombuffer(chunk, dtype=np.uint8)))
+        m_vraw, m_araw, consumed = decode_egram_frames(buff)
+        self.carry = buff[consumed:]
+        return m_vraw, m_araw
+
+""" 
+Preallocated receive buffer for the serial port.
+Bytes are read straight into a bytearray with readinto() and consumed from the
+front with a read cursor, so the cost per byte doesn't depend on the size of 
+the buffer. Unconsumed bytes (at most a partial frame) are moved back to the 
+front only when there is no room left at the end.
+"""
+class ReceiveBuffer():
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.array = np.frombuffer(self.buffer, dtype=np.uint8)
+        self.read_pos = 0
+        self.write_pos = 0
+
+    """ Number of bytes that have been received but not consumed. """
+    def __len__(self):
+        return self.write_pos - self.read_pos
+
+    """ Read up to size bytes from connection. Returns the number of bytes. """
+    def fill(self, connection, size):
+        if self.write_pos + size > len(self.buffer):
+            self.compact()
+        size = min(size, len(self.buffer) - self.write_pos)
+
+        num_bytes = connection.readinto(self.view[self.write_pos:
+                                                  self.write_pos + size])
+        self.write_pos = self.write_pos + num_bytes
+        return num_bytes
+
+    """ Move the unconsumed bytes to the front of the buffer. """
+    def compact(self):
+        num_pending = len(self)
+        self.array[:num_pending] = self.array[self.read_pos:self.write_pos]
+        self.read_pos = 0
+        self.write_pos = num_pending
+
+    """ uint8 NumPy view of the unconsumed bytes (no copy). """
+    def pending(self):
+        return self.array[self.read_pos:self.write_pos]
+
+    """ Discard num_bytes from the front of the unconsumed bytes. """
+    def consume(self, num_bytes):
+        self.read_pos = self.read_pos + num_bytes
+        if self.read_pos == self.write_pos:
+            self.read_pos = 0
+            self.write_pos = 0
+
+""" 
+One consumer's cursor into a SampleBroadcast (see EgramThread.subscribe()).
+A subscriber is slow when more than max_lag samples are waiting for it. What
+happens then depends on policy:
+    - "skip" moves the cursor ahead to the newest max_lag samples (for 
+      displays, which only care about recent samples)
+    - "report" leaves the cursor alone and prints a warning once until the 
+      subscriber catches up (for recorders and analyzers, which want every 
+      sample). Samples are only lost when the ring wraps around onto them.
+    - "drop_newest" keeps the oldest max_lag samples (copied out of the ring,
+      in self.held) and drops everything after them until the subscriber 
+      reads
+Samples that a subscriber never got are counted in self.dropped. The gaps 
+also show in the "seq" of the batches.
+"""
+class Subscription():
+    policies = ("skip", "report", "drop_newest")
+
+    def __init__(self, reader, name, policy, max_lag):
+        assert policy in Subscription.policies
+        self.reader = reader
+        self.name = name
+        self.policy = policy
+        self.max_lag = max_lag
+        self.seq = reader.broadcast.head # only samples from now on
+        self.dropped = 0
+        self.slow = False
+        self.held = None    # (seq, samples) kept by "drop_newest"
+
+    """ 
+    All samples that arrived for this subscriber since its last call, in the
+    same form as EgramThread.get_data(). "numpy" views are valid until the 
+    next call if the subscriber keeps within max_lag (see SampleBroadcast).
+    """
+    def get_data(self, form="numpy"):
+        with self.reader.data_lock:
+            seq, samples = self.reader.broadcast.read_view(self)
+            if form != "numpy":
+                samples = samples.copy()
+        return samples_dict(seq, samples, form)
+
+    """ Number of samples waiting for this subscriber """
+    def lag(self):
+        with self.reader.data_lock:
+            held = 0 if self.held is None else self.held[1].shape[1]
+            return self.reader.broadcast.head - self.seq + held
+
+    """ Stop receiving samples """
+    def cancel(self):
+        self.reader.unsubscribe(self)
+
+""" 
+Ring buffer that every subscriber reads at its own pace.
+Samples are written once and never removed: each Subscription keeps the 
+sequence number of the next sample it wants, and the oldest samples are
+simply overwritten when the ring wraps, so a long egram session runs in 
+bounded memory (2 bytes per sample) whoever reads it. Every sample's sequence
+number is its position in the stream, so readers can tell where a batch 
+belongs and spot gaps. 
+read_view() lends out views of the ring instead of copies. Views stay intact 
+as long as the subscriber has fewer than capacity // 2 samples waiting, so 
+"skip" subscriptions are limited to that max_lag.
+Not thread safe on its own (EgramThread protects it with data_lock).
+"""
+class SampleBroadcast():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.samples = np.zeros((len(egram_channels), capacity), 
+                                dtype=np.uint16)
+        self.head = 0   # sequence number of the next sample to be written
+        self.subscriptions = []
+
+    """ Add a batch of samples and check the subscribers' lag """
+    def write(self, m_vraw, m_araw):
+        for subscription in self.subscriptions:
+            if subscription.policy == "drop_newest":
+                self.drop_newest(subscription, m_vraw, m_araw)
+
+        num_samples = len(m_vraw)
+        if num_samples > self.capacity:
+            self.head = self.head + num_samples - self.capacity
+            m_vraw = m_vraw[-self.capacity:]
+            m_araw = m_araw[-self.capacity:]
+            num_samples = self.capacity
+
+        pos = self.head % self.capacity
+        first = min(num_samples, self.capacity - pos)
+        self.samples[0, pos:pos + first] = m_vraw[:first]
+        self.samples[1, pos:pos + first] = m_araw[:first]
+        self.samples[0, :num_samples - first] = m_vraw[first:]
+        self.samples[1, :num_samples - first] = m_araw[first:]
+        self.head = self.head + num_samples
+
+        for subscription in self.subscriptions:
+            self.check_lag(subscription)
+
+    """ Skip a slow subscriber ahead or report it (see Subscription) """
+    def check_lag(self, subscription):
+        lag = self.head - subscription.seq
+        if subscription.policy == "skip" and lag > subscription.max_lag:
+            skipped = lag - subscription.max_lag
+        else:
+            skipped = max(lag - self.capacity, 0) # overwritten
+        subscription.seq = subscription.seq + skipped
+        subscription.dropped = subscription.dropped + skipped
+
+        slow = lag > subscription.max_lag
+        if slow and not subscription.slow and subscription.policy == "report":
+            print(f"Egram subscriber {subscription.name} is falling behind "
+                  f"({lag} samples waiting)")
+        subscription.slow = slow
+
+    """ 
+    Before a batch is written: if it puts a "drop_newest" subscriber over 
+    max_lag, copy out its oldest max_lag samples (the ring may overwrite them
+    before it reads) and drop the rest. Later batches are dropped until it 
+    reads.
+    """
+    def drop_newest(self, subscription, m_vraw, m_araw):
+        num_samples = len(m_vraw)
+        if subscription.held is None:
+            lag = self.head + num_samples - subscription.seq
+            if lag <= subscription.max_lag:
+                return
+            fit = subscription.max_lag - (self.head - subscription.seq)
+            new_samples = np.array([m_vraw[:fit], m_araw[:fit]], 
+                                   dtype=np.uint16).reshape(2, -1)
+            samples = np.concatenate((self.view(subscription.seq, self.head),
+                                      new_samples), axis=1)
+            subscription.held = (subscription.seq, samples)
+            dropped = lag - subscription.max_lag
+        else:
+            dropped = num_samples
+        subscription.seq = self.head + num_samples
+        subscription.dropped = subscription.dropped + dropped
+
+    """ 
+    Samples with sequence numbers start to end (still in the ring), as a view
+    (a copy when they wrap around the end of the ring)
+    """
+    def view(self, start, end):
+        end = start % self.capacity + end - start
+        start = start % self.capacity
+        if end <= self.capacity:
+            return self.samples[:, start:end]
+        return np.concatenate((self.samples[:, start:], 
+                               self.samples[:, :end - self.capacity]), axis=1)
+
+    """ 
+    Return (seq, samples) for everything subscription hasn't read, as a view 
+    (a copy when it wraps around the end of the ring), and move its cursor.
+    """
+    def read_view(self, subscription):
+        subscription.slow = False
+        if subscription.held is not None:
+            seq, samples = subscription.held
+            subscription.held = None
+            return seq, samples
+        seq = subscription.seq
+        samples = self.view(seq, self.head)
+        subscription.seq = self.head
+        return seq, samples
+
+""" 
+Dictionary of a batch of samples from seq on ((2, n) array, row 0 is m_vraw)
+in the form asked for (see EgramThread.get_data()).
+"""
+def samples_dict(seq, samples, form):
+    data = {"seq":seq}
+    for channel, channel_samples in zip(egram_channels, samples):
+        if form == "list":
+            channel_samples = channel_samples.tolist()
+        elif form == "array":
+            channel_samples = array("H", channel_samples.tobytes())
+        data[channel] = channel_samples
+    return data
+
 """ 
 Handles serial reads and buffers data so that the egram plot code can 
 easily access it.
+Every decoded batch is written once into a SampleBroadcast ring. Consumers 
+(the plot, a detector) each subscribe() and read it through their own cursor,
+without opening the port again. get_data() is the default subscription: it 
+keeps up to capacity samples for a reader that doesn't keep up, dropping the
+oldest or the newest ones (overflow "drop_oldest" or "drop_newest").
 """
 class EgramThread(threading.Thread):
-    port_in_use = False
+    overflow_policies = {"drop_oldest":"skip", "drop_newest":"drop_newest"}
 
-    def __init__(self, packet_buffer_size):
+    def __init__(self, packet_buffer_size, connection=None, 
+                 capacity=egram_capacity, overflow="drop_oldest"):
+        assert capacity > 0
+        assert overflow in EgramThread.overflow_policies
         threading.Thread.__init__(self)
+        if connection is None:
+            connection = get_connection()
+        self.connection = connection
         self.egram_running = True
         self.packet_buffer_size = packet_buffer_size
         self.data_lock = threading.Lock()
-        self.data = {"m_vraw":[], "m_araw":[]}
+        # twice capacity, so a subscriber can lag capacity samples and still 
+        # have its views intact
+        self.broadcast = SampleBroadcast(2 * capacity)
+        self.default_subscription = self.subscribe(
+                        "get_data", EgramThread.overflow_policies[overflow], 
+                        capacity)
+        self.recorders = () # get every decoded batch (see add_recorder())
+
+    """ 
+    Semaphore protected extraction of the egram plot data.
+    Returns all samples that arrived since the last call as a dictionary with
+    the m_vraw and m_araw samples and "seq", the sequence number of the first
+    sample. form chooses the type of the samples:
+        - "list" Python lists of ints
+        - "array" compact array("H") copies
+        - "numpy" uint16 NumPy views into the ring buffer (no copy). These are
+          only valid until the next call to get_data().
+    """
+    def get_data(self, form="list"):
+        return self.default_subscription.get_data(form)
 
-    """ Semaphore protected extraction of the egram plot data. """
-    def get_data(self):
-        data = None
+    """ 
+    Start a Subscription to every sample from now on, with its own cursor.
+    max_lag defaults to (and for "skip" is at most) half the broadcast's 
+    capacity, the capacity the thread was created with (see SampleBroadcast).
+    """
+    def subscribe(self, name, policy="skip", max_lag=None):
+        limit = self.broadcast.capacity // 2
+        if max_lag is None or (policy == "skip" and max_lag > limit):
+            max_lag = limit
         with self.data_lock:
-            # create new name for self.data
-            data = self.data
-            # make self.data point to a new empty structure
-            self.data = {"m_vraw":[], "m_araw":[]}
-        return data
+            subscription = Subscription(self, name, policy, max_lag)
+            self.broadcast.subscriptions.append(subscription)
+        return subscription
+
+    """ 
+    Pass every decoded batch to recorder.write(m_vraw, m_araw) from the read
+    thread, as soon as it is decoded (see recording.py, edf.py,
+    shared_egram.py and egram_server.py). A recorder whose write() raises is
+    reported and removed; the egram goes on.
+    Recorders are pushed to rather than subscribed: they have no thread of 
+    their own to poll a Subscription, and they must get every sample however
+    long the app is busy, which a cursor into a ring can't promise. 
+    Their write() only hands the batch on (a file, shared memory, a socket 
+    queue), so it doesn't hold up the reader.
+    """
+    def add_recorder(self, recorder):
+        with self.data_lock:
+            self.recorders = self.recorders + (recorder,)
+
+    def remove_recorder(self, recorder):
+        with self.data_lock:
+            self.recorders = tuple(other for other in self.recorders 
+                                   if other is not recorder)
+
+    def unsubscribe(self, subscription):
+        with self.data_lock:
+            if subscription in self.broadcast.subscriptions:
+                self.broadcast.subscriptions.remove(subscription)
+
+    """ Number of samples get_data() lost because its reader fell behind. """
+    def dropped(self):
+        with self.data_lock:
+            return self.default_subscription.dropped
 
     """ Set a flag to stop the egram """
     def quit(self):
@@ -227,61 +1004,99 @@ class EgramThread(threading.Thread):
 
     """ 
     Overrides the Thread method which is called by thread.start() 
-    Read egram_packet_len bytes at a time from the serial port. When you have 
-    self.packet_buffer_size packets, use a Python memoryview to efficiently read
-    the packet buffer. Find the first occurring header, then read out the data
-    section into a field of the class called self.data. This field contains the
-    m_vraw and m_araw data from the Pacemaker for the two egram plot lines.
-    The structure self.data is protected by a thread lock so that other threads
-    can access it with self.get_data().
+    Read up to self.packet_buffer_size frames at a time from the serial port
+    into a ReceiveBuffer (the read returns early if the port times out). Decode
+    the whole batch with decode_egram_frames() and add it to a field of the 
+    class called self.broadcast (a SampleBroadcast). This field contains the 
+    m_vraw and m_araw data from the Pacemaker for the two egram plot lines. 
+    Partial frames are left in the receive buffer for the next read.
+    The structure self.broadcast is protected by a thread lock so that other 
+    threads can read it with self.get_data() and subscriptions. The lock is 
+    taken once per batch.
+    Every decoded batch is also passed to the write(m_vraw, m_araw) method of
+    each recorder, whether or not anyone reads the ring.
+    The receive buffer also has room for a whole k_echo response, which may 
+    be longer than a batch (see read_batch()).
     """
     def run(self):
-        egram_header_len = 2
-        egram_data_len = 4
-        egram_packet_len = egram_header_len + egram_data_len
-        packets = b''
-        num_packets = 0
-        EgramThread.port_in_use = True
-        try:
-            serial_port = serial.Serial(port=port, 
-                                        baudrate=baud, 
-                                        timeout=timeout)
+        batch_len = self.packet_buffer_size * egram_frame_len
+        receive_buffer = ReceiveBuffer(max(batch_len, max_response_len) + 
+                                       egram_frame_len)
 
+        self.connection.reader = self
+        try:
             while(self.egram_running):
-                if num_packets >= self.packet_buffer_size:
-                    buff = memoryview(packets)  # more efficient slicing
-                    state = 0 
-                    while (len(buff)) > egram_packet_len: 
-                        if state == 0:
-                            if buff[0] == k_sync:
-                                state = 1
-                            buff = buff[1:]
-                        elif state == 1:
-                            if buff[0] == k_soh:
-                                state = 2
-                            buff = buff[1:]
-                        elif state == 2:
-                            #print(f"{buff[0]} {buff[1]} {buff[2]} {buff[3]}")
-                            state = 0
-                            m_vraw = (buff[0] << 8) + buff[1]
-                            m_araw = (buff[2] << 8) + buff[3]
-                            with self.data_lock:
-                                self.data["m_vraw"].append(m_vraw)
-                                self.data["m_araw"].append(m_araw)
-                            buff = buff[egram_data_len:]
-                    packets = packets[-len(buff):]
-                    num_packets = 0
-
-                packets = packets + serial_port.read(egram_packet_len)
-                num_packets = num_packets + 1
-
-            serial_port.close()
-
-        except serial.serialutil.SerialException:
-            print("Device Disconnected!") 
-
+                self.read_batch(receive_buffer, batch_len)
         finally:
-            EgramThread.port_in_use = False
+            # requests must not wait for a response from a dead thread
+            self.connection.reader = None
+
+    """ 
+    One pass of the read loop: fill receive_buffer up to batch_len bytes, 
+    decode it and store the samples. Returns the number of bytes read.
+    A partial k_echo response held in the buffer can be longer than a batch, 
+    so while one is awaited the read asks for enough bytes to complete it. If
+    the request gave up, the bytes left behind are decoded (and skipped) 
+    without a read.
+    (Separate from run() so the hot path can be benchmarked without a thread.)
+    """
+    def read_batch(self, receive_buffer, batch_len):
+        size = batch_len - len(receive_buffer)
+        if getattr(self.connection, "response", None) is not None:
+            size = max(size, max_response_len - len(receive_buffer))
+        num_bytes = 0
+        if size > 0:
+            num_bytes = receive_buffer.fill(self.connection, size)
+            if num_bytes == 0:
+                return 0
+
+        # a request may have started while the read was waiting
+        response = getattr(self.connection, "response", None)
+        if response is not None and \
+                not self.take_response(receive_buffer, response):
+            return num_bytes    # wait for the rest of the response
+
+        m_vraw, m_araw, consumed = decode_egram_frames(receive_buffer.pending())
+        receive_buffer.consume(consumed)
+
+        self.store(m_vraw, m_araw)
+        return num_bytes
+
+    """ Add decoded samples to the ring and pass them to the recorders. """
+    def store(self, m_vraw, m_araw):
+        with self.data_lock:
+            self.broadcast.write(m_vraw, m_araw)
+
+        if len(m_vraw) > 0:
+            for recorder in self.recorders:
+                try:
+                    recorder.write(m_vraw, m_araw)
+                except Exception as error:
+                    # a failing recorder (full disk...) mustn't stop the egram
+                    print(f"Egram recorder {recorder} failed and was removed: "
+                          f"{error!r}")
+                    self.remove_recorder(recorder)
+
+    """ 
+    While a request_params() is waiting, look for the k_echo response in the
+    received bytes and hand it over. The egram frames in front of it are 
+    stored as usual. Returns False if a partial response has to stay in the 
+    buffer until the rest arrives.
+    """
+    def take_response(self, receive_buffer, response):
+        pending = receive_buffer.pending()
+        start, end = find_echo_response(pending.tobytes())
+        if start is None:
+            return True
+
+        m_vraw, m_araw, consumed = decode_egram_frames(pending[:start])
+        self.store(m_vraw, m_araw)
+        if end is None:
+            receive_buffer.consume(start)
+            return False
+        response.set(pending[start:end].tobytes())
+        receive_buffer.consume(end)
+        return True
 
 if __name__ == "__main__":
     print_data_section_spec()
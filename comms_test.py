@@ -0,0 +1,829 @@
+import os
+import threading
+import time
+import pty
+import tty
+import pytest       # run pytest in the directory to run all tests in the file
+import comms
+from simulator import PacemakerSimulator, synthetic_egram
+
+""" Open a pseudo-terminal to stand in for the Pacemaker's serial port. """
+@pytest.fixture
+def device():
+    master_fd, slave_fd = pty.openpty()
+    tty.setraw(master_fd)
+    yield master_fd, os.ttyname(slave_fd)
+    os.close(slave_fd)
+    try:
+        os.close(master_fd)
+    except OSError:
+        pass
+
+class TestConnection():
+    def test_write(self, device):
+        master_fd, port_name = device
+        connection = comms.Connection(port_name=port_name)
+        packet = bytes([comms.k_sync, comms.k_soh, comms.k_egram, 0x50])
+
+        assert connection.write(packet)
+        assert os.read(master_fd, 16) == packet
+        connection.close()
+
+    def test_port_stays_open_between_commands(self, device):
+        master_fd, port_name = device
+        connection = comms.Connection(port_name=port_name)
+
+        assert connection.write(b"\x16")
+        serial_port = connection.serial_port
+        assert connection.write(b"\x01")
+        assert connection.serial_port is serial_port
+        connection.close()
+
+    def test_read(self, device):
+        master_fd, port_name = device
+        connection = comms.Connection(port_name=port_name)
+        assert connection.open()
+        os.write(master_fd, b"\x16\x01\x00\x10\x00\x20")
+
+        assert connection.read(6) == b"\x16\x01\x00\x10\x00\x20"
+        connection.close()
+
+    def test_missing_device(self):
+        connection = comms.Connection(port_name="/dev/does_not_exist")
+
+        assert not connection.write(b"\x16")
+        assert not connection.is_connected()
+        assert connection.read(6) == b""
+
+    def test_reconnect(self, device):
+        master_fd, port_name = device
+        connection = comms.Connection(port_name=port_name)
+
+        assert connection.write(b"\x16")
+        connection.disconnected()
+        assert connection.serial_port is None
+        assert connection.write(b"\x01")
+        assert os.read(master_fd, 16) == b"\x16\x01"
+        connection.close()
+
+    def test_closed_while_in_use(self, device, monkeypatch):
+        master_fd, port_name = device
+        connection = comms.Connection(port_name=port_name)
+        get_port = connection.get_port
+        # another thread (an unplug) closes the port right after it is opened
+        def get_port_then_close():
+            serial_port = get_port()
+            connection.close()
+            return serial_port
+        monkeypatch.setattr(connection, "get_port", get_port_then_close)
+
+        assert not connection.write(b"\x16")
+        assert connection.read(6) == b""
+
+    def test_get_connection_is_shared(self):
+        assert comms.get_connection("/dev/a") is comms.get_connection("/dev/a")
+        assert comms.get_connection("/dev/a") is not comms.get_connection("/dev/b")
+
+""" Build an egram frame the way the Pacemaker sends it """
+def egram_frame(m_vraw, m_araw):
+    return bytes([comms.k_sync, comms.k_soh, 
+                  m_vraw >> 8, m_vraw & 0xff, m_araw >> 8, m_araw & 0xff])
+
+""" Scan the bytes in order, one frame at a time (reference decoder) """
+def scan_frames(stream):
+    m_vraw = []
+    m_araw = []
+    i = 0
+    while i + comms.egram_frame_len <= len(stream):
+        if stream[i] == comms.k_sync and stream[i + 1] == comms.k_soh:
+            m_vraw.append((stream[i + 2] << 8) + stream[i + 3])
+            m_araw.append((stream[i + 4] << 8) + stream[i + 5])
+            i = i + comms.egram_frame_len
+        else:
+            i = i + 1
+    return m_vraw, m_araw
+
+class TestEgramDecoder():
+    def test_decode_frames(self):
+        stream = egram_frame(1000, 2000) + egram_frame(0x1601, 4095)
+        m_vraw, m_araw, consumed = comms.decode_egram_frames(
+                                        comms.np.frombuffer(stream, "u1"))
+
+        assert m_vraw.tolist() == [1000, 0x1601]
+        assert m_araw.tolist() == [2000, 4095]
+        assert consumed == len(stream)
+
+    def test_sync_inside_data_section(self):
+        # m_vraw low byte and m_araw high byte look like SYNC SOH
+        stream = egram_frame(0x0016, 0x0102) + egram_frame(5, 6)
+        m_vraw, m_araw, consumed = comms.decode_egram_frames(
+                                        comms.np.frombuffer(stream, "u1"))
+
+        assert m_vraw.tolist() == [0x0016, 5]
+        assert m_araw.tolist() == [0x0102, 6]
+
+    def test_sync_in_every_frame(self):
+        # a flat signal with SYNC SOH inside every data section
+        stream = egram_frame(0x0a16, 0x0150) * 10000
+        start = time.perf_counter()
+        m_vraw, m_araw, consumed = comms.decode_egram_frames(
+                                        comms.np.frombuffer(stream, "u1"))
+        # linear: tens of ms, not the seconds of dropping a start per pass
+        assert time.perf_counter() - start < 0.1
+        assert (m_vraw.tolist(), m_araw.tolist()) == scan_frames(stream)
+        assert consumed == len(stream)
+
+    def test_matches_byte_scan_across_chunks(self):
+        rng = comms.np.random.default_rng(3)
+        stream = b""
+        for i in range(2000):
+            if rng.random() < 0.05:
+                stream += bytes(rng.integers(0, 256, rng.integers(1, 8)).tolist())
+            if rng.random() < 0.05:
+                stream += bytes([comms.k_sync, comms.k_soh]) # false start
+            stream += egram_frame(*rng.integers(0, 1 << 16, 2).tolist())
+
+        decoder = comms.EgramDecoder()
+        m_vraw = []
+        m_araw = []
+        i = 0
+        while i < len(stream):
+            size = int(rng.integers(1, 64))
+            vraw, araw = decoder.decode(stream[i:i + size])
+            m_vraw.extend(vraw.tolist())
+            m_araw.extend(araw.tolist())
+            i = i + size
+
+        assert (m_vraw, m_araw) == scan_frames(stream)
+        assert len(decoder.carry) < comms.egram_frame_len
+
+""" Stands in for Connection and hands out a fixed byte stream in pieces """
+class ScriptedConnection():
+    def __init__(self, stream, chunk_size=7):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.chunk_size, len(self.stream) - self.pos)
+        if size == 0:
+            time.sleep(0.001)
+        buffer[:size] = self.stream[self.pos:self.pos + size]
+        self.pos = self.pos + size
+        return size
+
+    def done(self):
+        return self.pos == len(self.stream)
+
+class TestReceiveBuffer():
+    def test_fill_and_consume(self):
+        connection = ScriptedConnection(bytes(range(20)), chunk_size=8)
+        receive_buffer = comms.ReceiveBuffer(12)
+
+        assert receive_buffer.fill(connection, 12) == 8
+        assert receive_buffer.pending().tolist() == list(range(8))
+        receive_buffer.consume(6)
+        assert len(receive_buffer) == 2
+
+        # not enough room at the end, so the 2 pending bytes move to the front
+        assert receive_buffer.fill(connection, 8) == 8
+        assert receive_buffer.read_pos == 0
+        assert receive_buffer.pending().tolist() == list(range(6, 16))
+
+        receive_buffer.consume(10)
+        assert receive_buffer.write_pos == 0
+
+class TestEgramThread():
+    def test_run(self):
+        frames = [(i, 4000 - i) for i in range(500)]
+        stream = b"\x00\x16" + b"".join(egram_frame(*f) for f in frames)
+        connection = ScriptedConnection(stream, chunk_size=50)
+        thread = comms.EgramThread(16, connection=connection)
+        thread.start()
+        while not connection.done():
+            time.sleep(0.001)
+        thread.quit()
+        thread.join()
+
+        data = thread.get_data()
+        assert data["m_vraw"] == [f[0] for f in frames]
+        assert data["m_araw"] == [f[1] for f in frames]
+
+    def test_response_in_stream(self):
+        frames = [(i, 4000 - i) for i in range(300)]
+        response = echo_response(VOO_DATA)
+        stream = b"".join(egram_frame(*f) for f in frames[:100]) + response + \
+                 b"".join(egram_frame(*f) for f in frames[100:])
+        connection = ScriptedConnection(stream, chunk_size=50)
+        connection.response = comms.PendingResponse()
+        thread = comms.EgramThread(16, connection=connection)
+        thread.start()
+        assert connection.response.wait(5) == response
+        while not connection.done():
+            time.sleep(0.001)
+        thread.quit()
+        thread.join()
+
+        data = thread.get_data()
+        assert data["m_vraw"] == [f[0] for f in frames]
+        assert data["m_araw"] == [f[1] for f in frames]
+
+    def test_long_response_small_batch(self):
+        # a DDDR response is longer than a batch of 4 frames
+        frames = [(i, 4000 - i) for i in range(300)]
+        response = echo_response(longest_params_data()[:-1])
+        assert len(response) == comms.max_response_len
+        stream = b"".join(egram_frame(*f) for f in frames[:50]) + response + \
+                 b"".join(egram_frame(*f) for f in frames[50:])
+        connection = ScriptedConnection(stream, chunk_size=50)
+        connection.response = comms.PendingResponse()
+        thread = comms.EgramThread(4, connection=connection)
+        thread.start()
+        assert connection.response.wait(5) == response
+        while not connection.done():
+            time.sleep(0.001)
+        thread.quit()
+        thread.join()
+
+        data = thread.get_data()
+        assert data["m_vraw"] == [f[0] for f in frames]
+
+    def test_partial_response_given_up(self):
+        # the rest of the response never comes and the request times out
+        frames = [(i, 4000 - i) for i in range(300)]
+        partial = echo_response(longest_params_data()[:-1])[:-3]
+        stream = b"".join(egram_frame(*f) for f in frames[:50]) + partial
+        connection = ScriptedConnection(stream, chunk_size=50)
+        connection.response = comms.PendingResponse()
+        thread = comms.EgramThread(4, connection=connection)
+        receive_buffer = comms.ReceiveBuffer(comms.max_response_len + 
+                                             comms.egram_frame_len)
+        batch_len = 4 * comms.egram_frame_len
+        while not connection.done():
+            thread.read_batch(receive_buffer, batch_len)
+        assert len(receive_buffer) > batch_len # held for the response
+
+        connection.response = None
+        connection.stream = stream + b"".join(egram_frame(*f) 
+                                              for f in frames[50:])
+        while not connection.done() or len(receive_buffer) > 0:
+            thread.read_batch(receive_buffer, batch_len)
+        # the egram goes on (the stale header may decode as one stray frame)
+        m_vraw = thread.get_data()["m_vraw"]
+        assert m_vraw[:50] == [f[0] for f in frames[:50]]
+        assert m_vraw[-250:] == [f[0] for f in frames[50:]]
+
+    def test_failing_recorder(self, capsys):
+        frames = [(i, 4000 - i) for i in range(300)]
+        connection = ScriptedConnection(b"".join(egram_frame(*f) 
+                                                 for f in frames), 
+                                        chunk_size=50)
+        connection.reader = None
+        class FullDisk():
+            def write(self, m_vraw, m_araw):
+                raise OSError(28, "No space left on device")
+        thread = comms.EgramThread(16, connection=connection)
+        thread.add_recorder(FullDisk())
+        thread.start()
+        while not connection.done():
+            time.sleep(0.001)
+        assert connection.reader is thread
+        thread.quit()
+        thread.join()
+
+        assert thread.recorders == ()
+        assert "failed and was removed" in capsys.readouterr().out
+        assert thread.get_data()["m_vraw"] == [f[0] for f in frames]
+
+    def test_reader_cleared_when_thread_dies(self):
+        class BrokenConnection(ScriptedConnection):
+            def readinto(self, buffer):
+                raise RuntimeError("broken")
+        connection = BrokenConnection(b"")
+        thread = comms.EgramThread(16, connection=connection)
+        with pytest.raises(RuntimeError):
+            thread.run()    # in this thread, to see the exception
+        assert connection.reader is None
+
+# mode, LRL, URL, amplitude (on, 3750), width (400)
+VOO_DATA = [7, 60, 120, 1, 0x0e, 0xa6, 0x01, 0x90]
+
+""" Echo response (header and data section) for a data section """
+def echo_response(data):
+    data = bytes(data) + bytes([comms.checksum(data)])
+    return bytes(comms.command_packet(comms.k_echo)) + data
+
+""" Data section (with its checksum) of the mode with the longest one """
+def longest_params_data():
+    codec = max(comms.params_codecs.values(), key=lambda codec: codec.data_len)
+    values = {param_name:comms.p[param_name].get() 
+              for param_name in codec.names}
+    values["mode"] = codec.mode_value
+    return codec.encode(values)
+
+class TestParamsPackets():
+    def test_decode_params(self, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VVI")
+        packet = comms.params_packet()
+        values = comms.decode_params(packet[comms.command_header_len:])
+        assert list(values) == ["mode"] + comms.p_by_mode["VVI"]
+        for param_name, value in values.items():
+            assert value == comms.p[param_name].get()
+
+    def test_layout(self):
+        data = bytes(VOO_DATA) + bytes([comms.checksum(VOO_DATA)])
+        codec = comms.params_codecs[7]
+        assert codec.layout.format == ">BBBBHH"
+        assert codec.data_len == comms.params_data_len(7) == len(data)
+        values = {"mode":7, "lower_rate_limit":60, "upper_rate_limit":120,
+                  "v_pulse_amplitude_unregulated":3750, "v_pulse_width":400}
+        assert comms.decode_params(data) == values
+        assert codec.encode(values) == data
+
+    def test_off_flag(self):
+        codec = comms.params_codecs[comms.p["mode"].get_strings().index("VVI")]
+        values = {param_name:comms.p[param_name].get() 
+                  for param_name in codec.names}
+        values["hysteresis_rate_limit"] = None
+        values["rate_smoothing"] = 25
+        data = codec.encode(values)
+        # hysteresis off: flag 0 and a 0 value, rate smoothing on: 1 and 25
+        assert data[-5:-1] == bytes([0, 0, 1, 25])
+        assert codec.decode(data) == values
+
+    def test_signed(self):
+        assert comms.field_format(comms.p["sensed_av_delay_offset"]) == "b"
+        assert comms.field_format(comms.p["v_sensitivity"]) == "H"
+        codec = comms.params_codecs[comms.p["mode"].get_strings().index("DDD")]
+        values = {param_name:comms.p[param_name].get() 
+                  for param_name in codec.names}
+        values["sensed_av_delay_offset"] = -50
+        assert codec.decode(codec.encode(values)) == values
+
+    def test_decode_bad_data(self):
+        data = bytearray(echo_response(VOO_DATA)[comms.command_header_len:])
+        with pytest.raises(ValueError):
+            comms.decode_params(data[:-1])
+        data[-1] = data[-1] ^ 0xff
+        with pytest.raises(ValueError):
+            comms.decode_params(data)
+
+    def test_find_response_between_frames(self):
+        response = echo_response(VOO_DATA)
+        frame = egram_frame(1, 2)
+        buff = frame + response + frame
+        assert comms.find_echo_response(buff) == (6, 6 + len(response))
+
+    def test_find_partial_response(self):
+        response = echo_response(VOO_DATA)
+        assert comms.find_echo_response(response[:2]) == (0, None)
+        assert comms.find_echo_response(response[:6]) == (0, None)
+        assert comms.find_echo_response(b"\x00" * 8) == (None, None)
+
+    def test_find_bad_checksum(self):
+        response = bytearray(echo_response(VOO_DATA))
+        response[-1] = response[-1] ^ 0xff
+        assert comms.find_echo_response(response) == (None, None)
+
+class TestOverflow():
+    def make_thread(self, capacity, overflow="drop_oldest"):
+        return comms.EgramThread(16, connection=ScriptedConnection(b""),
+                                 capacity=capacity, overflow=overflow)
+
+    def test_write_read(self):
+        thread = self.make_thread(8)
+        thread.store([1, 2, 3], [4, 5, 6])
+
+        assert thread.default_subscription.lag() == 3
+        data = thread.get_data()
+        assert data == {"seq":0, "m_vraw":[1, 2, 3], "m_araw":[4, 5, 6]}
+        assert thread.default_subscription.lag() == 0
+        assert thread.get_data()["m_vraw"] == []
+
+    def test_wrap_around(self):
+        thread = self.make_thread(2)
+        for i in range(0, 12, 2):
+            thread.store([i, i + 1], [i, i + 1])
+            data = thread.get_data()
+            assert data["seq"] == i
+            assert data["m_vraw"] == [i, i + 1]
+        assert thread.dropped() == 0
+
+    def test_drop_oldest(self):
+        thread = self.make_thread(4, "drop_oldest")
+        thread.store([1, 2, 3], [1, 2, 3])
+        thread.store([4, 5, 6], [4, 5, 6])
+
+        data = thread.get_data()
+        assert data["seq"] == 2
+        assert data["m_vraw"] == [3, 4, 5, 6]
+        assert thread.dropped() == 2
+
+        thread.store(list(range(10)), list(range(10)))
+        data = thread.get_data()
+        assert data["seq"] == 12
+        assert data["m_vraw"] == [6, 7, 8, 9]
+        assert thread.dropped() == 8
+
+    def test_drop_newest(self):
+        thread = self.make_thread(4, "drop_newest")
+        thread.store([1, 2, 3], [1, 2, 3])
+        thread.store([4, 5, 6], [4, 5, 6])
+        # the kept samples survive the ring wrapping around onto them
+        thread.store(list(range(7, 30)), list(range(7, 30)))
+
+        assert thread.default_subscription.lag() == 4
+        data = thread.get_data()
+        assert data["seq"] == 0
+        assert data["m_vraw"] == [1, 2, 3, 4]
+        assert thread.dropped() == 25
+
+        # after the read, it takes samples again
+        thread.store([30], [30])
+        assert thread.get_data() == {"seq":29, "m_vraw":[30], "m_araw":[30]}
+
+    def test_bad_policy(self):
+        with pytest.raises(AssertionError):
+            self.make_thread(4, "drop_everything")
+
+    def test_view_is_not_overwritten(self):
+        thread = self.make_thread(6)
+        thread.store([1, 2, 3, 4], [1, 2, 3, 4])
+        view = thread.get_data("numpy")["m_vraw"]
+        assert comms.np.shares_memory(view, thread.broadcast.samples)
+
+        # up to capacity samples can arrive before the next read
+        thread.store([5, 6, 7, 8, 9, 10], [5, 6, 7, 8, 9, 10])
+        assert view.tolist() == [1, 2, 3, 4]
+        data = thread.get_data("numpy")
+        assert data["seq"] == 4
+        assert data["m_vraw"].tolist() == [5, 6, 7, 8, 9, 10]
+
+class TestGetData():
+    def make_thread(self):
+        thread = comms.EgramThread(16, connection=ScriptedConnection(b""))
+        thread.store([1, 2], [3, 4])
+        return thread
+
+    def test_list(self):
+        data = self.make_thread().get_data()
+        assert data == {"seq":0, "m_vraw":[1, 2], "m_araw":[3, 4]}
+
+    def test_array(self):
+        data = self.make_thread().get_data("array")
+        assert data["m_vraw"] == comms.array("H", [1, 2])
+        assert data["m_araw"] == comms.array("H", [3, 4])
+
+    def test_numpy(self):
+        thread = self.make_thread()
+        data = thread.get_data("numpy")
+        assert data["m_vraw"].dtype == comms.np.uint16
+        assert data["m_araw"].tolist() == [3, 4]
+        assert comms.np.shares_memory(data["m_vraw"], thread.broadcast.samples)
+
+        thread.store([5], [6])
+        assert thread.get_data("numpy")["seq"] == 2
+
+class TestSubscriptions():
+    def make_thread(self, capacity=100):
+        return comms.EgramThread(16, connection=ScriptedConnection(b""),
+                                 capacity=capacity)
+
+    """ Write samples the way EgramThread.read_batch() does """
+    def write(self, thread, m_vraw, m_araw):
+        thread.store(comms.np.array(m_vraw), comms.np.array(m_araw))
+
+    def test_every_subscriber_gets_every_sample(self):
+        thread = self.make_thread()
+        plot = thread.subscribe("plot")
+        recorder = thread.subscribe("recorder", policy="report")
+        self.write(thread, [1, 2, 3], [4, 5, 6])
+
+        data = plot.get_data()
+        assert data["seq"] == 0
+        assert data["m_vraw"].tolist() == [1, 2, 3]
+        assert comms.np.shares_memory(data["m_vraw"], thread.broadcast.samples)
+
+        self.write(thread, [7], [8])
+        assert plot.get_data("list") == {"seq":3, "m_vraw":[7], "m_araw":[8]}
+        assert recorder.get_data("list") == {"seq":0, "m_vraw":[1, 2, 3, 7],
+                                             "m_araw":[4, 5, 6, 8]}
+        # get_data() is a separate consumer
+        assert thread.get_data("list")["m_vraw"] == [1, 2, 3, 7]
+
+    def test_starts_at_subscribe(self):
+        thread = self.make_thread()
+        first = thread.subscribe("first")
+        self.write(thread, [1, 2], [1, 2])
+        second = thread.subscribe("second")
+        self.write(thread, [3], [3])
+        assert first.get_data("list")["m_vraw"] == [1, 2, 3]
+        assert second.get_data("list") == {"seq":2, "m_vraw":[3], "m_araw":[3]}
+
+    def test_wrap_around(self):
+        thread = self.make_thread(capacity=10)
+        subscription = thread.subscribe("plot")
+        for i in range(0, 30, 3):
+            self.write(thread, list(range(i, i + 3)), list(range(i, i + 3)))
+            data = subscription.get_data("list")
+            assert data["seq"] == i
+            assert data["m_vraw"] == list(range(i, i + 3))
+
+    def test_skip_slow_subscriber(self):
+        thread = self.make_thread(capacity=100)
+        subscription = thread.subscribe("plot", max_lag=10)
+        self.write(thread, list(range(25)), list(range(25)))
+        assert subscription.lag() == 10
+        assert subscription.dropped == 15
+
+        data = subscription.get_data("list")
+        assert data["seq"] == 15
+        assert data["m_vraw"] == list(range(15, 25))
+        assert not subscription.slow
+
+    def test_report_slow_subscriber(self, capsys):
+        thread = self.make_thread(capacity=100)
+        subscription = thread.subscribe("recorder", policy="report",
+                                        max_lag=10)
+        self.write(thread, list(range(30)), list(range(30)))
+        assert subscription.slow
+        assert subscription.dropped == 0
+        assert "recorder is falling behind" in capsys.readouterr().out
+
+        # only what the ring (twice the capacity) overwrote is lost
+        self.write(thread, list(range(30, 220)), list(range(30, 220)))
+        assert subscription.dropped == 20
+        assert "falling behind" not in capsys.readouterr().out # once
+        data = subscription.get_data("list")
+        assert data["seq"] == 20
+        assert data["m_vraw"] == list(range(20, 220))
+
+    def test_max_lag_keeps_views_intact(self):
+        thread = self.make_thread(capacity=100)
+        assert thread.subscribe("plot", max_lag=1000).max_lag == 100
+        assert thread.subscribe("recorder", policy="report").max_lag == 100
+
+    def test_cancel(self):
+        thread = self.make_thread()
+        subscription = thread.subscribe("plot")
+        subscription.cancel()
+        assert thread.broadcast.subscriptions == [thread.default_subscription]
+        self.write(thread, [1], [1])
+        assert subscription.dropped == 0
+        assert thread.get_data()["m_vraw"] == [1]
+
+    def test_from_thread(self):
+        frames = [(i, 4000 - i) for i in range(500)]
+        stream = b"".join(egram_frame(*f) for f in frames)
+        connection = ScriptedConnection(stream, chunk_size=50)
+        thread = comms.EgramThread(16, connection=connection)
+        subscriptions = [thread.subscribe(name) for name in ("a", "b", "c")]
+        thread.start()
+        while not connection.done():
+            time.sleep(0.01)
+        thread.quit()
+        thread.join()
+        for subscription in subscriptions:
+            data = subscription.get_data("list")
+            assert list(zip(data["m_vraw"], data["m_araw"])) == frames
+
+""" A simulated Pacemaker on a pseudo-terminal, used as comms.port """
+@pytest.fixture
+def simulator(monkeypatch, tmp_path):
+    sim = PacemakerSimulator(link=str(tmp_path / "pacemaker"), seed=1)
+    monkeypatch.setattr(comms, "port", sim.port_name)
+    sim.start()
+    yield sim
+    comms.get_connection().close()
+    sim.quit()
+
+""" Collect egram samples from thread until n have arrived (or timeout) """
+def collect(thread, n, timeout=5):
+    m_vraw = []
+    m_araw = []
+    deadline = time.monotonic() + timeout
+    while len(m_vraw) < n and time.monotonic() < deadline:
+        data = thread.get_data()
+        m_vraw.extend(data["m_vraw"])
+        m_araw.extend(data["m_araw"])
+        time.sleep(0.01)
+    return m_vraw, m_araw
+
+class TestWithSimulator():
+    def test_egram_stream(self, simulator):
+        thread = comms.EgramThread(16)
+        thread.start()
+        assert comms.request_egram()
+        m_vraw, m_araw = collect(thread, 500)
+        assert comms.stop_egram()
+        thread.quit()
+        thread.join()
+
+        expected = synthetic_egram(range(len(m_vraw)), simulator.rate)
+        assert len(m_vraw) >= 500
+        assert m_vraw == expected[0].tolist()
+        assert m_araw == expected[1].tolist()
+        assert simulator.commands == [comms.k_egram, comms.k_estop]
+
+    def test_send_params(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VVI")
+        assert comms.update_pacemaker_params()
+        deadline = time.monotonic() + 5
+        while simulator.params is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert simulator.params[0] == comms.p["mode"].get()
+        assert len(simulator.params) == comms.params_data_len(8)
+
+    def test_garbage(self, simulator):
+        simulator.garbage = 0.01
+        thread = comms.EgramThread(16)
+        thread.start()
+        comms.request_egram()
+        m_vraw, m_araw = collect(thread, 2000)
+        thread.quit()
+        thread.join()
+
+        # junk costs at most the frame after it (plus a bogus sample if the
+        # junk happens to contain SYNC SOH)
+        expected = set(synthetic_egram(range(3000), simulator.rate)[0].tolist())
+        good = sum(v in expected for v in m_vraw)
+        assert good > 0.95 * len(m_vraw)
+
+    def test_reconnect(self, simulator):
+        assert comms.pacemaker_connected()
+        simulator.unplug()
+        assert not comms.pacemaker_connected()
+        assert not comms.get_connection().write(b"\x16")
+
+        simulator.plug()
+        time.sleep(comms.reconnect_period)
+        assert comms.pacemaker_connected()
+        assert comms.request_egram()
+        deadline = time.monotonic() + 5
+        while not simulator.streaming and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert simulator.streaming
+
+    def test_request_params(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VVI")
+        values, round_trip = comms.request_params(timeout=0.2)
+        assert values is None   # nothing programmed, so no response
+        assert comms.update_pacemaker_params()
+
+        values, round_trip = comms.request_params()
+        assert values == comms.decode_params(simulator.params)
+        assert values["mode"] == comms.p["mode"].get()
+        assert 0 < round_trip < comms.response_timeout
+
+    def test_request_params_while_streaming(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "AAI")
+        assert comms.update_pacemaker_params()
+        thread = comms.EgramThread(16)
+        thread.start()
+        assert comms.request_egram()
+        before = collect(thread, 200)
+
+        values, round_trip = comms.request_params()
+        after = collect(thread, 200)
+        thread.quit()
+        thread.join()
+
+        assert values == comms.decode_params(simulator.params)
+        assert round_trip < comms.response_timeout
+        # the response was taken out of the stream without losing samples
+        m_vraw = before[0] + after[0]
+        expected = synthetic_egram(range(len(m_vraw)), simulator.rate)
+        assert m_vraw == expected[0].tolist()
+
+    def test_program_and_verify(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        verified, mismatches, attempts = comms.program_and_verify()
+        assert verified
+        assert mismatches == {}
+        assert attempts == 1
+        assert simulator.commands == [comms.k_pparams, comms.k_echo]
+
+    def test_verify_retries_on_mismatch(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        request_params = comms.request_params
+        read_backs = []
+        # the first read back shows a value the device didn't take
+        def flaky_request_params(timeout):
+            values, round_trip = request_params(timeout)
+            if not read_backs:
+                values = dict(values, lower_rate_limit=50)
+            read_backs.append(values)
+            return values, round_trip
+        monkeypatch.setattr(comms, "request_params", flaky_request_params)
+
+        verified, mismatches, attempts = comms.program_and_verify()
+        assert verified
+        assert attempts == 2
+        assert simulator.commands == [comms.k_pparams, comms.k_echo] * 2
+
+    def test_verify_budget(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        # the device never answers
+        monkeypatch.setattr(comms, "request_params",
+                            lambda timeout: (time.sleep(timeout), None))
+        start = time.monotonic()
+        verified, mismatches, attempts = comms.program_and_verify(
+                                            max_attempts=10, time_budget=0.6)
+        assert not verified
+        assert time.monotonic() - start < 1
+        assert 1 < attempts < 10
+        assert mismatches["mode"] == (comms.p["mode"].get(), None)
+
+        verified, mismatches, attempts = comms.program_and_verify(
+                                            max_attempts=2, time_budget=10)
+        assert attempts == 2
+
+    def test_verify_waits_for_reconnect(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        assert comms.pacemaker_connected()
+        simulator.unplug()
+        assert not comms.pacemaker_connected()
+        # plugged back in while program_and_verify() is retrying
+        replug = threading.Timer(0.2, simulator.plug)
+        replug.start()
+        verified, mismatches, attempts = comms.program_and_verify()
+        replug.join()
+        assert verified
+        assert attempts > 1
+
+    def test_upload_skips_unchanged(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        monkeypatch.setattr(comms.p["lower_rate_limit"], "value", 60)
+        result, changed = comms.upload_params()
+        assert result == "programmed"
+        assert changed["lower_rate_limit"] == (comms.not_confirmed, 60)
+        assert len(changed) == len(comms.p_by_mode["VOO"]) + 1
+
+        # pressing Send again sends nothing
+        assert comms.upload_params() == ("unchanged", {})
+        assert simulator.commands == [comms.k_pparams, comms.k_echo]
+
+        comms.p["lower_rate_limit"].set(70)
+        result, changed = comms.upload_params()
+        assert result == "programmed"
+        assert changed == {"lower_rate_limit":(60, 70)}
+        assert simulator.commands == [comms.k_pparams, comms.k_echo] * 2
+
+    def test_upload_after_reconnect(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        assert comms.upload_params()[0] == "programmed"
+        # a device that was unplugged may come back with other parameters
+        simulator.unplug()
+        assert not comms.pacemaker_connected()
+        simulator.plug()
+        time.sleep(comms.reconnect_period)
+        assert comms.upload_params()[0] == "programmed"
+
+    def test_upload_new_mode(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        assert comms.upload_params()[0] == "programmed"
+        comms.p["mode"].set("AOO")
+        result, changed = comms.upload_params()
+        assert result == "programmed"
+        # AOO's atrial parameters weren't confirmed, they aren't "Off"
+        assert changed["a_pulse_width"] == (comms.not_confirmed, 
+                                            comms.p["a_pulse_width"].get())
+        assert "lower_rate_limit" not in changed
+
+    def test_upload_after_update(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        monkeypatch.setattr(comms.p["lower_rate_limit"], "value", 60)
+        assert comms.upload_params()[0] == "programmed"
+        # programmed without upload_params(), then set back in the GUI
+        comms.p["lower_rate_limit"].set(70)
+        assert comms.update_pacemaker_params()
+        comms.p["lower_rate_limit"].set(60)
+        result, changed = comms.upload_params()
+        assert result == "programmed"
+        assert changed["lower_rate_limit"] == (comms.not_confirmed, 60)
+        assert comms.decode_params(simulator.params)["lower_rate_limit"] == 60
+
+    def test_upload_after_failed_verify(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        monkeypatch.setattr(comms.p["lower_rate_limit"], "value", 60)
+        assert comms.upload_params()[0] == "programmed"
+
+        # the device took 70 but the read back got lost
+        request_params = comms.request_params
+        monkeypatch.setattr(comms, "request_params",
+                            lambda timeout: (None, None))
+        comms.p["lower_rate_limit"].set(70)
+        assert not comms.program_and_verify(max_attempts=1)[0]
+        assert comms.get_connection().acknowledged is None
+
+        monkeypatch.setattr(comms, "request_params", request_params)
+        comms.p["lower_rate_limit"].set(60)
+        assert comms.upload_params()[0] == "programmed"
+
+    def test_upload_failed_is_not_remembered(self, simulator, monkeypatch):
+        monkeypatch.setattr(comms.p["mode"], "value", "VOO")
+        monkeypatch.setattr(comms, "request_params",
+                            lambda timeout: (None, None))
+        assert comms.upload_params(time_budget=0.2)[0] == "failed"
+        assert comms.get_connection().acknowledged is None
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+python3 edf.py FILE... [--workers N] [--record-duration 1]
+    Convert recordings (see recording.py) to EDF+, FILE.edf for each FILE.
+
+import comms, edf
+reader = comms.EgramThread(16)
+writer = edf.EdfWriter("session.edf")
+reader.add_recorder(writer)
+...
+writer.close()
+
+MODULE PURPOSE
+--------------
+Export of egrams in European Data Format (EDF+, https://www.edfplus.info) for
+analysis tools. m_vraw and m_araw are written as two signals, plus the
+"EDF Annotations" signal that EDF+ needs to time each data record.
+
+EdfWriter streams samples as they arrive (it can be a recorder of an
+EgramThread). convert() turns stored recordings into EDF+ files on a process
+pool.
+
+The samples are stored exactly: digital value = sample - 32768, with the
+physical range 0 to 65535, so every uint16 sample maps to one int16 value and
+back. The recording is written as continuous (EDF+C). The last data record is
+padded with its last sample.
+
+MODULE SECRETS
+--------------
+    - Every data record is the same size, so a record is a NumPy structured
+      array element (see record_dtype()) and many records are encoded at once.
+    - EdfWriter holds at most one data record of samples, so memory use
+      doesn't depend on the length of the session. The number of records
+      isn't known until the end, so it is written as -1 (allowed while
+      recording) and patched when the file is closed.
+    - convert() knows the size of the file up front, so it splits every
+      recording into segments of records and the workers write their segments
+      straight into their place in the same file.
+"""
+
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import recording
+
+months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT",
+          "NOV", "DEC"]
+annotation_samples = 16 # 2 byte "samples" per record for the annotation text
+num_records_offset = 236 # position of the number of data records field
+segment_records = 600   # data records per convert() task
+
+""" text left aligned in a field of size characters """
+def field(text, size):
+    text = str(text)
+    assert len(text) <= size, f"{text} doesn't fit in {size} characters"
+    return text.ljust(size)
+
+""" Samples per signal in one data record """
+def samples_per_record(sample_rate, record_duration):
+    num_samples = sample_rate * record_duration
+    assert num_samples == int(num_samples), "records must hold whole samples"
+    return int(num_samples)
+
+""" NumPy dtype of one data record """
+def record_dtype(num_samples):
+    return np.dtype([("m_vraw", "<i2", (num_samples,)),
+                     ("m_araw", "<i2", (num_samples,)),
+                     ("annotations", f"S{2 * annotation_samples}")])
+
+"""
+The EDF+ header for num_records data records (-1 if not known yet) of
+record_duration seconds, starting at the wall clock time start_time.
+"""
+def edf_header(start_time, sample_rate, record_duration, num_records=-1,
+               physical_dimension="mV"):
+    start = time.localtime(start_time)
+    start_date = f"{start.tm_mday:02d}-{months[start.tm_mon - 1]}-" \
+                 f"{start.tm_year}"
+    num_samples = samples_per_record(sample_rate, record_duration)
+    signals = [
+        # label, dimension, physical min/max, digital min/max, samples
+        ("m_vraw", physical_dimension, 0, 65535, -32768, 32767, num_samples),
+        ("m_araw", physical_dimension, 0, 65535, -32768, 32767, num_samples),
+        ("EDF Annotations", "", -1, 1, -32768, 32767, annotation_samples),
+    ]
+    header_len = 256 * (len(signals) + 1)
+
+    header = field("0", 8)
+    header += field("X X X X", 80)  # patient (EDF+: code sex birthdate name)
+    header += field(f"Startdate {start_date} X X Pacemaker", 80)
+    header += time.strftime("%d.%m.%y%H.%M.%S", start)
+    header += field(header_len, 8)
+    header += field("EDF+C", 44)
+    header += field(num_records, 8)
+    header += field(f"{record_duration:g}", 8)
+    header += field(len(signals), 4)
+    for column, size in [(0, 16), (None, 80), (1, 8), (2, 8), (3, 8), (4, 8),
+                         (5, 8), (None, 80), (6, 8), (None, 32)]:
+        for signal in signals:
+            header += field("" if column is None else signal[column], size)
+    return header.encode("ascii")
+
+"""
+Encode samples (row 0 is m_vraw, row 1 is m_araw) as data records, the first
+one being record number first_record. The samples are padded to whole
+records with the last sample. Returns a record_dtype() array.
+"""
+def encode_records(samples, first_record, num_samples, record_duration):
+    samples = np.asarray(samples)
+    num_records = -(-samples.shape[1] // num_samples)
+    padding = num_records * num_samples - samples.shape[1]
+    if padding > 0:
+        samples = np.pad(samples, ((0, 0), (0, padding)), mode="edge")
+
+    records = np.empty(num_records, dtype=record_dtype(num_samples))
+    digital = (samples.astype(np.int32) - 32768).astype(np.int16)
+    records["m_vraw"] = digital[0].reshape(num_records, num_samples)
+    records["m_araw"] = digital[1].reshape(num_records, num_samples)
+    # time-keeping annotation: "+onset" 20 20 0, then zeros
+    records["annotations"] = [
+        f"+{(first_record + i) * record_duration:.12g}\x14\x14\x00".encode()
+        for i in range(num_records)]
+    return records
+
+"""
+Streams egram samples to a new EDF+ file at path. Add it to an EgramThread 
+with add_recorder(), or call write() with batches of samples. Thread safe.
+"""
+class EdfWriter():
+    def __init__(self, path, sample_rate=recording.default_sample_rate,
+                 record_duration=1, start_time=None):
+        if start_time is None:
+            start_time = time.time()
+        self.path = path
+        self.record_duration = record_duration
+        self.num_samples = samples_per_record(sample_rate, record_duration)
+        self.lock = threading.Lock()
+        self.buffer = np.empty((2, self.num_samples), dtype=np.uint16)
+        self.fill = 0           # samples in self.buffer
+        self.num_records = 0    # records written
+        self.file = open(path, "wb")
+        self.file.write(edf_header(start_time, sample_rate, record_duration))
+
+    """ Add a batch of samples (one array-like per channel, same length). """
+    def write(self, m_vraw, m_araw):
+        with self.lock:
+            if self.file is None:
+                return
+            samples = np.vstack((m_vraw, m_araw))
+            if self.fill > 0:
+                # complete the buffered record first
+                size = min(samples.shape[1], self.num_samples - self.fill)
+                self.buffer[:, self.fill:self.fill + size] = samples[:, :size]
+                self.fill = self.fill + size
+                samples = samples[:, size:]
+                if self.fill < self.num_samples:
+                    return
+                self.write_records(self.buffer)
+                self.fill = 0
+
+            # whole records straight from the batch, keep the rest
+            complete = samples.shape[1] // self.num_samples * self.num_samples
+            if complete > 0:
+                self.write_records(samples[:, :complete])
+            rest = samples.shape[1] - complete
+            self.buffer[:, :rest] = samples[:, complete:]
+            self.fill = rest
+
+    def write_records(self, samples):
+        records = encode_records(samples, self.num_records, self.num_samples,
+                                 self.record_duration)
+        self.file.write(records.tobytes())
+        self.num_records = self.num_records + len(records)
+
+    """ Write the last (padded) record, the number of records and close. """
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            if self.fill > 0:
+                self.write_records(self.buffer[:, :self.fill])
+                self.fill = 0
+            self.file.seek(num_records_offset)
+            self.file.write(field(self.num_records, 8).encode("ascii"))
+            self.file.close()
+            self.file = None
+
+"""
+Write data records first to last of the recording at path into their place
+in the EDF+ file at edf_path (header_len bytes of header). Runs in a worker
+process.
+"""
+def write_segment(path, edf_path, first, last, record_duration, header_len):
+    session = recording.EgramRecording(path)
+    num_samples = samples_per_record(session.sample_rate, record_duration)
+    m_vraw, m_araw = session.read(first * num_samples, last * num_samples)
+    records = encode_records(np.vstack((m_vraw, m_araw)), first, num_samples,
+                             record_duration)
+    with open(edf_path, "r+b") as f:
+        f.seek(header_len + first * records.dtype.itemsize)
+        f.write(records.tobytes())
+    session.close()
+    return last - first
+
+"""
+Convert recordings to EDF+ on a pool of max_workers processes
+(os.cpu_count() if None). jobs is a list of (recording path, EDF path).
+Returns the number of data records written.
+"""
+def convert(jobs, record_duration=1, max_workers=None):
+    tasks = []
+    for path, edf_path in jobs:
+        session = recording.EgramRecording(path)
+        num_samples = samples_per_record(session.sample_rate, record_duration)
+        num_records = -(-len(session) // num_samples)
+        header = edf_header(session.start_time, session.sample_rate,
+                            record_duration, num_records)
+        session.close()
+
+        # the whole file is sized up front so segments can be written anywhere
+        with open(edf_path, "wb") as f:
+            f.write(header)
+            f.truncate(len(header) + num_records *
+                       record_dtype(num_samples).itemsize)
+        for first in range(0, num_records, segment_records):
+            last = min(first + segment_records, num_records)
+            tasks.append((path, edf_path, first, last, record_duration,
+                          len(header)))
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers, mp_context=context) as pool:
+        return sum(pool.map(write_segment, *zip(*tasks))) if tasks else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert recordings to EDF+")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--record-duration", type=float, default=1,
+                        help="seconds per data record")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    jobs = [(path, os.path.splitext(path)[0] + ".edf") for path in args.files]
+    num_records = convert(jobs, args.record_duration, args.workers)
+    print(f"{num_records} data records in {len(jobs)} files "
+          f"({time.perf_counter() - start:.1f} s)")
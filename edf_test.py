@@ -0,0 +1,118 @@
+import time
+import numpy as np
+import pytest       # run pytest in the directory to run all tests in the file
+import edf
+import recording
+import simulator
+
+""" Minimal EDF reader: (header fields, signal fields, samples by label) """
+def read_edf(path):
+    data = open(path, "rb").read()
+    header = {
+        "version":data[0:8], "patient":data[8:88], "recording":data[88:168],
+        "start":data[168:184], "header_len":int(data[184:192]),
+        "reserved":data[192:236], "num_records":int(data[236:244]),
+        "duration":float(data[244:252]), "num_signals":int(data[252:256]),
+    }
+    ns = header["num_signals"]
+    pos = 256
+    signals = {}
+    for name, size in [("label", 16), ("transducer", 80), ("dimension", 8),
+                       ("physical_min", 8), ("physical_max", 8),
+                       ("digital_min", 8), ("digital_max", 8),
+                       ("prefiltering", 80), ("samples", 8), ("reserved", 32)]:
+        signals[name] = [data[pos + i * size:pos + (i + 1) * size].decode()
+                         .strip() for i in range(ns)]
+        pos = pos + ns * size
+    assert pos == header["header_len"]
+
+    counts = [int(n) for n in signals["samples"]]
+    record_len = 2 * sum(counts)
+    assert len(data) == pos + header["num_records"] * record_len
+    records = np.frombuffer(data[pos:], dtype="<i2").reshape(
+                                            header["num_records"], -1)
+    samples = {}
+    offset = 0
+    for label, count in zip(signals["label"], counts):
+        samples[label] = records[:, offset:offset + count]
+        offset = offset + count
+    return header, signals, samples
+
+def session_samples(num_samples):
+    return simulator.synthetic_egram(np.arange(num_samples), 1000, noise=100,
+                                     rng=np.random.default_rng(0))
+
+class TestEdfWriter():
+    def test_stream(self, tmp_path):
+        m_vraw, m_araw = session_samples(2500)
+        m_vraw[7] = 0
+        m_araw[8] = 65535
+        writer = edf.EdfWriter(tmp_path / "test.edf", start_time=0)
+        rng = np.random.default_rng(1)
+        start = 0
+        while start < len(m_vraw):
+            stop = start + rng.integers(1, 1500)
+            writer.write(m_vraw[start:stop], m_araw[start:stop])
+            start = stop
+        writer.close()
+
+        header, signals, samples = read_edf(tmp_path / "test.edf")
+        assert header["version"] == b"0       "
+        assert header["reserved"].startswith(b"EDF+C")
+        assert header["num_records"] == 3
+        assert header["duration"] == 1
+        assert signals["label"] == ["m_vraw", "m_araw", "EDF Annotations"]
+        assert signals["samples"] == ["1000", "1000", "16"]
+
+        decoded = samples["m_vraw"].ravel().astype(np.int32) + 32768
+        assert decoded[:2500].tolist() == m_vraw.tolist()
+        assert (decoded[2500:] == m_vraw[-1]).all()  # padding
+        decoded = samples["m_araw"].ravel().astype(np.int32) + 32768
+        assert decoded[:2500].tolist() == m_araw.tolist()
+
+        annotations = samples["EDF Annotations"].tobytes()
+        assert annotations[:6] == b"+0\x14\x14\x00\x00"
+        assert annotations[64:69] == b"+2\x14\x14\x00"
+
+    def test_header_fields_fit(self):
+        header = edf.edf_header(time.time(), 1000, 0.5)
+        assert len(header) == 256 * 4
+        assert header[168:184].count(b".") == 4
+
+class TestConvert():
+    def test_parallel_segments(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(edf, "segment_records", 3)
+        jobs = []
+        expected = []
+        for i, num_samples in enumerate([10500, 999, 4000]):
+            path = tmp_path / f"test{i}.egram"
+            m_vraw, m_araw = session_samples(num_samples)
+            recorder = recording.EgramRecorder(path, chunk_len=512)
+            recorder.write(m_vraw, m_araw)
+            recorder.close()
+            jobs.append((path, tmp_path / f"test{i}.edf"))
+            expected.append((m_vraw, m_araw))
+
+        assert edf.convert(jobs, max_workers=2) == 11 + 1 + 4
+
+        for (path, edf_path), (m_vraw, m_araw) in zip(jobs, expected):
+            header, signals, samples = read_edf(edf_path)
+            assert header["num_records"] == -(-len(m_vraw) // 1000)
+            decoded = samples["m_araw"].ravel().astype(np.int32) + 32768
+            assert decoded[:len(m_araw)].tolist() == m_araw.tolist()
+            for i, annotation in enumerate(samples["EDF Annotations"]):
+                assert annotation.tobytes().startswith(f"+{i}\x14\x14".encode())
+
+    def test_matches_stream(self, tmp_path):
+        m_vraw, m_araw = session_samples(3210)
+        path = tmp_path / "test.egram"
+        recorder = recording.EgramRecorder(path, start_time=1e9)
+        recorder.write(m_vraw, m_araw)
+        recorder.close()
+        edf.convert([(path, tmp_path / "converted.edf")], max_workers=1)
+
+        writer = edf.EdfWriter(tmp_path / "streamed.edf", start_time=1e9)
+        writer.write(m_vraw, m_araw)
+        writer.close()
+        assert (tmp_path / "converted.edf").read_bytes() == \
+               (tmp_path / "streamed.edf").read_bytes()
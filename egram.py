@@ -4,11 +4,15 @@ Displaying VENT_SIGNAL (m_vraw) and ATR_SIGNAL (m_araw)
 
 Use PACEMAKER Section 4.7 for a guideline.
     - we are supporting printing egrams indirectly by writing the data points to
-      a file
+      a file (EgramPlot.start_recording(), see recording.py) and printing the
+      file (printout.py)
     - checkboxes to show atrial/ventricular/both egrams
     - serial module should update the data points
     - auto scroll?
     - 0.5x 1x 2x gain applied to both channels
+    - scrolling or monitor-style sweep display
+    - viewer for recorded sessions with pan and zoom (EgramViewer), which
+      can print them (printout.py)
 
 Idea:
     - click button on main GUI to start egram
@@ -33,28 +37,211 @@ https://stackoverflow.com/questions/457246/what-is-the-best-real-time-plotting-w
 """
 
 import time
+import numpy as np
 import matplotlib
 matplotlib.use("TkAgg")
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
 from matplotlib.figure import Figure
-import matplotlib.animation as animation
+from matplotlib.transforms import Bbox
 from matplotlib import style
 
 import tkinter as tk
 
+import sys
 import comms
-
-""" Egram plot widget """
+import edf
+import printout
+import recording
+
+""" 
+Circular buffer holding the last length samples of one plot line.
+Each sample is written twice, at i and i + length, so the samples in time 
+order are always the contiguous slice buffer[pos:pos + length]. Adding n 
+samples costs O(n) no matter how long the window is, and the line data can be
+set from a view instead of a new list.
+"""
+class EgramTrace():
+    def __init__(self, length):
+        self.length = length
+        self.buffer = np.zeros(2 * length)
+        self.pos = 0    # index of the oldest sample
+        self.xs = np.arange(length)
+
+    """ Add new samples, dropping the oldest ones. """
+    def extend(self, samples):
+        samples = samples[-self.length:]
+        num_samples = len(samples)
+        first = min(num_samples, self.length - self.pos)
+        rest = num_samples - first
+        for offset in (0, self.length):
+            start = self.pos + offset
+            self.buffer[start:start + first] = samples[:first]
+            self.buffer[offset:offset + rest] = samples[first:]
+        self.pos = (self.pos + num_samples) % self.length
+
+    """ View of the window, oldest sample first. """
+    def view(self):
+        return self.buffer[self.pos:self.pos + self.length]
+
+""" 
+Monitor-style sweep buffer for one plot line.
+New samples overwrite the window in place at a moving cursor (wrapping back to
+the start), followed by a short blank gap (NaN) so the newest sample is easy 
+to see. extend() returns the index ranges that changed, so only those columns
+of the plot need to be redrawn.
+"""
+class SweepTrace():
+    def __init__(self, length, gap=None):
+        if gap is None:
+            gap = max(1, length // 50)
+        assert 0 < gap < length
+        self.length = length
+        self.gap = gap
+        self.buffer = np.full(length, np.nan)
+        self.cursor = 0     # index where the next sample is written
+        self.xs = np.arange(length)
+
+    """ Write values starting at index start, wrapping around the end. """
+    def put(self, start, values):
+        first = min(len(values), self.length - start)
+        self.buffer[start:start + first] = values[:first]
+        self.buffer[:len(values) - first] = values[first:]
+
+    """ 
+    Write new samples at the cursor and blank the gap after them. Returns a 
+    list of (start, stop) index ranges that changed.
+    """
+    def extend(self, samples):
+        samples = samples[-(self.length - self.gap):]
+        num_samples = len(samples)
+        if num_samples == 0:
+            return []
+
+        start = self.cursor
+        self.put(start, samples)
+        self.cursor = (start + num_samples) % self.length
+        self.put(self.cursor, np.full(self.gap, np.nan))
+
+        stop = start + num_samples + self.gap
+        if stop <= self.length:
+            return [(start, stop)]
+        return [(start, self.length), (0, stop - self.length)]
+
+    """ The whole window (no copy). """
+    def view(self):
+        return self.buffer
+
+""" 
+Min/max decimation of a scrolling plot line for display.
+The window of length samples is split into columns (one per pixel column of 
+the plot) of bin_len samples each. Only the min and max of each column are 
+kept, in the order they arrived, and view() returns them interleaved. A line 
+through them covers the same pixels as a line through every sample (QRS 
+spikes are kept) while the number of vertices depends on the plot width 
+instead of the window length.
+Columns are computed from new samples only. The samples of the newest, 
+incomplete column are held back until it is complete.
+"""
+class MinMaxDecimator():
+    def __init__(self, length, columns):
+        self.requested_columns = columns
+        self.bin_len = -(-length // columns)            # round up
+        self.columns = -(-length // self.bin_len)
+        self.firsts = EgramTrace(self.columns)  # extreme that came first
+        self.lasts = EgramTrace(self.columns)
+        self.partial = np.empty(0)  # samples of the incomplete column
+        self.y = np.zeros(2 * self.columns)
+        column_starts = np.arange(self.columns) * self.bin_len
+        self.xs = np.repeat(column_starts + (self.bin_len - 1) / 2, 2)
+
+    """ Add new samples. """
+    def extend(self, samples):
+        if len(self.partial) > 0:
+            samples = np.concatenate((self.partial, samples))
+        num_columns = len(samples) // self.bin_len
+        complete = samples[:num_columns * self.bin_len]
+        complete = complete.reshape(num_columns, self.bin_len)
+
+        rows = np.arange(num_columns)
+        min_index = complete.argmin(axis=1)
+        max_index = complete.argmax(axis=1)
+        mins = complete[rows, min_index]
+        maxs = complete[rows, max_index]
+        min_first = min_index <= max_index
+        self.firsts.extend(np.where(min_first, mins, maxs))
+        self.lasts.extend(np.where(min_first, maxs, mins))
+
+        # copy, samples may be a view that the reader will reuse
+        self.partial = np.array(samples[num_columns * self.bin_len:], 
+                                dtype=float)
+
+    """ Column extremes interleaved, oldest column first. """
+    def view(self):
+        self.y[0::2] = self.firsts.view()
+        self.y[1::2] = self.lasts.view()
+        return self.y
+
+""" 
+Adaptive refresh rate for the egram plot.
+Keeps a smoothed average of how long a frame takes to draw and spaces frames
+so that drawing uses at most load (a fraction) of the Tk main loop's time. 
+On a slow machine the refresh rate drops instead of starving the rest of the
+GUI, and it climbs back to the fastest rate (min_period) when frames get 
+cheap again. Periods are in milliseconds.
+"""
+class FrameScheduler():
+    def __init__(self, min_period=10, max_period=200, load=0.5):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.load = load
+        self.frame_time = None  # smoothed frame time (ms)
+        self.period = min_period
+
+    """ Record the time taken to draw a frame (in seconds). """
+    def frame_drawn(self, seconds):
+        frame_time = 1000 * seconds
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time = 0.8 * self.frame_time + 0.2 * frame_time
+
+        period = self.frame_time / self.load
+        self.period = min(self.max_period, max(self.min_period, period))
+
+    """ Time to wait before the next frame (whole milliseconds for Tk). """
+    def next_period(self):
+        return int(round(self.period))
+
+""" 
+Egram plot widget 
+The lines are drawn with manual blitting: the plot without its lines is saved
+after every full draw, and each frame only restores and redraws the columns
+that changed. In "scroll" mode the whole trace shifts every frame, so that is
+the whole plot. In "sweep" mode only the samples at the cursor change.
+In scroll mode, windows with more samples than the plot has pixel columns are
+drawn through a MinMaxDecimator per line.
+The refresh rate is set by a FrameScheduler and is independent of how many 
+frames the serial read thread batches per read (read_batch). Frames with no 
+new samples are skipped.
+"""
 class EgramPlot(tk.Frame):
-    def __init__(self, master):
+    def __init__(self, master, x_len=1000, mode="scroll", read_batch=16,
+                 min_period=10):
         super().__init__(master)
         self.master = master
+        self.x_len = x_len # samples in the window (1 ms each)
+        self.mode = mode   # "scroll" or "sweep"
+        self.read_batch = read_batch # egram frames per serial read
+        self.paused = False
+        self.recorder = None # see start_recording()
 
         self.create_matplotlib_figure()
 
         self.create_plot()
 
-        self.animation_period = 10 # milliseconds
+        # fastest refresh period in milliseconds
+        self.scheduler = FrameScheduler(min_period=min_period)
 
         self.initialize_egram()
 
@@ -78,43 +265,142 @@ class EgramPlot(tk.Frame):
         self.subplot = self.figure.add_subplot(1,1,1)
         self.subplot.set_facecolor(self["bg"])
 
-        self.x_len = 1000
         self.y_range = [0,5000]
-        self.xs = list(range(0, self.x_len))
-        self.y_vraw = [0] * self.x_len
-        self.y_araw = [0] * self.x_len
+        self.xs = np.arange(self.x_len)
+        if self.mode == "sweep":
+            self.y_vraw = SweepTrace(self.x_len)
+            self.y_araw = SweepTrace(self.x_len)
+        else:
+            self.y_vraw = EgramTrace(self.x_len)
+            self.y_araw = EgramTrace(self.x_len)
         self.subplot.set_ylim(self.y_range)
+        self.subplot.set_xlim([0, self.x_len - 1])
 
-        self.line1, = self.subplot.plot(self.xs,self.y_vraw)
-        self.line2, = self.subplot.plot(self.xs,self.y_araw)
+        # animated lines are left out of full draws (we draw them ourselves)
+        self.line1, = self.subplot.plot(self.xs,self.y_vraw.view(),
+                                        animated=True)
+        self.line2, = self.subplot.plot(self.xs,self.y_araw.view(),
+                                        animated=True)
+        self.traces = [(self.line1, self.y_vraw), (self.line2, self.y_araw)]
+        self.decimators = []
 
         self.subplot.set_title("Electrogram")
         self.subplot.set_xlabel("ms")
         self.subplot.set_ylabel("mV")
 
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self.save_background)
+
     """
     Create and launch the serial read thread, send the egram request to the
     Pacemaker, and start the plot animation.
     """
     def initialize_egram(self):
         success = comms.request_egram() # ask Pacemaker for an egram
-        self.egram_reader = comms.EgramThread(self.animation_period + 2)
+        self.egram_reader = comms.EgramThread(self.read_batch)
         self.egram_reader.start()
-        self.animation = animation.FuncAnimation(self.figure, 
-                                             self.update_egram, 
-                                             interval=self.animation_period,
-                                             blit=True) # efficient draw
+        self.animation = self.after(self.scheduler.next_period(), self.animate)
+
+    """ 
+    Draw a frame (timing it for the scheduler) and schedule the next one. 
+    Nothing is drawn while paused.
+    """
+    def animate(self):
+        start = time.perf_counter()
+        if not self.paused and self.update_egram():
+            self.scheduler.frame_drawn(time.perf_counter() - start)
+        self.animation = self.after(self.scheduler.next_period(), self.animate)
 
-    """ Update the plot lines """
+    """ Update the plot lines. Returns False if there was nothing new. """
     def update_egram(self, *args):
-        egram_data = self.egram_reader.get_data()    # get all available samples
-        self.y_vraw = self.y_vraw + egram_data["m_vraw"]
-        self.y_vraw = self.y_vraw[-self.x_len:]
-        self.y_araw = self.y_araw + egram_data["m_araw"]
-        self.y_araw = self.y_araw[-self.x_len:]
-        self.line1.set_ydata(self.y_vraw)
-        self.line2.set_ydata(self.y_araw)
-        return [self.line1, self.line2]
+        # get all available samples as uint16 views (no conversion to ints)
+        egram_data = self.egram_reader.get_data("numpy")
+        new_samples = [egram_data["m_vraw"], egram_data["m_araw"]]
+        if len(new_samples[0]) == 0:
+            return False
+        changed = self.y_vraw.extend(new_samples[0])
+        self.y_araw.extend(new_samples[1])
+        for decimator, samples in zip(self.decimators, new_samples):
+            decimator.extend(samples)
+        if self.mode != "sweep":
+            changed = [(0, self.x_len)]
+        self.draw_lines(changed)
+        return True
+
+    """ 
+    Called after every full draw of the figure (first draw, resize, y range 
+    change). Save the plot without the lines and draw the lines on top.
+    """
+    def save_background(self, event):
+        self.background = self.canvas.copy_from_bbox(self.subplot.bbox)
+        if self.mode != "sweep":
+            self.fit_to_width()
+        self.draw_lines([(0, self.x_len)], blit=False)
+
+    """ 
+    Decimate the scrolling lines to one min/max pair per pixel column if the 
+    window has more samples than the plot is wide. Called after every full 
+    draw, so the decimators are rebuilt (from the stored samples) on resize.
+    """
+    def fit_to_width(self):
+        columns = int(self.subplot.bbox.width)
+        if (self.decimators and 
+                self.decimators[0].requested_columns == columns):
+            return
+
+        raw_traces = [self.y_vraw, self.y_araw]
+        self.decimators = []
+        if self.x_len > columns > 0:
+            for trace in raw_traces:
+                decimator = MinMaxDecimator(self.x_len, columns)
+                decimator.extend(trace.view())
+                self.decimators.append(decimator)
+            self.traces = list(zip([self.line1, self.line2], self.decimators))
+        else:
+            self.traces = list(zip([self.line1, self.line2], raw_traces))
+
+    """ 
+    Redraw the lines for the sample index ranges in changed. Each range is 
+    redrawn by restoring the saved background under it, drawing just that 
+    piece of each line, and copying only that region to the screen.
+    """
+    def draw_lines(self, changed, blit=True):
+        if self.background is None:
+            return
+        x0, y0, x1, y1 = self.background.get_extents()
+        plot_box = self.subplot.bbox
+
+        for start, stop in changed:
+            first = max(start - 1, 0)   # connect to the sample before
+            last = min(stop, self.x_len - 1)
+            # whole pixel columns so the drawn and restored areas match
+            left = np.floor(self.subplot.transData.transform((first, 0))[0])
+            right = np.ceil(self.subplot.transData.transform((last, 0))[0])
+            box = Bbox.from_extents(max(left - 2, plot_box.x0), plot_box.y0,
+                                    min(right + 2, plot_box.x1), plot_box.y1)
+
+            # restore the full height of the columns (xy is the region origin
+            # and the last column is inclusive)
+            self.canvas.restore_region(self.background, 
+                                       bbox=(box.x0, y0, box.x1 - 1, y1), 
+                                       xy=(x0, y0))
+            # draw every sample that touches the box, plus one on each side so
+            # the line reaches the edges (the clip box cuts off the rest)
+            to_data = self.subplot.transData.inverted()
+            lo = int(np.floor(to_data.transform((box.x0, 0))[0])) - 1
+            hi = int(np.ceil(to_data.transform((box.x1, 0))[0])) + 2
+            lo = max(lo, 0)
+            for line, trace in self.traces:
+                if (start, stop) == (0, self.x_len):
+                    line.set_data(trace.xs, trace.view())
+                else:
+                    line.set_data(trace.xs[lo:hi], trace.view()[lo:hi])
+                line.set_clip_box(box)
+                self.subplot.draw_artist(line)
+                line.set_clip_box(plot_box)
+
+            if blit:
+                self.canvas.blit(box)
 
     """ Change the plot y range """
     def update_y_range(self, y_range):
@@ -122,32 +408,151 @@ class EgramPlot(tk.Frame):
         ax.set_ylim(y_range)
         self.canvas.draw()
 
-    """ Pause the reader thread loop """
+    """ 
+    Freeze the plot. The reader thread keeps draining the port into its ring 
+    buffer, so nothing has to be re-opened or resynced on resume.
+    """
     def pause_egram(self): 
-        self.egram_reader.quit()
+        self.paused = True
 
-    """ Resume the reader thread loop after a pause """
+    """ 
+    Unfreeze the plot. The samples that arrived during the pause are drawn on
+    the next frame (up to the reader's ring buffer capacity, 60 s by default).
+    """
     def resume_egram(self): 
-        # ensure that it was stopped
-        self.egram_reader.quit()
-        # this may conflict with the plot animation
-        self.egram_reader = comms.EgramThread(self.animation_period + 2)
-        self.egram_reader.start()
+        self.paused = False
 
     def set_visible(self, visibility):
         self.line1.set_visible(visibility[0])
         self.line2.set_visible(visibility[1])
+        # a hidden line's pixels are only cleared by a full draw
+        self.canvas.draw_idle()
+
+    """ 
+    Record every sample from now on to a new recording file at path (see 
+    recording.py), or to an EDF+ file if path ends in ".edf" (see edf.py), 
+    whether or not the plot is paused.
+    """
+    def start_recording(self, path):
+        self.stop_recording()
+        if str(path).lower().endswith(".edf"):
+            self.recorder = edf.EdfWriter(path)
+        else:
+            self.recorder = recording.EgramRecorder(path)
+        self.egram_reader.add_recorder(self.recorder)
+
+    """ Finish the recording file, if there is one """
+    def stop_recording(self):
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
+            self.egram_reader.remove_recorder(recorder)
+            recorder.close()
 
     """ Stop the serial read thread and send stop signal to the Pacemaker """
     def stop_egram(self):
         self.egram_reader.quit()
+        self.stop_recording()
         comms.stop_egram() # if connected to Pacemaker, stop egram
 
     """ Override destroy to ensure that the serial read thread is stopped """
     def destroy(self):
+        self.after_cancel(self.animation)
         self.stop_egram()
         super().destroy()
 
+""" 
+Egram plot widget for a recorded session (see recording.py). 
+Pan and zoom with the toolbar. Whenever the x range changes, the lines are 
+rebuilt from the recording's min/max pyramid at the level that matches the 
+zoom (recording.envelope()), so a redraw costs about the same for a few 
+seconds or a few hours of egram. Nothing is kept in memory but the visible
+points.
+"""
+class EgramViewer(EgramPlot):
+    def __init__(self, master, path):
+        tk.Frame.__init__(self, master)
+        self.master = master
+        self.recording = recording.EgramRecording(path)
+
+        self.create_matplotlib_figure()
+        self.create_plot()
+
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self, 
+                                            pack_toolbar=False)
+        self.toolbar.update()
+        self.toolbar.pack(side="bottom", fill="x")
+
+    """ Create the plot and lines showing the whole recording """
+    def create_plot(self):
+        self.subplot = self.figure.add_subplot(1,1,1)
+        self.subplot.set_facecolor(self["bg"])
+
+        self.y_range = [0,5000]
+        self.line1, = self.subplot.plot([], [])
+        self.line2, = self.subplot.plot([], [])
+        self.subplot.set_ylim(self.y_range)
+
+        self.subplot.set_title("Electrogram")
+        self.subplot.set_xlabel("s")
+        self.subplot.set_ylabel("mV")
+
+        self.subplot.callbacks.connect("xlim_changed", self.update_view)
+        self.subplot.set_xlim([0, max(self.recording.duration(), 1e-3)])
+
+    """ Rebuild the lines for the visible time range (called on pan/zoom) """
+    def update_view(self, *args):
+        rate = self.recording.sample_rate
+        x0, x1 = self.subplot.get_xlim()
+        start = int(np.floor(x0 * rate))
+        stop = int(np.ceil(x1 * rate)) + 1
+        columns = max(int(self.subplot.bbox.width), 1)
+
+        xs, m_vraw, m_araw = self.recording.envelope(start, stop, columns)
+        self.line1.set_data(xs / rate, m_vraw)
+        self.line2.set_data(xs / rate, m_araw)
+
+    """ Override destroy to release the recording file """
+    def destroy(self):
+        self.recording.close()
+        tk.Frame.destroy(self)
+
+""" 
+Prints the recording shown in an EgramViewer at the viewer's gain (see 
+printout.py) into the directory "<path>-printout". The pages are drawn by a
+background PrintJob, and the button shows the progress.
+"""
+class EgramPrintButton(tk.Button):
+    def __init__(self, master=None, viewer=None):
+        self.tk_text = tk.StringVar()
+        super().__init__(master=master, textvariable=self.tk_text, 
+                         command=self.print_recording)
+        self.tk_text.set("Print")
+        self.viewer = viewer
+        self.job = None
+
+    def print_recording(self):
+        if self.job is not None:
+            return # already printing
+        path = self.viewer.recording.path
+        gain = 5000 / self.viewer.subplot.get_ylim()[1]
+        self.job = printout.PrintJob(path, f"{path}-printout", 
+                                     printout.PrintSettings(gain=gain))
+        self.job.start()
+        self.show_progress()
+
+    """ Poll the print job from the Tk main loop until it is done """
+    def show_progress(self):
+        if self.job.is_alive():
+            self.tk_text.set(f"Printing {self.job.pages_done}/"
+                             f"{self.job.num_pages}")
+            self.after(200, self.show_progress)
+        else:
+            if self.job.error is not None:
+                print(f"Printing failed: {self.job.error}")
+            self.tk_text.set("Print")
+            self.job = None
+
 class EgramPauseButton(tk.Button):
     def __init__(self, master=None, actions={"on_pause":None,"on_resume":None}):
         self.tk_text = tk.StringVar()
@@ -230,16 +635,25 @@ class EgramLineSelector(tk.Frame):
                      ]
         self.update_line_visibility(visibility)
 
-""" Supports creating the egram monitor in a separate window. """
+""" 
+Supports creating the egram monitor in a separate window. 
+In "view" mode the window shows the recording at path instead of the live 
+egram.
+"""
 class EgramWin(tk.Toplevel):
-    def __init__(self, master=None):
+    def __init__(self, master=None, mode="scroll", path=None):
         super().__init__(master)
         self.master = master
+        self.mode = mode # "scroll", "sweep" (see EgramPlot) or "view"
+        self.path = path # recording to show in "view" mode
         self.create_widgets()
 
     """ Create the plot and button widgets """
     def create_widgets(self):
-        self.egram_plot = EgramPlot(master=self)
+        if self.mode == "view":
+            self.egram_plot = EgramViewer(master=self, path=self.path)
+        else:
+            self.egram_plot = EgramPlot(master=self, mode=self.mode)
         self.gain_selector = EgramGainSelector(master=self, 
                                              cmd=self.egram_plot.update_y_range)
 
@@ -247,13 +661,24 @@ class EgramWin(tk.Toplevel):
         self.line_selector = EgramLineSelector(master=self,
                                                 cmd=self.egram_plot.set_visible)
 
-        actions = {
-                    "on_pause":self.egram_plot.pause_egram,
-                    "on_resume":self.egram_plot.resume_egram,
-                  }
-        self.tk_button = EgramPauseButton(master=self, actions=actions)
-
         self.gain_selector.pack(side="left")
+        if self.mode == "view": # a recording has nothing to pause
+            self.tk_button = EgramPrintButton(master=self, 
+                                              viewer=self.egram_plot)
+        else:
+            actions = {
+                        "on_pause":self.egram_plot.pause_egram,
+                        "on_resume":self.egram_plot.resume_egram,
+                      }
+            self.tk_button = EgramPauseButton(master=self, actions=actions)
         self.tk_button.pack(side="bottom", anchor="n")
         self.egram_plot.pack(side="left")
         self.line_selector.pack(side="left")
+
+if __name__ == "__main__":
+    # python3 egram.py FILE opens a recording (see recording.py) in the viewer
+    root = tk.Tk()
+    root.withdraw()
+    win = EgramWin(master=root, mode="view", path=sys.argv[1])
+    win.protocol("WM_DELETE_WINDOW", root.destroy)
+    root.mainloop()
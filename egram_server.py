@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+python3 egram_server.py SOCKET [--replay FILE] [--speed 1]
+    Serve the live egram from the Pacemaker on comms.port (or replay a
+    capture, see capture.py) on the Unix domain socket SOCKET.
+
+python3 egram_server.py SOCKET --listen
+    Connect to a server and print the samples per second it sends.
+
+import comms, egram_server
+reader = comms.EgramThread(16)
+server = egram_server.EgramServer("/tmp/pacemaker-egram.sock")
+server.start()
+reader.add_recorder(server)
+...
+server.close()
+
+sock = egram_server.connect("/tmp/pacemaker-egram.sock")
+for seq, m_vraw, m_araw in egram_server.receive_frames(sock):
+    ...
+
+MODULE PURPOSE
+--------------
+Serves the live egram to tools in any language over a Unix domain socket.
+Every decoded batch is sent to every connected client as one frame (big
+endian, like the serial packets):
+    length      4 bytes  uint32, number of bytes after this field
+    seq         8 bytes  uint64, sequence number of the first sample (counted
+                         from when the server started)
+    m_vraw      2n bytes uint16 samples
+    m_araw      2n bytes uint16 samples
+so a frame holds n = (length - 8) / 4 samples per channel. Clients don't send
+anything; closing the socket unsubscribes. A gap in seq means the client fell
+behind and samples were dropped for it.
+
+MODULE SECRETS
+--------------
+    - The server runs its own asyncio event loop in a thread. The read thread
+      only encodes a batch (once for every client) and hands it to the loop
+      with call_soon_threadsafe(), so it never waits on a socket.
+    - Every client has a bounded queue of frames and its own sender task. If
+      a client doesn't keep up, its queue fills and its oldest frames are
+      dropped (counted in client.dropped); other clients and the read thread
+      don't notice.
+    - A stale socket file left by a server that crashed is removed before
+      binding, but only if nothing is listening on it (asyncio would replace
+      the socket of a running server without asking).
+"""
+
+import argparse
+import asyncio
+import errno
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+import numpy as np
+
+import capture
+import comms
+
+frame_header = struct.Struct(">IQ") # length, seq
+length_len = 4                      # bytes in the length field
+client_queue_len = 256  # frames queued per client before the oldest is dropped
+
+""" Frame (bytes) for a batch of samples starting at sequence number seq """
+def encode_frame(seq, m_vraw, m_araw):
+    samples = np.concatenate((m_vraw, m_araw)).astype(">u2")
+    return frame_header.pack(frame_header.size - length_len + samples.nbytes,
+                             seq) + samples.tobytes()
+
+""" (seq, m_vraw, m_araw) from a frame without its length field """
+def decode_frame(payload):
+    (seq,) = struct.unpack_from(">Q", payload)
+    samples = np.frombuffer(payload, dtype=">u2",
+                            offset=frame_header.size - length_len)
+    samples = samples.astype(np.uint16)
+    num_samples = len(samples) // 2
+    return seq, samples[:num_samples], samples[num_samples:]
+
+""" Connect to the server at path. Returns the socket. """
+def connect(path, read_timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(read_timeout)
+    sock.connect(path)
+    return sock
+
+"""
+Yield (seq, m_vraw, m_araw) for every frame that arrives on sock (see
+connect()) until the server closes the connection.
+"""
+def receive_frames(sock):
+    with sock.makefile("rb") as stream:
+        while True:
+            length = stream.read(length_len)
+            if len(length) < length_len:
+                return
+            (length,) = struct.unpack(">I", length)
+            payload = stream.read(length)
+            if len(payload) < length:
+                return
+            yield decode_frame(payload)
+
+"""
+Remove the socket file at path if no server is listening on it. Raises
+OSError if one is.
+"""
+def remove_stale_socket(path):
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise OSError(errno.EADDRINUSE, f"an egram server is already on {path}")
+
+"""
+One connected client: a bounded queue of frames and the task that sends them.
+Lives on the server's event loop.
+"""
+class ServerClient():
+    def __init__(self, name, writer, queue_len):
+        self.name = name
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_len)
+        self.dropped = 0    # samples dropped because the queue was full
+        self.sent = 0       # samples sent
+
+    """ Queue a frame of num_samples, dropping the oldest if it is full """
+    def put(self, frame, num_samples):
+        if self.queue.full():
+            _, old_samples = self.queue.get_nowait()
+            if self.dropped == 0:
+                print(f"Egram client {self.name} is falling behind")
+            self.dropped = self.dropped + old_samples
+        self.queue.put_nowait((frame, num_samples))
+
+    async def send(self):
+        while True:
+            frame, num_samples = await self.queue.get()
+            self.writer.write(frame)
+            await self.writer.drain()
+            self.sent = self.sent + num_samples
+
+"""
+Serves egram batches to every client connected to the Unix domain socket at
+path. Add it to an EgramThread with add_recorder() (or call write()). start()
+returns once the socket is listening.
+"""
+class EgramServer(threading.Thread):
+    def __init__(self, path, queue_len=client_queue_len):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.queue_len = queue_len
+        self.clients = []
+        self.num_clients = 0    # clients ever connected (for names)
+        self.seq = 0            # sequence number of the next sample
+        self.loop = None
+        self.stopping = None
+        self.ready = threading.Event()
+        self.error = None
+
+    def start(self):
+        threading.Thread.start(self)
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        try:
+            self.stopping = asyncio.Event()
+            remove_stale_socket(self.path)
+            server = await asyncio.start_unix_server(self.handle_client,
+                                                     path=self.path)
+            self.loop = asyncio.get_running_loop()
+        except Exception as error:
+            self.error = error
+            return
+        finally:
+            self.ready.set()
+
+        await self.stopping.wait()
+        self.loop = None
+        server.close()
+        for client in self.clients:
+            client.writer.close()
+        await server.wait_closed()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    """ Send frames to a new client until it disconnects """
+    async def handle_client(self, reader, writer):
+        self.num_clients = self.num_clients + 1
+        client = ServerClient(self.num_clients, writer, self.queue_len)
+        self.clients.append(client)
+        sender = asyncio.create_task(client.send())
+        closed = asyncio.create_task(reader.read())  # clients send nothing
+        try:
+            await asyncio.wait((sender, closed),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.clients.remove(client)
+            sender.cancel()
+            closed.cancel()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    """
+    Add a batch of samples (one array-like per channel, same length). Called
+    from the read thread, doesn't wait for the clients.
+    """
+    def write(self, m_vraw, m_araw):
+        num_samples = len(m_vraw)
+        seq = self.seq
+        self.seq = seq + num_samples
+        loop = self.loop
+        if num_samples == 0 or loop is None or not self.clients:
+            return
+        frame = encode_frame(seq, m_vraw, m_araw)
+        try:
+            loop.call_soon_threadsafe(self.publish, frame, num_samples)
+        except RuntimeError:
+            pass    # the loop has just closed
+
+    def publish(self, frame, num_samples):
+        for client in self.clients:
+            client.put(frame, num_samples)
+
+    """ Disconnect every client, stop listening and remove the socket. """
+    def close(self):
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass
+        if self.is_alive():
+            self.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Unix socket egram server")
+    parser.add_argument("socket")
+    parser.add_argument("--replay", default=None,
+                        help="serve a capture file instead of the device")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay speed (0 is as fast as possible)")
+    parser.add_argument("--listen", action="store_true",
+                        help="connect to a server and print its rate")
+    args = parser.parse_args()
+
+    if args.listen:
+        start = time.monotonic()
+        num_samples = 0
+        sock = connect(args.socket)
+        for seq, m_vraw, m_araw in receive_frames(sock):
+            num_samples = num_samples + len(m_vraw)
+            if time.monotonic() - start >= 1:
+                print(f"{num_samples} samples/s (seq {seq})")
+                start = time.monotonic()
+                num_samples = 0
+    else:
+        connection = None
+        if args.replay is not None:
+            connection = capture.ReplayConnection(args.replay, args.speed)
+        reader = comms.EgramThread(16, connection=connection)
+        server = EgramServer(args.socket)
+        server.start()
+        reader.add_recorder(server)
+        if connection is None:
+            comms.request_egram()
+        reader.start()
+        print(f"Serving the egram on {args.socket}")
+        try:
+            while connection is None or not connection.done():
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        if connection is None:
+            comms.stop_egram()
+        reader.quit()
+        reader.join()
+        server.close()
@@ -0,0 +1,142 @@
+import os
+import socket
+import threading
+import time
+import numpy as np
+import pytest       # run pytest in the directory to run all tests in the file
+import capture
+import comms
+import egram_server
+import simulator
+from capture_test import write_capture
+
+@pytest.fixture
+def server(tmp_path):
+    server = egram_server.EgramServer(str(tmp_path / "egram.sock"),
+                                      queue_len=64)
+    server.start()
+    yield server
+    server.close()
+
+""" Wait until the server has num_clients clients """
+def wait_for_clients(server, num_clients):
+    deadline = time.monotonic() + 5
+    while len(server.clients) != num_clients:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+""" Read frames from sock until num_samples have arrived """
+def receive_samples(sock, num_samples):
+    batches = []
+    total = 0
+    for seq, m_vraw, m_araw in egram_server.receive_frames(sock):
+        batches.append((seq, m_vraw, m_araw))
+        total = total + len(m_vraw)
+        if total >= num_samples:
+            break
+    return batches
+
+class TestFrames():
+    def test_round_trip(self):
+        frame = egram_server.encode_frame(70000, np.array([1, 2, 0xffff]),
+                                          np.array([4, 5, 6]))
+        assert frame[:4] == bytes([0, 0, 0, 8 + 12])
+        assert frame[12:14] == b"\x00\x01"  # big endian samples
+        seq, m_vraw, m_araw = egram_server.decode_frame(frame[4:])
+        assert seq == 70000
+        assert m_vraw.tolist() == [1, 2, 0xffff]
+        assert m_araw.tolist() == [4, 5, 6]
+
+class TestEgramServer():
+    def test_clients_get_every_batch(self, server):
+        server.write([7], [8])  # nobody connected, only counted
+        socks = [egram_server.connect(server.path, read_timeout=5)
+                 for i in range(2)]
+        wait_for_clients(server, 2)
+        server.write([1, 2, 3], [4, 5, 6])
+        server.write([10], [11])
+        for sock in socks:
+            batches = receive_samples(sock, 4)
+            assert [(seq, m_vraw.tolist(), m_araw.tolist())
+                    for seq, m_vraw, m_araw in batches] == \
+                   [(1, [1, 2, 3], [4, 5, 6]), (4, [10], [11])]
+            sock.close()
+        wait_for_clients(server, 0)
+
+    def test_slow_client_does_not_stall(self, server):
+        slow = egram_server.connect(server.path)    # never reads
+        fast = egram_server.connect(server.path, read_timeout=10)
+        wait_for_clients(server, 2)
+        received = []
+        receiver = threading.Thread(target=lambda: received.extend(
+                                        receive_samples(fast, 300 * 2000)))
+        receiver.start()
+
+        batch = np.arange(2000, dtype=np.uint16)
+        start = time.perf_counter()
+        for i in range(300):
+            server.write(batch, batch)
+            time.sleep(0.002)
+        # writing never waited for the slow client
+        assert time.perf_counter() - start < 5
+        receiver.join(timeout=20)
+
+        assert [seq for seq, _, _ in received] == list(range(0, 600000, 2000))
+        slow_client, fast_client = server.clients
+        assert slow_client.dropped > 0
+        assert fast_client.dropped == 0
+        slow.close()
+        fast.close()
+
+    def test_scripted_device(self, server, tmp_path):
+        # a capture file stands in for the device's serial port
+        seq = np.arange(3000)
+        m_vraw, m_araw = simulator.synthetic_egram(seq, 1000)
+        stream = simulator.egram_frames(m_vraw, m_araw).tobytes()
+        path = tmp_path / "device.cap"
+        write_capture(path, [(i * 0.01, "R", stream[i:i + 600])
+                             for i in range(0, len(stream), 600)])
+        connection = capture.ReplayConnection(path, speed=0, read_timeout=0.01)
+
+        sock = egram_server.connect(server.path, read_timeout=5)
+        wait_for_clients(server, 1)
+        reader = comms.EgramThread(256, connection=connection)
+        reader.add_recorder(server)
+        reader.start()
+        try:
+            batches = receive_samples(sock, 3000)
+        finally:
+            reader.quit()
+            reader.join()
+        sock.close()
+
+        assert batches[0][0] == 0
+        assert np.array_equal(np.concatenate([b[1] for b in batches]), m_vraw)
+        assert np.array_equal(np.concatenate([b[2] for b in batches]), m_araw)
+
+    def test_close_removes_socket(self, tmp_path):
+        path = str(tmp_path / "egram.sock")
+        server = egram_server.EgramServer(path)
+        server.start()
+        sock = egram_server.connect(path, read_timeout=5)
+        wait_for_clients(server, 1)
+        server.close()
+        assert not os.path.exists(path)
+        assert list(egram_server.receive_frames(sock)) == []
+        sock.close()
+
+    def test_stale_socket(self, tmp_path):
+        path = str(tmp_path / "egram.sock")
+        first = egram_server.EgramServer(path)
+        first.start()
+        with pytest.raises(OSError):
+            egram_server.EgramServer(path).start()  # still in use
+        first.close()
+
+        # a socket file left behind by a server that died
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = egram_server.EgramServer(path)
+        server.start()
+        server.close()
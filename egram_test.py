@@ -0,0 +1,259 @@
+import time
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import pytest       # run pytest in the directory to run all tests in the file
+import comms
+import egram
+import recording
+from bench import HeadlessEgramPlot
+from comms_test import ScriptedConnection, egram_frame
+
+class TestEgramTrace():
+    def test_starts_empty(self):
+        trace = egram.EgramTrace(4)
+        assert trace.view().tolist() == [0, 0, 0, 0]
+
+    def test_extend(self):
+        trace = egram.EgramTrace(4)
+        trace.extend(np.array([1, 2, 3]))
+        assert trace.view().tolist() == [0, 1, 2, 3]
+
+        trace.extend(np.array([4, 5]))
+        assert trace.view().tolist() == [2, 3, 4, 5]
+
+    def test_extend_longer_than_window(self):
+        trace = egram.EgramTrace(4)
+        trace.extend(np.array([1]))
+        trace.extend(np.arange(10))
+        assert trace.view().tolist() == [6, 7, 8, 9]
+
+    def test_matches_list_scroll(self):
+        rng = np.random.default_rng(1)
+        trace = egram.EgramTrace(50)
+        y = [0] * 50
+        for i in range(200):
+            samples = rng.integers(0, 5000, rng.integers(0, 30))
+            trace.extend(samples)
+            y = (y + samples.tolist())[-50:]
+            assert trace.view().tolist() == y
+
+class TestSweepTrace():
+    def test_starts_blank(self):
+        trace = egram.SweepTrace(10, gap=2)
+        assert np.isnan(trace.view()).all()
+
+    def test_extend(self):
+        trace = egram.SweepTrace(10, gap=2)
+        assert trace.extend(np.array([1, 2, 3])) == [(0, 5)]
+        assert trace.view()[:3].tolist() == [1, 2, 3]
+        assert np.isnan(trace.view()[3:]).all()
+        assert trace.cursor == 3
+
+    def test_wrap_around(self):
+        trace = egram.SweepTrace(10, gap=2)
+        trace.extend(np.arange(7))
+        assert trace.extend(np.array([7, 8, 9, 10])) == [(7, 10), (0, 3)]
+        assert trace.view()[[7, 8, 9, 0]].tolist() == [7, 8, 9, 10]
+        assert np.isnan(trace.view()[1:3]).all()
+        assert trace.view()[3:7].tolist() == [3, 4, 5, 6]
+
+    def test_nothing_new(self):
+        trace = egram.SweepTrace(10, gap=2)
+        assert trace.extend(np.array([], dtype=np.uint16)) == []
+
+class TestMinMaxDecimator():
+    def test_columns(self):
+        decimator = egram.MinMaxDecimator(1000, 300)
+        assert decimator.bin_len == 4
+        assert decimator.columns == 250
+        assert len(decimator.view()) == len(decimator.xs) == 500
+
+    def test_keeps_spikes(self):
+        decimator = egram.MinMaxDecimator(100, 10)
+        samples = np.full(100, 2000)
+        samples[42] = 4500
+        samples[77] = 100
+        decimator.extend(samples)
+        assert decimator.view().max() == 4500
+        assert decimator.view().min() == 100
+        assert decimator.view()[8:10].tolist() == [2000, 4500]
+        assert decimator.view()[14:16].tolist() == [2000, 100]
+
+    def test_incremental_matches_batch(self):
+        rng = np.random.default_rng(2)
+        samples = rng.integers(0, 5000, 3000)
+        batch = egram.MinMaxDecimator(1000, 64)
+        batch.extend(samples)
+        incremental = egram.MinMaxDecimator(1000, 64)
+        i = 0
+        while i < len(samples):
+            size = int(rng.integers(0, 40))
+            incremental.extend(samples[i:i + size])
+            i = i + size
+        assert incremental.view().tolist() == batch.view().tolist()
+
+class TestFrameScheduler():
+    def test_fast_frames_use_min_period(self):
+        scheduler = egram.FrameScheduler(min_period=10, max_period=200)
+        for i in range(20):
+            scheduler.frame_drawn(0.001)
+        assert scheduler.next_period() == 10
+
+    def test_slow_frames_lower_the_rate(self):
+        scheduler = egram.FrameScheduler(min_period=10, max_period=200, 
+                                         load=0.5)
+        for i in range(50):
+            scheduler.frame_drawn(0.030)
+        assert scheduler.next_period() == 60
+
+        for i in range(50):
+            scheduler.frame_drawn(1.0)
+        assert scheduler.next_period() == 200
+
+    def test_recovers(self):
+        scheduler = egram.FrameScheduler(min_period=10)
+        scheduler.frame_drawn(0.050)
+        assert scheduler.next_period() == 100
+        for i in range(50):
+            scheduler.frame_drawn(0.002)
+        assert scheduler.next_period() == 10
+
+""" 
+EgramPlot drawn on a plain Agg canvas (no tkinter window needed). Only the 
+parts of the widget that draw the plot are set up.
+"""
+class AggEgramPlot(egram.EgramPlot):
+    def __init__(self, x_len, mode):
+        self.x_len = x_len
+        self.mode = mode
+        self.figure = Figure(figsize=(6,3), dpi=80)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.create_plot()
+
+    def __getitem__(self, key):
+        return "white" # stands in for the tkinter background colour
+
+    def pixels(self):
+        return np.asarray(self.canvas.buffer_rgba()).astype(int)
+
+    """ Top and bottom row of the lines in each pixel column of the plot """
+    def line_extents(self):
+        x0, y0, x1, y1 = self.subplot.bbox.extents.astype(int)
+        height = self.pixels().shape[0]
+        plot = self.pixels()[height - y1 + 2:height - y0 - 2, x0 + 2:x1 - 2]
+        on_line = plot[..., :3].sum(axis=-1) < 600
+        top = np.argmax(on_line, axis=0)
+        bottom = len(on_line) - np.argmax(on_line[::-1], axis=0)
+        return top, bottom
+
+class TestEgramPlotDrawing():
+    def test_sweep_frames_match_full_draw(self):
+        plot = AggEgramPlot(500, "sweep")
+        plot.canvas.draw()
+        rng = np.random.default_rng(0)
+        for i in range(40):
+            t = np.arange(i * 30, i * 30 + rng.integers(5, 30))
+            m_vraw = (2500 + 2000 * np.sin(t / 10)).astype(np.uint16)
+            changed = plot.y_vraw.extend(m_vraw)
+            plot.y_araw.extend(m_vraw // 2)
+            plot.draw_lines(changed)
+        frames = plot.pixels()
+
+        plot.canvas.draw()
+        # only antialiasing differences where the pieces of the lines meet
+        assert np.abs(frames - plot.pixels()).max() < 64
+
+    def test_decimated_scroll_matches_every_sample(self):
+        plot = AggEgramPlot(20000, "scroll")
+        plot.line2.set_visible(False)
+        plot.canvas.draw()
+        assert len(plot.decimators) == 2
+
+        t = np.arange(20000)
+        m_vraw = (2500 + 2000 * np.sin(t / 600)).astype(np.uint16)
+        m_vraw[::700] = 4800 # spikes
+        decimator = plot.decimators[0]
+        decimator.extend(m_vraw)
+        plot.draw_lines([(0, plot.x_len)])
+        decimated = plot.line_extents()
+
+        # draw every sample in the complete columns instead
+        stream = np.concatenate((np.zeros(20000), m_vraw))
+        end = len(stream) - len(decimator.partial)
+        shown = stream[end - decimator.columns * decimator.bin_len:end]
+        plot.canvas.restore_region(plot.background)
+        plot.line1.set_data(np.arange(len(shown)), shown)
+        plot.subplot.draw_artist(plot.line1)
+
+        # Each pixel column covers the same vertical range (give or take a 
+        # pixel, the decimated points sit in the middle of their column).
+        for a, b in zip(decimated, plot.line_extents()):
+            near = np.stack((b, np.roll(b, 1), np.roll(b, -1)))[:, 1:-1]
+            a = a[1:-1]
+            assert ((near.min(axis=0) - 3 <= a) & (a <= near.max(axis=0) + 3)).all()
+
+class TestPauseResume():
+    def test_reader_drains_while_paused(self, monkeypatch):
+        frames = [(i, 4000 - i) for i in range(1500)]
+        connection = ScriptedConnection(b"".join(egram_frame(*f) 
+                                                 for f in frames), 
+                                        chunk_size=60)
+        reader = comms.EgramThread(16, connection=connection)
+        plot = HeadlessEgramPlot(reader, x_len=1000)
+        plot.paused = False
+        plot.scheduler = egram.FrameScheduler()
+        plot.after = lambda period, callback: None  # frames are drawn by hand
+        # resuming must not start another reader
+        monkeypatch.setattr(comms, "EgramThread", None)
+
+        plot.pause_egram()
+        reader.start()
+        deadline = time.monotonic() + 5
+        while not connection.done() and time.monotonic() < deadline:
+            plot.animate()
+            time.sleep(0.001)
+        # the port was drained while the plot stayed frozen
+        assert connection.done()
+        assert plot.y_vraw.view().tolist() == [0] * 1000
+
+        reader.quit()
+        reader.join()       # every sample read is in its ring buffer
+        plot.resume_egram()
+        plot.animate()
+        assert plot.egram_reader is reader
+        assert plot.y_vraw.view().tolist() == [f[0] for f in frames[-1000:]]
+        assert plot.y_araw.view().tolist() == [f[1] for f in frames[-1000:]]
+
+class AggEgramViewer(egram.EgramViewer):
+    def __init__(self, path):
+        self.recording = recording.EgramRecording(path)
+        self.figure = Figure(figsize=(10,5), dpi=100)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.create_plot()
+
+    def __getitem__(self, key):
+        return "white" # stands in for the tkinter background colour
+
+class TestEgramViewer():
+    def test_zoom(self, tmp_path):
+        path = tmp_path / "test.egram"
+        recorder = recording.EgramRecorder(path)
+        t = np.arange(2 * 3600 * 1000)  # two hours at 1 kHz
+        m_vraw = (2500 + 2000 * np.sin(t / 300)).astype(np.uint16)
+        recorder.write(m_vraw, np.full(len(t), 1000, dtype=np.uint16))
+        recorder.close()
+
+        viewer = AggEgramViewer(path)
+        viewer.canvas.draw()
+        columns = int(viewer.subplot.bbox.width)
+        xs, ys = viewer.line1.get_data()
+        assert len(xs) <= 2 * 8 * columns
+        assert xs[-1] == pytest.approx(7200, rel=1e-3)
+        assert ys.min() == m_vraw.min() and ys.max() == m_vraw.max()
+
+        # zoomed in to 0.2 s: the samples themselves
+        viewer.subplot.set_xlim([60, 60.2])
+        xs, ys = viewer.line1.get_data()
+        assert len(xs) == 201
+        assert xs[0] == pytest.approx(60)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+python3 printout.py FILE [--out DIR] [--speed 25] [--gain 1] [--format pdf]
+                         [--strips 4] [--workers N]
+
+import printout
+job = printout.PrintJob("session.egram", "session-printout",
+                        printout.PrintSettings(paper_speed=50, gain=2))
+job.start()
+... job.pages_done of job.num_pages ...
+job.join()
+
+MODULE PURPOSE
+--------------
+Printable egram strips (PACEMAKER section 4.7) from a recording (see
+recording.py), drawn headless with Agg so nothing depends on the GUI.
+
+Each page is landscape paper (A4 by default) holding strips, one below the
+other, that continue from one to the next. The time axis is to scale: at a
+paper speed of 25 mm/s, one second of egram is 25 mm long on paper, with the
+usual grid (1 mm minor, 5 mm major). The gain scales the y axis the same way
+as the gain selector of the live plot (2x shows 0 to 2500).
+
+Pages are written as separate files, DIR/page-0001.png (or .pdf), ...
+
+MODULE SECRETS
+--------------
+    - Pages are drawn in parallel by a process pool, one page per task. A
+      worker opens the recording itself (mmap, so it costs nothing), reads
+      only the samples of its page, draws it, saves it and throws the figure
+      away, so memory doesn't grow with the length of the strip and nothing
+      but file names comes back from the workers.
+    - PrintJob runs the pool from a thread so the Tk main loop never waits
+      for a page. Workers are spawned rather than forked, since forking a 
+      process with Tk and other threads running isn't safe.
+    - Long strips at low resolution are drawn from the recording's min/max
+      pyramid (recording.envelope()), spikes included.
+"""
+
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import recording
+
+mm_per_inch = 25.4
+
+""" Paper and plot settings for a printout (lengths in mm) """
+class PrintSettings():
+    def __init__(self, paper_speed=25, gain=1, page_size=(297, 210),
+                 strips=4, margin=10, dpi=150, file_format="pdf"):
+        self.paper_speed = paper_speed # mm per second
+        self.gain = gain
+        self.page_size = page_size     # (width, height), landscape A4
+        self.strips = strips           # per page
+        self.margin = margin
+        self.dpi = dpi
+        self.file_format = file_format # "pdf" or "png"
+
+    """ Length of a strip on paper (mm) """
+    def strip_length(self):
+        return self.page_size[0] - 2 * self.margin
+
+    """ Seconds of egram in one strip """
+    def strip_seconds(self):
+        return self.strip_length() / self.paper_speed
+
+    """ Seconds of egram on one page """
+    def page_seconds(self):
+        return self.strips * self.strip_seconds()
+
+    """ The y range of a strip (the same as EgramGainSelector) """
+    def y_range(self):
+        return [0, 5000 / self.gain]
+
+""" Number of pages needed for the recording at path """
+def num_pages(path, settings):
+    session = recording.EgramRecording(path)
+    pages = int(np.ceil(session.duration() / settings.page_seconds()))
+    session.close()
+    return max(pages, 1)
+
+""" File name of page (counting from 0) in out_dir """
+def page_path(out_dir, page, settings):
+    return os.path.join(out_dir, f"page-{page + 1:04d}.{settings.file_format}")
+
+"""
+ECG paper grid on subplot: 1 mm minor and 5 mm major squares for a strip 
+strip_height mm high. Drawn as four line collections because matplotlib tick
+gridlines are one artist per line (hundreds per strip).
+"""
+def draw_grid(subplot, settings, strip_height):
+    x0, x1 = subplot.get_xlim()
+    y0, y1 = subplot.get_ylim()
+    x_mm = np.arange(0, int(settings.strip_length()) + 1)
+    y_mm = np.arange(0, int(strip_height) + 1)
+    xs = x0 + x_mm / settings.paper_speed
+    ys = y0 + y_mm * (y1 - y0) / strip_height
+    for major, color, width in [(False, "#f6d8d8", 0.3),
+                                (True, "#e8a0a0", 0.6)]:
+        subplot.vlines(xs[(x_mm % 5 == 0) == major], y0, y1, color=color,
+                       linewidth=width)
+        subplot.hlines(ys[(y_mm % 5 == 0) == major], x0, x1, color=color,
+                       linewidth=width)
+    subplot.set_xticks([])
+    subplot.set_yticks([])
+
+""" Draw one strip (strip_height mm high) of samples start to stop """
+def draw_strip(subplot, session, start, stop, settings, columns, 
+               strip_height):
+    rate = session.sample_rate
+    t0 = start / rate
+    subplot.set_xlim([t0, t0 + settings.strip_seconds()])
+    subplot.set_ylim(settings.y_range())
+    draw_grid(subplot, settings, strip_height)
+    subplot.text(0.002, 0.98, f"{t0:.1f} s", transform=subplot.transAxes,
+                 fontsize=6, va="top")
+
+    if stop > start:
+        xs, m_vraw, m_araw = session.envelope(start, stop, columns)
+        subplot.plot(xs / rate, m_vraw, linewidth=0.5, color="black")
+        subplot.plot(xs / rate, m_araw, linewidth=0.5, color="tab:blue")
+
+"""
+Draw page (counting from 0) of the recording at path and save it to out_path.
+Runs in a worker process. Returns out_path.
+"""
+def render_page(path, page, settings, out_path):
+    session = recording.EgramRecording(path)
+    width, height = settings.page_size
+    figure = Figure(figsize=(width / mm_per_inch, height / mm_per_inch),
+                    dpi=settings.dpi)
+    canvas = FigureCanvasAgg(figure)
+
+    started = time.strftime("%Y-%m-%d %H:%M:%S",
+                            time.localtime(session.start_time))
+    figure.text(settings.margin / width, 1 - 0.5 * settings.margin / height,
+                f"Electrogram recorded {started}    "
+                f"{settings.paper_speed:g} mm/s    {settings.gain:g}x    "
+                f"m_vraw (black), m_araw (blue)    page {page + 1}",
+                fontsize=8, va="center")
+
+    # strips fill the page between the margins, a margin apart
+    strip_height = (height - 2 * settings.margin -
+                    (settings.strips - 1) * settings.margin / 2) \
+                   / settings.strips
+    strip_len = int(round(settings.strip_seconds() * session.sample_rate))
+    columns = int(settings.strip_length() / mm_per_inch * settings.dpi)
+    for strip in range(settings.strips):
+        start = (page * settings.strips + strip) * strip_len
+        stop = min(start + strip_len, len(session))
+        top = settings.margin + strip * (strip_height + settings.margin / 2)
+        subplot = figure.add_axes([settings.margin / width,
+                                   1 - (top + strip_height) / height,
+                                   settings.strip_length() / width,
+                                   strip_height / height])
+        draw_strip(subplot, session, start, stop, settings, columns,
+                   strip_height)
+
+    figure.savefig(out_path, format=settings.file_format)
+    session.close()
+    return out_path
+
+"""
+Renders every page of the recording at path into out_dir on a pool of
+max_workers processes (os.cpu_count() if None), from a background thread.
+self.pages_done counts finished pages, self.error holds the exception if
+rendering failed, and self.paths lists the page files when it is done.
+"""
+class PrintJob(threading.Thread):
+    def __init__(self, path, out_dir, settings=None, max_workers=None):
+        threading.Thread.__init__(self, daemon=True)
+        if settings is None:
+            settings = PrintSettings()
+        self.path = path
+        self.out_dir = out_dir
+        self.settings = settings
+        self.max_workers = max_workers
+        self.num_pages = num_pages(path, settings)
+        self.pages_done = 0
+        self.paths = []
+        self.error = None
+
+    def run(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        pages = range(self.num_pages)
+        out_paths = [page_path(self.out_dir, page, self.settings)
+                     for page in pages]
+        try:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(self.max_workers, 
+                                     mp_context=context) as pool:
+                for out_path in pool.map(render_page,
+                                         [self.path] * self.num_pages, pages,
+                                         [self.settings] * self.num_pages,
+                                         out_paths):
+                    self.paths.append(out_path)
+                    self.pages_done = self.pages_done + 1
+        except Exception as error:
+            self.error = error
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print an egram recording")
+    parser.add_argument("file")
+    parser.add_argument("--out", default=None,
+                        help="directory for the pages (default FILE-printout)")
+    parser.add_argument("--speed", type=float, default=25,
+                        help="paper speed in mm/s")
+    parser.add_argument("--gain", type=float, default=1)
+    parser.add_argument("--format", choices=["pdf", "png"], default="pdf")
+    parser.add_argument("--strips", type=int, default=4,
+                        help="strips per page")
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    out_dir = args.out
+    if out_dir is None:
+        out_dir = f"{args.file}-printout"
+    settings = PrintSettings(paper_speed=args.speed, gain=args.gain,
+                             strips=args.strips, dpi=args.dpi,
+                             file_format=args.format)
+    job = PrintJob(args.file, out_dir, settings, args.workers)
+    start = time.perf_counter()
+    job.start()
+    job.join()
+    if job.error is not None:
+        raise job.error
+    print(f"{job.pages_done} pages in {out_dir} "
+          f"({time.perf_counter() - start:.1f} s)")
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+from PIL import Image
+import pytest       # run pytest in the directory to run all tests in the file
+import printout
+import recording
+import simulator
+
+@pytest.fixture
+def session_path(tmp_path):
+    path = tmp_path / "test.egram"
+    recorder = recording.EgramRecorder(path)
+    seq = np.arange(100000)    # 100 s
+    recorder.write(*simulator.synthetic_egram(seq, 1000))
+    recorder.close()
+    return str(path)
+
+class TestPrintSettings():
+    def test_paper_speed(self):
+        settings = printout.PrintSettings(paper_speed=25)
+        assert settings.strip_length() == 277
+        assert settings.strip_seconds() == pytest.approx(11.08)
+        assert settings.page_seconds() == pytest.approx(44.32)
+
+    def test_gain(self):
+        assert printout.PrintSettings(gain=2).y_range() == [0, 2500]
+        assert printout.PrintSettings(gain=0.5).y_range() == [0, 10000]
+
+    def test_num_pages(self, session_path):
+        settings = printout.PrintSettings(paper_speed=25)
+        assert printout.num_pages(session_path, settings) == 3
+        settings = printout.PrintSettings(paper_speed=50)
+        assert printout.num_pages(session_path, settings) == 5
+
+class TestRenderPage():
+    def test_png(self, session_path, tmp_path):
+        settings = printout.PrintSettings(file_format="png", dpi=100)
+        out_path = str(tmp_path / "page.png")
+        assert printout.render_page(session_path, 0, settings,
+                                    out_path) == out_path
+        with Image.open(out_path) as image:
+            # A4 landscape at 100 dpi
+            assert image.size == (1169, 826)
+
+    def test_pdf_last_page(self, session_path, tmp_path):
+        settings = printout.PrintSettings(file_format="pdf")
+        out_path = str(tmp_path / "page.pdf")
+        printout.render_page(session_path, 2, settings, out_path)
+        with open(out_path, "rb") as f:
+            assert f.read(4) == b"%PDF"
+
+class TestPrintJob():
+    def test_pages_in_parallel(self, session_path, tmp_path):
+        settings = printout.PrintSettings(file_format="png", dpi=50)
+        job = printout.PrintJob(session_path, str(tmp_path / "printout"),
+                                settings, max_workers=2)
+        job.start()
+        job.join()
+        assert job.error is None
+        assert job.pages_done == job.num_pages == 3
+        assert sorted(os.listdir(tmp_path / "printout")) == [
+                "page-0001.png", "page-0002.png", "page-0003.png"]
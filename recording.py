@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+import comms, recording
+reader = comms.EgramThread(16)
+recorder = recording.EgramRecorder("session.egram")
+reader.add_recorder(recorder)
+reader.start()
+...
+reader.quit()
+recorder.close()
+
+session = recording.EgramRecording("session.egram")
+m_vraw, m_araw = session.read(0, 5000)      # first 5 s at 1 kHz
+first = session.seq_at(session.start_time + 3600)   # sample after an hour
+xs, m_vraw, m_araw = session.envelope(0, len(session), 1000) # whole session
+session.close()
+
+python3 recording.py FILE
+    Prints a summary of a recording.
+
+MODULE PURPOSE
+--------------
+Compact on-disk egram recordings. EgramRecorder is attached to an EgramThread
+and appends every decoded sample of both channels to a file as the session
+goes. EgramRecording opens the file later with mmap, so a recording of any
+length opens instantly and only the samples that are read are loaded.
+
+While recording, a min/max pyramid is built for zoomed out views: level k 
+holds the min and max of every bin of pyramid_factor**k samples (8, 64, 512, 
+... by default), so envelope() can draw any range of a long recording from at
+most a few bins per pixel column.
+
+File format (little endian):
+    header, header_len bytes
+        magic       8 bytes     b"PMEGRAM1"
+        sample_rate 8 bytes     float, samples per second per channel
+        start_time  8 bytes     float, time.time() of the first sample
+        chunk_len   4 bytes     samples per channel in every chunk
+        channels    4 bytes     number of channels (2: m_vraw, m_araw)
+        pyramid_factor  4 bytes samples per bin, times this at each level
+        pyramid_levels  4 bytes number of pyramid levels (0 for none)
+        reserved    up to header_len
+    chunks, each the same size (see chunk_dtype())
+        seq         8 bytes     sequence number of the chunk's first sample
+        count       4 bytes     samples in the chunk (chunk_len except for
+                                the last chunk)
+        reserved    4 bytes
+        time        8 bytes     float, time.time() of the chunk's first sample
+        samples     2 * chunk_len uint16, all of m_vraw then all of m_araw
+
+The chunk headers are the time index: one (seq, time) pair per chunk, so a
+time can be found with a binary search over the chunks and gaps in the stream
+(device unplugged, egram stopped) show up as jumps in time.
+
+Pyramid level k is stored next to the recording in "<path>.x<factor**k>" 
+(session.egram.x8, session.egram.x64, ...) as an array of bins, see
+pyramid_dtype (the last bin of a level may cover fewer samples).
+
+MODULE SECRETS
+--------------
+    - Every chunk is the same size, so the chunks are one NumPy structured
+      array laid over the mmap (np.frombuffer, no copy). Reading a range of
+      samples only touches the chunks that hold it.
+    - The recorder fills one chunk in memory and writes it when it is full,
+      so the disk is written once per chunk_len samples (4 s at 1 kHz). A
+      crash loses at most the chunk being filled, and a chunk cut off by a
+      crash is ignored when the file is opened.
+    - Each pyramid level is built from the complete bins of the level below
+      as they are produced, keeping fewer than pyramid_factor bins per level
+      back until their bin is complete. Building the whole pyramid costs 
+      about as much as one pass over the samples.
+"""
+
+import argparse
+import mmap
+import struct
+import threading
+import time
+import numpy as np
+
+import comms
+
+magic = b"PMEGRAM1"
+header = struct.Struct("<8sddIIII")
+header_len = 64
+default_chunk_len = 4096
+default_sample_rate = 1000.0 / comms.k_streamPeriod # samples per second
+default_pyramid_factor = 8
+default_pyramid_levels = 6  # bins of 262144 samples (4.4 minutes) at the top
+
+# one pyramid bin: min and max of each channel
+pyramid_dtype = np.dtype([("min", "<u2", (2,)), ("max", "<u2", (2,))])
+
+""" Path of the pyramid level file with bins of bin_len samples """
+def level_path(path, bin_len):
+    return f"{path}.x{bin_len}"
+
+""" NumPy dtype of one chunk of a recording """
+def chunk_dtype(chunk_len, channels=2):
+    return np.dtype([("seq", "<u8"), ("count", "<u4"), ("reserved", "<u4"),
+                     ("time", "<f8"), ("samples", "<u2", (channels, chunk_len))])
+
+"""
+Builds the min/max pyramid of a recording as samples arrive and appends the 
+bins of each level to its own file.
+"""
+class PyramidBuilder():
+    def __init__(self, path, factor=default_pyramid_factor, 
+                 levels=default_pyramid_levels):
+        self.factor = factor
+        self.files = [open(level_path(path, factor ** level), "wb")
+                      for level in range(1, levels + 1)]
+        # (mins, maxs) of the level below that don't fill a bin yet
+        empty = np.empty((2, 0), dtype=np.uint16)
+        self.carry = [(empty, empty)] * levels
+
+    """ Add samples, a (2, n) array (row 0 is m_vraw, row 1 is m_araw) """
+    def write(self, samples):
+        mins, maxs = samples, samples
+        for level, f in enumerate(self.files):
+            carry_mins, carry_maxs = self.carry[level]
+            mins = np.concatenate((carry_mins, mins), axis=1)
+            maxs = np.concatenate((carry_maxs, maxs), axis=1)
+            num_bins = mins.shape[1] // self.factor
+            complete = num_bins * self.factor
+            self.carry[level] = (mins[:, complete:], maxs[:, complete:])
+            if num_bins == 0:
+                break   # no new bins for the levels above either
+            mins = mins[:, :complete].reshape(2, num_bins, self.factor).min(2)
+            maxs = maxs[:, :complete].reshape(2, num_bins, self.factor).max(2)
+            f.write(self.bins(mins, maxs).tobytes())
+
+    """ Structured array (pyramid_dtype) of the bins """
+    def bins(self, mins, maxs):
+        bins = np.empty(mins.shape[1], dtype=pyramid_dtype)
+        bins["min"] = mins.T
+        bins["max"] = maxs.T
+        return bins
+
+    """ Write the incomplete last bin of every level and close the files. """
+    def close(self):
+        mins = maxs = np.empty((2, 0), dtype=np.uint16)
+        for level, f in enumerate(self.files):
+            carry_mins, carry_maxs = self.carry[level]
+            # the last bin of this level includes the last bin of the one below
+            mins = np.concatenate((carry_mins, mins), axis=1)
+            maxs = np.concatenate((carry_maxs, maxs), axis=1)
+            if mins.shape[1] > 0:
+                mins = mins.min(axis=1, keepdims=True)
+                maxs = maxs.max(axis=1, keepdims=True)
+                f.write(self.bins(mins, maxs).tobytes())
+            f.close()
+
+"""
+Streams egram samples to a new recording file at path (and its pyramid to the
+level files next to it). Add it to an EgramThread with add_recorder(), or 
+call write() with batches of samples. Thread safe.
+"""
+class EgramRecorder():
+    def __init__(self, path, sample_rate=default_sample_rate,
+                 chunk_len=default_chunk_len, start_time=None,
+                 pyramid_factor=default_pyramid_factor,
+                 pyramid_levels=default_pyramid_levels):
+        if start_time is None:
+            start_time = time.time()
+        self.path = path
+        self.sample_rate = sample_rate
+        self.chunk_len = chunk_len
+        self.start_time = start_time
+        self.lock = threading.Lock()
+        self.chunk = np.zeros(1, dtype=chunk_dtype(chunk_len))
+        self.fill = 0   # samples in self.chunk
+        self.seq = 0    # sequence number of the next sample
+
+        self.file = open(path, "wb")
+        self.file.write(header.pack(magic, sample_rate, start_time, chunk_len,
+                                    len(comms.egram_channels),
+                                    pyramid_factor, pyramid_levels).ljust(
+                                                        header_len, b"\0"))
+        self.pyramid = PyramidBuilder(path, pyramid_factor, pyramid_levels)
+
+    """ Add a batch of samples (one array-like per channel, same length). """
+    def write(self, m_vraw, m_araw):
+        with self.lock:
+            if self.file is None:
+                return
+            num_samples = len(m_vraw)
+            now = time.time()
+            samples = self.chunk["samples"][0]
+            pos = 0
+            while pos < num_samples:
+                if self.fill == 0:
+                    # the newest sample of the batch arrived just now
+                    self.chunk["seq"] = self.seq
+                    self.chunk["time"] = now - (num_samples - 1 - pos) \
+                                               / self.sample_rate
+                size = min(num_samples - pos, self.chunk_len - self.fill)
+                samples[0, self.fill:self.fill + size] = m_vraw[pos:pos + size]
+                samples[1, self.fill:self.fill + size] = m_araw[pos:pos + size]
+                self.fill = self.fill + size
+                self.seq = self.seq + size
+                pos = pos + size
+                if self.fill == self.chunk_len:
+                    self.write_chunk()
+            self.pyramid.write(np.vstack((m_vraw, m_araw)))
+
+    """ Append the current chunk to the file and start a new one. """
+    def write_chunk(self):
+        self.chunk["count"] = self.fill
+        self.chunk["samples"][0, :, self.fill:] = 0
+        self.file.write(self.chunk.tobytes())
+        self.fill = 0
+
+    """ Write the last (partial) chunk and close the file. """
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            if self.fill > 0:
+                self.write_chunk()
+            self.file.close()
+            self.file = None
+            self.pyramid.close()
+
+"""
+Read-only view of a recording file through mmap.
+self.chunks is a structured array (see chunk_dtype()) over the file, and
+channel() gives a (chunks, chunk_len) view of one channel. Neither copies
+anything. read() copies just the samples in a range.
+self.levels[k - 1] is pyramid level k (a pyramid_dtype array over its file).
+"""
+class EgramRecording():
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < header_len:
+            self.map.close()
+            raise ValueError(f"{path} is not an egram recording")
+        file_magic, self.sample_rate, self.start_time, self.chunk_len, \
+            self.channels, self.pyramid_factor, pyramid_levels = \
+            header.unpack_from(self.map)
+        if file_magic != magic:
+            self.map.close()
+            raise ValueError(f"{path} is not an egram recording")
+
+        dtype = chunk_dtype(self.chunk_len, self.channels)
+        num_chunks = (len(self.map) - header_len) // dtype.itemsize
+        self.chunks = np.frombuffer(self.map, dtype=dtype, count=num_chunks,
+                                    offset=header_len)
+        self.num_samples = 0
+        if num_chunks > 0:
+            self.num_samples = int(self.chunks["seq"][-1] +
+                                   self.chunks["count"][-1])
+
+        self.level_maps = []
+        self.levels = []
+        for level in range(1, pyramid_levels + 1):
+            bin_len = self.pyramid_factor ** level
+            try:
+                with open(level_path(path, bin_len), "rb") as f:
+                    level_map = mmap.mmap(f.fileno(), 0, 
+                                          access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                break   # missing (or empty) level file
+            num_bins = len(level_map) // pyramid_dtype.itemsize
+            self.level_maps.append(level_map)
+            self.levels.append(np.frombuffer(level_map, dtype=pyramid_dtype,
+                                             count=num_bins))
+
+    """ Number of samples per channel """
+    def __len__(self):
+        return self.num_samples
+
+    """ Length of the recording in seconds (at the sample rate) """
+    def duration(self):
+        return self.num_samples / self.sample_rate
+
+    """ (chunks, chunk_len) view of the channel ("m_vraw" or "m_araw") """
+    def channel(self, name):
+        index = comms.egram_channels.index(name)
+        return self.chunks["samples"][:, index, :]
+
+    """ Copies of samples start to stop of both channels: (m_vraw, m_araw) """
+    def read(self, start, stop):
+        start = max(0, start)
+        stop = min(stop, self.num_samples)
+        if stop <= start:
+            empty = np.empty(0, dtype=np.uint16)
+            return empty, empty
+
+        first = start // self.chunk_len
+        last = (stop - 1) // self.chunk_len + 1
+        block = self.chunks["samples"][first:last]
+        samples = block.transpose(1, 0, 2).reshape(self.channels, -1)
+        offset = start - first * self.chunk_len
+        # always copy: a range inside one chunk is a view into the mmap, which
+        # would keep close() from unmapping the file
+        samples = samples[:, offset:offset + stop - start]
+        return samples[0].copy(), samples[1].copy()
+
+    """ Index of the first sample at or after the wall clock time t """
+    def seq_at(self, t):
+        if len(self.chunks) == 0:
+            return 0
+        times = self.chunks["time"]
+        chunk = max(np.searchsorted(times, t, side="right") - 1, 0)
+        # wall clock times are large, allow for float error in the difference
+        offset = int(np.ceil((t - times[chunk]) * self.sample_rate - 1e-3))
+        offset = min(max(offset, 0), int(self.chunks["count"][chunk]))
+        return int(self.chunks["seq"][chunk]) + offset
+
+    """
+    The pyramid level to draw samples_per_column samples per pixel column:
+    the one with the largest bins that still has a bin per column (0 means 
+    the samples themselves).
+    """
+    def level_for(self, samples_per_column):
+        level = 0
+        while (level < len(self.levels) and 
+               self.pyramid_factor ** (level + 1) <= samples_per_column):
+            level = level + 1
+        return level
+
+    """
+    Samples start to stop reduced for a plot columns pixels wide. Returns
+    (xs, m_vraw, m_araw) where xs are sample indices. Zoomed out, each bin of 
+    the pyramid level from level_for() gives its min and max (interleaved, 
+    both at the middle of the bin), so spikes are never lost. Zoomed in, the
+    samples themselves are returned.
+    """
+    def envelope(self, start, stop, columns):
+        start = max(0, start)
+        stop = min(stop, self.num_samples)
+        level = self.level_for((stop - start) / max(columns, 1))
+        if level == 0:
+            m_vraw, m_araw = self.read(start, stop)
+            return np.arange(start, start + len(m_vraw)), m_vraw, m_araw
+
+        bin_len = self.pyramid_factor ** level
+        bins = self.levels[level - 1][start // bin_len:-(-stop // bin_len)]
+        first = start // bin_len * bin_len
+        centres = first + bin_len * np.arange(len(bins)) + (bin_len - 1) / 2
+        xs = np.repeat(np.minimum(centres, self.num_samples - 1), 2)
+        ys = np.empty((2, 2 * len(bins)), dtype=np.uint16)
+        ys[:, 0::2] = bins["min"].T
+        ys[:, 1::2] = bins["max"].T
+        return xs, ys[0], ys[1]
+
+    """ Wall clock time of sample seq (from the time index) """
+    def time_of(self, seq):
+        chunk = seq // self.chunk_len
+        offset = seq - chunk * self.chunk_len
+        return float(self.chunks["time"][chunk]) + offset / self.sample_rate
+
+    """
+    Release the file. Arrays from channel() or self.chunks must not be used
+    after this (arrays from read() are copies and stay valid).
+    """
+    def close(self):
+        self.chunks = None
+        self.levels = []
+        for file_map in [self.map] + self.level_maps:
+            try:
+                file_map.close()
+            except BufferError:
+                pass # views still exist, the map is freed with the last one
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Egram recording summary")
+    parser.add_argument("file")
+    args = parser.parse_args()
+
+    session = EgramRecording(args.file)
+    start = time.strftime("%Y-%m-%d %H:%M:%S",
+                          time.localtime(session.start_time))
+    print(f"started {start}, {len(session)} samples at "
+          f"{session.sample_rate:g} Hz ({session.duration():.1f} s) in "
+          f"{len(session.chunks)} chunks of {session.chunk_len}")
+    if len(session.chunks) > 1:
+        gaps = np.diff(session.chunks["time"]) - \
+               session.chunk_len / session.sample_rate
+        print(f"largest gap between chunks {gaps.max():.3f} s")
+    session.close()
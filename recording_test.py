@@ -0,0 +1,194 @@
+import time
+import numpy as np
+import pytest       # run pytest in the directory to run all tests in the file
+import comms
+import recording
+import simulator
+
+""" Record the samples in random size batches """
+def record(path, m_vraw, m_araw, chunk_len=100, seed=0):
+    rng = np.random.default_rng(seed)
+    recorder = recording.EgramRecorder(path, chunk_len=chunk_len,
+                                       start_time=1000.0)
+    start = 0
+    while start < len(m_vraw):
+        stop = start + rng.integers(1, 3 * chunk_len)
+        recorder.write(m_vraw[start:stop], m_araw[start:stop])
+        start = stop
+    recorder.close()
+
+def samples(num_samples):
+    return simulator.synthetic_egram(np.arange(num_samples), 1000, noise=50,
+                                     rng=np.random.default_rng(1))
+
+class TestEgramRecording():
+    def test_round_trip(self, tmp_path):
+        m_vraw, m_araw = samples(1234)
+        record(tmp_path / "test.egram", m_vraw, m_araw)
+
+        session = recording.EgramRecording(tmp_path / "test.egram")
+        assert len(session) == 1234
+        assert session.sample_rate == 1000
+        assert session.start_time == 1000.0
+        assert len(session.chunks) == 13
+        assert session.chunks["seq"].tolist() == list(range(0, 1300, 100))
+        assert session.chunks["count"][-1] == 34
+
+        for start, stop in [(0, 1234), (50, 60), (99, 101), (1200, 5000)]:
+            read_vraw, read_araw = session.read(start, stop)
+            assert read_vraw.tolist() == m_vraw[start:stop].tolist()
+            assert read_araw.tolist() == m_araw[start:stop].tolist()
+        session.close()
+
+    def test_read_copies(self, tmp_path):
+        m_vraw, m_araw = samples(1000)
+        record(tmp_path / "test.egram", m_vraw, m_araw)
+
+        session = recording.EgramRecording(tmp_path / "test.egram")
+        # inside one chunk, where a slice would be a view into the mmap
+        read_vraw, read_araw = session.read(50, 60)
+        assert not np.shares_memory(read_vraw, session.chunks)
+        assert not np.shares_memory(read_araw, session.chunks)
+        session.close()
+        assert read_vraw.tolist() == m_vraw[50:60].tolist()
+
+    def test_zero_copy(self, tmp_path):
+        m_vraw, m_araw = samples(1000)
+        record(tmp_path / "test.egram", m_vraw, m_araw)
+
+        session = recording.EgramRecording(tmp_path / "test.egram")
+        view = session.channel("m_araw")
+        assert view.shape == (10, 100)
+        assert not view.flags.owndata
+        assert view.base is not None
+        assert view.ravel().tolist() == m_araw.tolist()
+
+    def test_time_index(self, tmp_path):
+        recorder = recording.EgramRecorder(tmp_path / "test.egram",
+                                           chunk_len=100)
+        m_vraw, m_araw = samples(300)
+        recorder.write(m_vraw[:200], m_araw[:200])
+        time.sleep(0.3) # a gap in the stream
+        recorder.write(m_vraw[200:], m_araw[200:])
+        recorder.close()
+
+        session = recording.EgramRecording(tmp_path / "test.egram")
+        times = session.chunks["time"]
+        assert times[1] - times[0] == pytest.approx(0.1)
+        assert times[2] - times[1] == pytest.approx(0.3, abs=0.05)
+        assert session.seq_at(times[0]) == 0
+        assert session.seq_at(times[0] + 0.15) == 150
+        assert session.seq_at(times[2] - 0.1) == 200  # in the gap
+        assert session.seq_at(times[2] + 0.05) == 250
+        assert session.time_of(250) == pytest.approx(times[2] + 0.05)
+
+    def test_cut_off_chunk(self, tmp_path):
+        m_vraw, m_araw = samples(250)
+        record(tmp_path / "test.egram", m_vraw, m_araw)
+        path = tmp_path / "test.egram"
+        path.write_bytes(path.read_bytes()[:-10])
+
+        session = recording.EgramRecording(path)
+        assert len(session) == 200
+
+    def test_not_a_recording(self, tmp_path):
+        path = tmp_path / "test.egram"
+        path.write_bytes(bytes(100))
+        with pytest.raises(ValueError):
+            recording.EgramRecording(path)
+
+class StreamConnection():
+    def __init__(self, stream):
+        self.stream = stream
+        self.pos = 0
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.stream) - self.pos)
+        if size == 0:
+            time.sleep(0.001)
+        buffer[:size] = self.stream[self.pos:self.pos + size]
+        self.pos = self.pos + size
+        return size
+
+class TestEgramThreadRecorder():
+    def test_records_every_sample(self, tmp_path):
+        m_vraw, m_araw = samples(5000)
+        stream = simulator.egram_frames(m_vraw, m_araw).tobytes()
+        connection = StreamConnection(stream)
+        # a small ring that nobody reads, the recording still gets everything
+        thread = comms.EgramThread(16, connection=connection, capacity=100)
+        recorder = recording.EgramRecorder(tmp_path / "test.egram")
+        thread.add_recorder(recorder)
+        thread.start()
+        while connection.pos < len(stream):
+            time.sleep(0.01)
+        thread.quit()
+        thread.join()
+        recorder.close()
+
+        assert thread.dropped() == 4900
+        session = recording.EgramRecording(tmp_path / "test.egram")
+        read_vraw, read_araw = session.read(0, len(session))
+        assert read_vraw.tolist() == m_vraw.tolist()
+        assert read_araw.tolist() == m_araw.tolist()
+
+class TestPyramid():
+    def test_levels_match_batch_min_max(self, tmp_path):
+        m_vraw, m_araw = samples(5000)
+        path = tmp_path / "test.egram"
+        recorder = recording.EgramRecorder(path, chunk_len=100,
+                                           pyramid_factor=4, pyramid_levels=3)
+        rng = np.random.default_rng(3)
+        start = 0
+        while start < len(m_vraw):
+            stop = start + rng.integers(1, 50)
+            recorder.write(m_vraw[start:stop], m_araw[start:stop])
+            start = stop
+        recorder.close()
+
+        session = recording.EgramRecording(path)
+        assert len(session.levels) == 3
+        for level, bins in enumerate(session.levels, 1):
+            bin_len = 4 ** level
+            assert len(bins) == -(-5000 // bin_len)
+            for i in [0, 1, len(bins) - 1]:
+                expected = m_vraw[i * bin_len:(i + 1) * bin_len]
+                assert bins["min"][i, 0] == expected.min()
+                assert bins["max"][i, 0] == expected.max()
+                expected = m_araw[i * bin_len:(i + 1) * bin_len]
+                assert bins["min"][i, 1] == expected.min()
+                assert bins["max"][i, 1] == expected.max()
+
+    def test_envelope(self, tmp_path):
+        m_vraw, m_araw = samples(100000)
+        m_vraw[54321] = 4900    # a spike that must survive the zoom out
+        path = tmp_path / "test.egram"
+        record(path, m_vraw, m_araw, chunk_len=4096)
+        session = recording.EgramRecording(path)
+
+        assert session.level_for(5) == 0
+        assert session.level_for(8) == 1
+        assert session.level_for(100) == 2
+        assert session.level_for(1e9) == 6
+
+        xs, env_vraw, env_araw = session.envelope(0, len(session), 500)
+        assert 500 <= len(xs) // 2 <= 8 * 500
+        assert env_vraw.max() == 4900
+        assert env_araw.min() == m_araw.min()
+        assert xs[0] >= 0 and xs[-1] < len(session)
+
+        xs, env_vraw, env_araw = session.envelope(54000, 54500, 500)
+        assert xs.tolist() == list(range(54000, 54500))
+        assert env_vraw.tolist() == m_vraw[54000:54500].tolist()
+
+    def test_no_pyramid(self, tmp_path):
+        m_vraw, m_araw = samples(1000)
+        path = tmp_path / "test.egram"
+        recorder = recording.EgramRecorder(path, pyramid_levels=0)
+        recorder.write(m_vraw, m_araw)
+        recorder.close()
+
+        session = recording.EgramRecording(path)
+        assert session.levels == []
+        xs, env_vraw, env_araw = session.envelope(0, 1000, 10)
+        assert env_vraw.tolist() == m_vraw.tolist()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+In the GUI process (or anything that owns the port):
+    import comms, shared_egram
+    reader = comms.EgramThread(16)
+    publisher = shared_egram.EgramPublisher("pacemaker_egram")
+    reader.add_recorder(publisher)
+    ...
+    publisher.close()
+
+In any other process on the machine:
+    import shared_egram
+    subscriber = shared_egram.EgramSubscriber("pacemaker_egram")
+    data = subscriber.get_data("numpy")    # same form as EgramThread
+    subscriber.close()
+
+python3 shared_egram.py NAME
+    Attach to a published stream and print the sample rate it gets.
+
+MODULE PURPOSE
+--------------
+Broadcast of the egram stream to other processes (analysis, logging) through
+a multiprocessing.shared_memory ring, so they don't have to open the serial
+port or get the samples through a socket. Any number of subscribers can
+attach by name, each with its own cursor, at no cost to the publisher.
+
+Shared memory layout:
+    header, header_len bytes of int64
+        [0] write sequence (seqlock): odd while a write is in progress
+        [1] head: sequence number of the next sample to be written
+        [2] capacity: samples per channel in the ring
+        [3] closed: 1 once the publisher has closed
+        [4] sample_rate (float64)
+    samples, (2, capacity) uint16, sample seq is at index seq % capacity
+
+MODULE SECRETS
+--------------
+    - The publisher is the only writer, so it needs no lock. It makes the
+      write sequence odd, writes the samples and the new head, then makes it
+      even again (a seqlock).
+    - Readers never block the publisher. A reader takes the head while the
+      write sequence is even, copies the samples it hasn't read and checks
+      the write sequence again. If a write happened in the meantime, the copy
+      is still good unless the writer could have reached the copied samples
+      (head - capacity moved past the start of the copy); otherwise it tries
+      again. A reader that falls more than capacity samples behind loses the
+      oldest samples (counted in self.dropped).
+    - Samples are always copied out of shared memory, since the publisher
+      can overwrite them at any time.
+    - Attaching from another process registers the block with Python's
+      resource tracker, which would destroy it when that process exits
+      (Python < 3.13). Subscribers unregister it so only the publisher
+      removes the block.
+"""
+
+import argparse
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+import numpy as np
+
+import comms
+import recording
+
+header_len = 8 # int64 fields
+seq_field = 0
+head_field = 1
+capacity_field = 2
+closed_field = 3
+rate_field = 4
+read_retries = 100
+
+""" NumPy views of the header and samples in the shared memory block shm """
+def ring_views(shm, capacity):
+    header = np.ndarray((header_len,), dtype=np.int64, buffer=shm.buf)
+    samples = np.ndarray((len(comms.egram_channels), capacity),
+                         dtype=np.uint16, buffer=shm.buf,
+                         offset=header.nbytes)
+    return header, samples
+
+"""
+Owner of the shared ring. Add it to an EgramThread with add_recorder() (or
+call write()) to publish every decoded batch. name=None picks a unique name
+(see self.name).
+"""
+class EgramPublisher():
+    def __init__(self, name=None, capacity=comms.egram_capacity,
+                 sample_rate=recording.default_sample_rate):
+        size = header_len * 8 + len(comms.egram_channels) * capacity * 2
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=size)
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.header, self.samples = ring_views(self.shm, capacity)
+        self.header[:] = 0
+        self.header[capacity_field] = capacity
+        self.header[rate_field:rate_field + 1].view(np.float64)[0] = sample_rate
+
+    """ Add a batch of samples (one array-like per channel, same length). """
+    def write(self, m_vraw, m_araw):
+        header = self.header
+        if header is None:
+            return
+        num_samples = len(m_vraw)
+        head = int(header[head_field])
+        if num_samples > self.capacity:
+            head = head + num_samples - self.capacity
+            m_vraw = m_vraw[-self.capacity:]
+            m_araw = m_araw[-self.capacity:]
+            num_samples = self.capacity
+
+        header[seq_field] = header[seq_field] + 1   # odd: writing
+        pos = head % self.capacity
+        first = min(num_samples, self.capacity - pos)
+        self.samples[0, pos:pos + first] = m_vraw[:first]
+        self.samples[1, pos:pos + first] = m_araw[:first]
+        self.samples[0, :num_samples - first] = m_vraw[first:]
+        self.samples[1, :num_samples - first] = m_araw[first:]
+        header[head_field] = head + num_samples
+        header[seq_field] = header[seq_field] + 1   # even: done
+
+    """ Mark the stream closed and remove the shared memory block. """
+    def close(self):
+        if self.header is None:
+            return
+        self.header[closed_field] = 1
+        self.header = None
+        self.samples = None
+        self.shm.close()
+        self.shm.unlink()
+
+"""
+Reader of a published ring, attached by name from any process. Starts with
+the samples published after it attached.
+"""
+class EgramSubscriber():
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        # the publisher owns the block, don't let this process remove it
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+        capacity = int(np.ndarray((header_len,), dtype=np.int64,
+                                  buffer=self.shm.buf)[capacity_field])
+        self.capacity = capacity
+        self.header, self.samples = ring_views(self.shm, capacity)
+        self.sample_rate = float(self.header[rate_field:rate_field + 1]
+                                 .view(np.float64)[0])
+        self.seq = int(self.header[head_field])
+        self.dropped = 0
+
+    """ True once the publisher has closed the stream """
+    def closed(self):
+        return bool(self.header[closed_field])
+
+    """
+    Copy the samples published since the last call. Returns (seq, samples)
+    with samples a (2, n) uint16 array (row 0 is m_vraw, row 1 is m_araw).
+    """
+    def read(self):
+        header = self.header
+        for attempt in range(read_retries):
+            write_seq = int(header[seq_field])
+            if write_seq % 2 == 1:
+                time.sleep(0)   # a write is in progress
+                continue
+            head = int(header[head_field])
+            start = max(self.seq, head - self.capacity)
+            begin = start % self.capacity
+            end = begin + head - start
+            if end <= self.capacity:
+                samples = self.samples[:, begin:end].copy()
+            else:
+                samples = np.concatenate((self.samples[:, begin:],
+                                          self.samples[:, :end - self.capacity]),
+                                         axis=1)
+
+            # the copy is good if no write could have reached it
+            write_seq_after = int(header[seq_field])
+            if write_seq_after != write_seq:
+                reserved = int(header[head_field])
+                if write_seq_after % 2 == 1:
+                    reserved = reserved + self.capacity # size unknown
+                if reserved - self.capacity > start:
+                    continue
+
+            self.dropped = self.dropped + start - self.seq
+            self.seq = head
+            return start, samples
+        raise TimeoutError("could not get a consistent read of the ring")
+
+    """ Same as EgramThread.get_data(), but the samples are always copies """
+    def get_data(self, form="numpy"):
+        seq, samples = self.read()
+        return comms.samples_dict(seq, samples, form)
+
+    def close(self):
+        self.header = None
+        self.samples = None
+        self.shm.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared egram subscriber")
+    parser.add_argument("name")
+    args = parser.parse_args()
+
+    subscriber = EgramSubscriber(args.name)
+    while not subscriber.closed():
+        start = time.monotonic()
+        num_samples = 0
+        while time.monotonic() - start < 1:
+            num_samples = num_samples + len(subscriber.get_data()["m_vraw"])
+            time.sleep(0.01)
+        print(f"{num_samples} samples/s, {subscriber.dropped} dropped")
+    subscriber.close()
@@ -0,0 +1,111 @@
+import multiprocessing
+import threading
+import numpy as np
+import pytest       # run pytest in the directory to run all tests in the file
+import shared_egram
+
+@pytest.fixture
+def publisher():
+    publisher = shared_egram.EgramPublisher(capacity=1000, sample_rate=500)
+    yield publisher
+    publisher.close()
+
+""" Read from the ring published as name in another process """
+def read_in_process(name, queue):
+    subscriber = shared_egram.EgramSubscriber(name)
+    queue.put("attached")
+    total = 0
+    while total < 300:
+        total = total + len(subscriber.get_data()["m_vraw"])
+    queue.put((total, subscriber.dropped))
+    subscriber.close()
+
+class TestSharedEgram():
+    def test_round_trip(self, publisher):
+        subscriber = shared_egram.EgramSubscriber(publisher.name)
+        assert subscriber.capacity == 1000
+        assert subscriber.sample_rate == 500
+
+        publisher.write([1, 2, 3], [4, 5, 6])
+        data = subscriber.get_data("list")
+        assert data == {"seq":0, "m_vraw":[1, 2, 3], "m_araw":[4, 5, 6]}
+        assert len(subscriber.get_data()["m_vraw"]) == 0
+
+        publisher.write(np.arange(10, 12), np.arange(20, 22))
+        data = subscriber.get_data("numpy")
+        assert data["seq"] == 3
+        assert data["m_vraw"].tolist() == [10, 11]
+        subscriber.close()
+
+    def test_subscribers_have_own_cursor(self, publisher):
+        first = shared_egram.EgramSubscriber(publisher.name)
+        publisher.write([1], [1])
+        second = shared_egram.EgramSubscriber(publisher.name)
+        publisher.write([2], [2])
+        assert first.get_data("list")["m_vraw"] == [1, 2]
+        assert second.get_data("list")["m_vraw"] == [2]
+        first.close()
+        second.close()
+
+    def test_wrap_and_dropped(self, publisher):
+        subscriber = shared_egram.EgramSubscriber(publisher.name)
+        samples = np.arange(2500, dtype=np.uint16)
+        for start in range(0, 2500, 700):
+            publisher.write(samples[start:start + 700],
+                            samples[start:start + 700])
+        data = subscriber.get_data()
+        assert data["seq"] == 1500
+        assert data["m_vraw"].tolist() == list(range(1500, 2500))
+        assert subscriber.dropped == 1500
+        subscriber.close()
+
+    def test_batch_bigger_than_ring(self, publisher):
+        subscriber = shared_egram.EgramSubscriber(publisher.name)
+        samples = np.arange(1500, dtype=np.uint16)
+        publisher.write(samples, samples)
+        data = subscriber.get_data()
+        assert data["seq"] == 500
+        assert data["m_araw"].tolist() == list(range(500, 1500))
+        subscriber.close()
+
+    def test_consistent_while_writing(self, publisher):
+        # the value of every sample is its sequence number
+        subscriber = shared_egram.EgramSubscriber(publisher.name)
+        def write():
+            for start in range(0, 200000, 97):
+                seq = np.arange(start, start + 97) % 65536
+                publisher.write(seq, seq)
+        writer = threading.Thread(target=write)
+        writer.start()
+        writing = True
+        while writing:
+            writing = writer.is_alive()
+            data = subscriber.get_data()
+            expected = np.arange(data["seq"],
+                                 data["seq"] + len(data["m_vraw"])) % 65536
+            assert np.array_equal(data["m_vraw"], expected)
+            assert np.array_equal(data["m_araw"], expected)
+        assert subscriber.seq == publisher.header[shared_egram.head_field]
+        subscriber.close()
+
+    def test_closed(self):
+        publisher = shared_egram.EgramPublisher(capacity=10)
+        subscriber = shared_egram.EgramSubscriber(publisher.name)
+        assert not subscriber.closed()
+        publisher.close()
+        assert subscriber.closed()
+        subscriber.close()
+        publisher.write([1], [1])    # ignored once closed
+
+    def test_other_process(self, publisher):
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        process = context.Process(target=read_in_process,
+                                  args=(publisher.name, queue))
+        process.start()
+        assert queue.get(timeout=30) == "attached"
+        for i in range(3):
+            publisher.write(np.full(100, i), np.full(100, i))
+        assert queue.get(timeout=30) == (300, 0)
+        process.join(timeout=10)
+        assert process.exitcode == 0
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+USAGE
+-----
+python3 simulator.py [--rate 1000] [--noise 0] [--garbage 0] [--link PATH]
+
+    Prints the name of the simulator's serial port. Point comms at it with
+    comms.port = "<name>" (or pass it to comms.get_connection()).
+
+from simulator import PacemakerSimulator
+sim = PacemakerSimulator(rate=1000)
+sim.start()
+... talk to sim.port_name with comms ...
+sim.quit()
+
+MODULE PURPOSE
+--------------
+Stand-in for the Pacemaker so that comms.py can be exercised without a board on
+/dev/ttyACM0 (load testing, reproducing throughput problems, running the egram
+decoder on CI machines).
+
+The simulator opens a pseudo-terminal and speaks the protocol in
+packet_specification.txt on the master side. The host opens the slave side
+just like the real serial port.
+    - k_egram starts streaming synthetic egram frames at self.rate frames per
+      second (1 kHz is the real device, up to 50 kHz for load tests)
+    - k_estop stops the stream
+    - k_pparams stores the data section (mode byte, parameters, checksum)
+    - k_echo answers with a k_echo header followed by the stored data section
+      (nothing is sent if no parameters have been received yet)
+
+Faults can be injected to test the host stack:
+    - noise: standard deviation of Gaussian noise added to the samples
+    - garbage: probability that random bytes are inserted before a frame
+    - unplug()/plug(): close the port and open a new one, like pulling the
+      USB cable. Give a link path to get a stable port name that follows the
+      new port across plug() calls.
+
+MODULE SECRETS
+--------------
+    - Frames are generated in NumPy batches for all the samples that are due
+      since the stream started, so high rates don't need a Python loop per
+      frame.
+    - The master side is nonblocking. If the host doesn't read, bytes queue up
+      in self.out up to out_limit bytes and whole frames are dropped after
+      that (counted in self.dropped_frames), like the device's USB buffer.
+"""
+
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+import numpy as np
+
+import comms
+
+"""
+Synthetic egram samples for sequence numbers seq at rate samples per second.
+Returns (m_vraw, m_araw) as uint16 arrays: a P wave on the atrial channel
+followed by a QRS spike on the ventricular channel once per beat.
+"""
+def synthetic_egram(seq, rate, heart_rate=60, noise=0, rng=None):
+    t = np.asarray(seq, dtype=float) / rate
+    phase = (t * heart_rate / 60) % 1.0
+    m_araw = 2000 + 1200 * np.exp(-((phase - 0.05) / 0.02) ** 2)
+    m_vraw = 2000 + 2500 * np.exp(-((phase - 0.21) / 0.008) ** 2) \
+                  - 600 * np.exp(-((phase - 0.24) / 0.015) ** 2)
+    if noise > 0:
+        if rng is None:
+            rng = np.random.default_rng()
+        m_vraw = m_vraw + rng.normal(0, noise, len(t))
+        m_araw = m_araw + rng.normal(0, noise, len(t))
+    m_vraw = np.clip(m_vraw, 0, 0xffff).astype(np.uint16)
+    m_araw = np.clip(m_araw, 0, 0xffff).astype(np.uint16)
+    return m_vraw, m_araw
+
+""" Egram frames (SYNC SOH m_vraw m_araw, big endian) for the samples """
+def egram_frames(m_vraw, m_araw):
+    frames = np.empty((len(m_vraw), comms.egram_frame_len), dtype=np.uint8)
+    frames[:, 0] = comms.k_sync
+    frames[:, 1] = comms.k_soh
+    frames[:, 2] = m_vraw >> 8
+    frames[:, 3] = m_vraw & 0xff
+    frames[:, 4] = m_araw >> 8
+    frames[:, 5] = m_araw & 0xff
+    return frames
+
+""" 
+Bytes of frames (from egram_frames()) with 1 to 7 random junk bytes inserted 
+in front of each frame with probability garbage.
+"""
+def with_garbage(frames, garbage, rng):
+    if garbage <= 0:
+        return frames.tobytes()
+    stream = bytearray()
+    start = 0
+    for i in np.flatnonzero(rng.random(len(frames)) < garbage):
+        junk = rng.integers(0, 256, rng.integers(1, 8))
+        stream.extend(frames[start:i].tobytes())
+        stream.extend(junk.astype(np.uint8).tobytes())
+        start = i
+    stream.extend(frames[start:].tobytes())
+    return bytes(stream)
+
+class PacemakerSimulator(threading.Thread):
+    out_limit = 1 << 16 # bytes queued for a host that isn't reading
+
+    def __init__(self, rate=1000, noise=0, garbage=0, link=None, seed=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.rate = rate
+        self.noise = noise
+        self.garbage = garbage
+        self.link = link
+        self.rng = np.random.default_rng(seed)
+
+        self.running = True
+        self.streaming = False
+        self.stream_start = None
+        self.seq = 0                # sequence number of the next sample
+        self.params = None          # last data section received
+        self.commands = []          # fn codes received, oldest first
+        self.dropped_frames = 0
+        self.rx = bytearray()
+        self.out = bytearray()
+        self.lock = threading.Lock()
+        self.master_fd = None
+        self.slave_fd = None
+        self.plug()
+
+    """ Open a new pseudo-terminal (the simulated device is plugged in). """
+    def plug(self):
+        with self.lock:
+            master_fd, slave_fd = pty.openpty()
+            tty.setraw(master_fd)
+            tty.setraw(slave_fd)
+            os.set_blocking(master_fd, False)
+            self.master_fd = master_fd
+            # keep the slave open so the port survives the host closing it
+            self.slave_fd = slave_fd
+            self.port_name = os.ttyname(slave_fd)
+            if self.link is not None:
+                if os.path.lexists(self.link):
+                    os.remove(self.link)
+                os.symlink(self.port_name, self.link)
+                self.port_name = self.link
+            self.rx = bytearray()
+            self.out = bytearray()
+
+    """ Close the pseudo-terminal (the simulated device is unplugged). """
+    def unplug(self):
+        with self.lock:
+            for fd in (self.master_fd, self.slave_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.master_fd = None
+            self.slave_fd = None
+            self.streaming = False
+
+    """ Stop the simulator thread and close the port. """
+    def quit(self):
+        self.running = False
+        self.join()
+        self.unplug()
+        if self.link is not None and os.path.lexists(self.link):
+            os.remove(self.link)
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                if self.master_fd is not None:
+                    self.receive()
+                    self.stream()
+                    self.send()
+            time.sleep(0.0005)
+
+    """ Read and handle any commands from the host. """
+    def receive(self):
+        try:
+            readable, _, _ = select.select([self.master_fd], [], [], 0)
+            if readable:
+                self.rx.extend(os.read(self.master_fd, 4096))
+        except (BlockingIOError, OSError):
+            return
+        self.parse_commands()
+
+    """ Handle every complete command packet in self.rx. """
+    def parse_commands(self):
+        header_len = 4
+        while len(self.rx) >= header_len:
+            if self.rx[0] != comms.k_sync or self.rx[1] != comms.k_soh or \
+                    comms.checksum(self.rx[:3]) != self.rx[3]:
+                del self.rx[0]
+                continue
+
+            fn = self.rx[2]
+            if fn == comms.k_pparams:
+                if len(self.rx) <= header_len:
+                    return  # wait for the mode byte
+                data_len = comms.params_data_len(self.rx[header_len])
+                if data_len is None:
+                    del self.rx[0]
+                    continue
+                if len(self.rx) < header_len + data_len:
+                    return  # wait for the rest of the data section
+                data = bytes(self.rx[header_len:header_len + data_len])
+                if comms.checksum(data[:-1]) == data[-1]:
+                    self.params = data
+                    self.commands.append(fn)
+                del self.rx[:header_len + data_len]
+                continue
+
+            del self.rx[:header_len]
+            self.commands.append(fn)
+            if fn == comms.k_egram:
+                self.streaming = True
+                self.stream_start = time.monotonic()
+                self.stream_seq = self.seq
+            elif fn == comms.k_estop:
+                self.streaming = False
+            elif fn == comms.k_echo and self.params is not None:
+                header = bytearray([comms.k_sync, comms.k_soh, comms.k_echo])
+                header.append(comms.checksum(header))
+                self.out.extend(header + self.params)
+
+    """ Queue the egram frames that are due since the stream started. """
+    def stream(self):
+        if not self.streaming:
+            return
+        elapsed = time.monotonic() - self.stream_start
+        due = self.stream_seq + int(elapsed * self.rate) - self.seq
+        if due <= 0:
+            return
+
+        seq = np.arange(self.seq, self.seq + due)
+        self.seq = self.seq + due
+        frames = egram_frames(*synthetic_egram(seq, self.rate, noise=self.noise,
+                                               rng=self.rng))
+
+        room = (PacemakerSimulator.out_limit - len(self.out)) // len(frames[0])
+        if room < len(frames):
+            self.dropped_frames = self.dropped_frames + len(frames) - max(room, 0)
+            frames = frames[:max(room, 0)]
+
+        self.out.extend(with_garbage(frames, self.garbage, self.rng))
+
+    """ Write as much of the queued output as the port will take. """
+    def send(self):
+        if not self.out:
+            return
+        try:
+            num_bytes = os.write(self.master_fd, self.out)
+        except (BlockingIOError, OSError):
+            return
+        del self.out[:num_bytes]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pacemaker simulator")
+    parser.add_argument("--rate", type=int, default=1000,
+                        help="egram frames per second")
+    parser.add_argument("--noise", type=float, default=0)
+    parser.add_argument("--garbage", type=float, default=0,
+                        help="probability of junk bytes before a frame")
+    parser.add_argument("--link", default=None,
+                        help="stable path (symlink) for the port")
+    args = parser.parse_args()
+
+    sim = PacemakerSimulator(rate=args.rate, noise=args.noise,
+                             garbage=args.garbage, link=args.link)
+    print(f"Simulated Pacemaker on {sim.port_name}")
+    sim.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.quit()
@@ -3,11 +3,12 @@
 import tkinter as tk
 import tkinter.messagebox
 import csv
+import threading
 
 import params as p
 import auth
 #import egram
-#import comms
+import comms
 
 class LoginFrame(tk.Frame):
     def __init__(self, master=None):
@@ -264,6 +265,32 @@ class ParamsFrame(tk.Frame):
             else:
                 NonNumericParamDropDown(parameter, name=param_name, master=self)
 
+""" Display string of a parameter value as comms.upload_params() reports it """
+def value_str(param_name, value):
+    parameter = p.params[param_name]
+    if value is comms.not_confirmed:
+        return "(new)"
+    if value is None:
+        return "Off"
+    if isinstance(parameter, p.NonNumericParam):
+        return parameter.get_strings()[value]   # sent as the index
+    return f"{value} {parameter.unit}"
+
+""" 
+Runs comms.upload_params() in a background thread so the GUI (and the egram
+plot) keeps running while the Pacemaker is programmed and read back. 
+self.result and self.changed hold what upload_params() returned once it is 
+done.
+"""
+class UploadJob(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.result = None
+        self.changed = {}
+
+    def run(self):
+        self.result, self.changed = comms.upload_params()
+
 """ 
 Main window that contains different frame types.
 When switching the main frame, destroy the previous frame.
@@ -304,10 +331,35 @@ class MainWin(tk.Toplevel):
         menubar.add_cascade(label="Mode", menu=sub_mode)
 
         menubar.add_command(label="Send Params", command=self.send_params)
+        self.upload = None
         
     
+    """ 
+    Send the parameters if the Pacemaker doesn't have them already (in an 
+    UploadJob, pressing again while it runs does nothing), and show what 
+    changed.
+    """
     def send_params(self):
-        comms.update_pacemaker_params()
+        if self.upload is not None:
+            return # still sending
+        self.upload = UploadJob()
+        self.upload.start()
+        self.show_upload()
+
+    """ Poll the upload from the Tk main loop and show how it went """
+    def show_upload(self):
+        if self.upload.is_alive():
+            self.after(50, self.show_upload)
+            return
+        upload = self.upload
+        self.upload = None
+        if upload.result == "unchanged":
+            tkinter.messagebox.showinfo('Send Params', 'The Pacemaker already has these parameters.')
+        elif upload.result == "programmed":
+            lines = [f"{name}: {value_str(name, old)} -> {value_str(name, new)}" for name, (old, new) in upload.changed.items()]
+            tkinter.messagebox.showinfo('Send Params', 'Parameters sent and confirmed.\n' + '\n'.join(lines))
+        else:
+            tkinter.messagebox.showerror('Send Params', 'The Pacemaker did not confirm the parameters.')
 
     """ Ensure that all windows close (even invisible windows) """
     def destroy(self):